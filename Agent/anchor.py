@@ -0,0 +1,168 @@
+import cv2
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+
+class AnchorTracker:
+    """
+    图标锚点跟踪器。
+
+    模板只从磁盘解码一次并常驻内存；记住上一次匹配到的位置，
+    下一帧先在其附近的小窗口内搜索，置信度不足时才回退到全屏搜索
+    （全屏搜索可先在降采样的金字塔上粗定位，再在原分辨率下精确定位）。
+    """
+
+    def __init__(self, icon1_path: str, icon2_path: str, threshold: float = 0.8,
+                 search_margin: int = 32, pyramid_levels: int = 1,
+                 search_area: Optional[Tuple[int, int, int, int]] = None):
+        """
+        :param icon1_path: 左上角图标路径
+        :param icon2_path: 右下角图标路径
+        :param threshold: 模板匹配的置信度阈值
+        :param search_margin: 在上次位置附近搜索时向四周扩展的像素数
+        :param pyramid_levels: 全屏搜索时的降采样层数，0 表示直接在原分辨率搜索
+        :param search_area: 只在屏幕的 (left, top, right, bottom) 范围内搜索，多个窗口使用相同图标时用来区分窗口
+        """
+        icon1 = cv2.imread(icon1_path, cv2.IMREAD_COLOR)
+        icon2 = cv2.imread(icon2_path, cv2.IMREAD_COLOR)
+        if icon1 is None or icon2 is None:
+            raise FileNotFoundError("无法加载图标文件，请确认路径是否正确。")
+
+        self.templates = [cv2.cvtColor(icon1, cv2.COLOR_BGR2GRAY), cv2.cvtColor(icon2, cv2.COLOR_BGR2GRAY)]
+        self.threshold = threshold
+        self.search_margin = search_margin
+        self.pyramid_levels = pyramid_levels
+        self.search_area = search_area
+        # 两个图标上一次匹配到的左上角坐标，以及由它们确定的截图区域
+        self.positions: list = [None, None]
+        self.region: Optional[Tuple[int, int, int, int]] = None
+
+    def _match_window(self, img: np.ndarray, template: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> Optional[Tuple[int, int]]:
+        """
+        在 img[y0:y1, x0:x1] 内匹配模板，返回最佳位置（全图坐标），置信度不足时返回 None。
+        彩色图只转换窗口内的像素为灰度。
+        """
+        h, w = template.shape[:2]
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(img.shape[1], x1), min(img.shape[0], y1)
+        if x1 - x0 < w or y1 - y0 < h:
+            return None
+        window = img[y0:y1, x0:x1]
+        if window.ndim == 3:
+            window = cv2.cvtColor(window, cv2.COLOR_BGR2GRAY)
+        res = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        if max_val < self.threshold:
+            return None
+        return x0 + max_loc[0], y0 + max_loc[1]
+
+    def _full_search(self, img: np.ndarray, template: np.ndarray) -> Optional[Tuple[int, int]]:
+        """
+        全屏搜索：先在金字塔顶层粗定位，再在原分辨率的小窗口内精确定位。
+        """
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.pyramid_levels > 0:
+            scale = 2 ** self.pyramid_levels
+            small_gray, small_tpl = gray, template
+            for _ in range(self.pyramid_levels):
+                small_gray = cv2.pyrDown(small_gray)
+                small_tpl = cv2.pyrDown(small_tpl)
+            if small_tpl.shape[0] >= 4 and small_tpl.shape[1] >= 4:
+                res = cv2.matchTemplate(small_gray, small_tpl, cv2.TM_CCOEFF_NORMED)
+                _, max_val, _, max_loc = cv2.minMaxLoc(res)
+                # 降采样后的匹配分数会偏低，这里放宽阈值，最终以原分辨率的结果为准
+                if max_val >= self.threshold * 0.6:
+                    x, y = max_loc[0] * scale, max_loc[1] * scale
+                    h, w = template.shape[:2]
+                    found = self._match_window(gray, template, x - scale * 2, y - scale * 2, x + w + scale * 2, y + h + scale * 2)
+                    if found is not None:
+                        return found
+
+        return self._match_window(gray, template, 0, 0, gray.shape[1], gray.shape[0])
+
+    def _locate_icon(self, img: np.ndarray, index: int, ox: int, oy: int) -> Tuple[int, int]:
+        """
+        :param img: 屏幕上从 (ox, oy) 开始的一块图像；记住的位置和返回值都是屏幕坐标
+        """
+        template = self.templates[index]
+        found = None
+        last = self.positions[index]
+        if last is not None:
+            h, w = template.shape[:2]
+            m = self.search_margin
+            x, y = last[0] - ox, last[1] - oy
+            found = self._match_window(img, template, x - m, y - m, x + w + m, y + h + m)
+        if found is None:
+            found = self._full_search(img, template)
+        if found is None:
+            self.positions[index] = None
+            raise ValueError(f"icon{index + 1} 未找到匹配项")
+        found = (ox + found[0], oy + found[1])
+        self.positions[index] = found
+        return found
+
+    def locate(self, screen_img: np.ndarray, origin: Tuple[int, int] = (0, 0)) -> Tuple[int, int, int, int]:
+        """
+        定位两个图标之间的截图区域。
+
+        :param screen_img: BGR 或灰度的屏幕截图，可以只是屏幕的一部分
+        :param origin: screen_img 左上角在屏幕上的坐标，只截取了部分屏幕时传入
+        :return: (left, top, right, bottom)，左上角为 icon1 的右下角，右下角为 icon2 的右上角（屏幕坐标）
+        """
+        ox, oy = origin
+        if self.search_area is not None:
+            left, top, right, bottom = self.search_area
+            x0, y0 = max(0, left - ox), max(0, top - oy)
+            screen_img = screen_img[y0:max(y0, bottom - oy), x0:max(x0, right - ox)]
+            ox, oy = ox + x0, oy + y0
+        try:
+            x1, y1 = self._locate_icon(screen_img, 0, ox, oy)
+            x2, y2 = self._locate_icon(screen_img, 1, ox, oy)
+        except ValueError:
+            self.region = None
+            raise
+        h1, w1 = self.templates[0].shape[:2]
+        w2 = self.templates[1].shape[1]
+
+        # 截图区域左上角 = icon1 的右下角，右下角 = icon2 的右上角
+        self.region = (x1 + w1, y1 + h1, x2 + w2, y2)
+        return self.region
+
+    def bounds(self, screen_size: Optional[Tuple[int, int]] = None) -> Optional[Tuple[int, int, int, int]]:
+        """
+        下一帧需要截取的最小屏幕范围 (left, top, right, bottom)：两个图标及其周围 search_margin 的外接矩形，
+        足以完成窗口内搜索和截取聊天区域。还没有定位到两个图标时返回 None，需要截取整个屏幕。
+
+        :param screen_size: 屏幕的 (宽, 高)，传入时右边和下边不超出屏幕（窗口靠近屏幕边缘时）
+        """
+        if self.region is None or None in self.positions:
+            return None
+        (x1, y1), (x2, y2) = self.positions
+        h2, w2 = self.templates[1].shape[:2]
+        m = self.search_margin
+        right, bottom = x2 + w2 + m, y2 + h2 + m
+        if screen_size is not None:
+            right, bottom = min(right, screen_size[0]), min(bottom, screen_size[1])
+        return max(0, x1 - m), max(0, y1 - m), right, bottom
+
+    def reset(self) -> None:
+        """
+        清除记住的位置，下一次将进行全屏搜索。
+        """
+        self.positions = [None, None]
+        self.region = None
+
+
+_trackers: Dict[tuple, AnchorTracker] = {}
+
+
+def get_anchor_tracker(icon1_path: str, icon2_path: str, threshold: float = 0.8) -> AnchorTracker:
+    """
+    获取（必要时创建）对应图标组合的共享跟踪器。
+    """
+    key = (icon1_path, icon2_path, threshold)
+    tracker = _trackers.get(key)
+    if tracker is None:
+        tracker = AnchorTracker(icon1_path, icon2_path, threshold)
+        _trackers[key] = tracker
+    return tracker
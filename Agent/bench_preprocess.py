@@ -0,0 +1,90 @@
+"""
+比较不同图像预处理预设的编码耗时、负载大小以及识别结果的一致性。
+
+用法:
+    python bench_preprocess.py <帧目录> [--vl] [--repeat N]
+
+帧目录中的每个 .png 文件都是一张录制下来的聊天区域截图（例如开启 DEBUG_SNAPSHOT 后保存的 capture_result.png）。
+加上 --vl 时会用视觉模型识别每个预设的结果，并以 raw 预设的识别结果为基准计算一致性。
+"""
+import argparse
+import difflib
+import glob
+import os
+import time
+
+import cv2
+
+from preprocess import encode_with_preset
+from static import IMAGE_PRESETS, PROMPT_CHAT_READ, MODEL_NAME_VL
+
+
+def load_frames(frame_dir: str) -> list:
+    paths = sorted(glob.glob(os.path.join(frame_dir, "*.png")))
+    frames = [(os.path.basename(p), cv2.imread(p, cv2.IMREAD_COLOR)) for p in paths]
+    return [(name, img) for name, img in frames if img is not None]
+
+
+def transcribe(payload_b64: str) -> str:
+    """
+    用视觉模型识别一张已编码的图片，返回 sender:message 格式的文本。
+    """
+    from context_manager import PayloadBuilder
+    from service import describe_image_with_ollama
+    from utils import format_response_to_string, parse_json_from_markdown
+
+    payload = PayloadBuilder(MODEL_NAME_VL, stream=False)
+    payload.settings_fix_loop()
+    payload.add_user_message_with_image_b64(PROMPT_CHAT_READ, payload_b64)
+    return format_response_to_string(parse_json_from_markdown(describe_image_with_ollama(payload.build())))
+
+
+def run(frame_dir: str, use_vl: bool = False, repeat: int = 3) -> None:
+    import base64
+
+    frames = load_frames(frame_dir)
+    if not frames:
+        print(f"{frame_dir} 中没有可用的 .png 帧")
+        return
+
+    baseline = {}
+    rows = []
+    # raw 排在最前，作为一致性比较的基准
+    for name in sorted(IMAGE_PRESETS, key=lambda n: n != "raw"):
+        encode_ms = []
+        payload_bytes = []
+        agreement = []
+        for frame_name, img in frames:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = encode_with_preset(img, name)
+                encode_ms.append((time.perf_counter() - start) * 1000)
+            payload_bytes.append(len(data))
+
+            if use_vl:
+                text = transcribe(base64.b64encode(data).decode("utf-8"))
+                if name == "raw":
+                    baseline[frame_name] = text
+                agreement.append(difflib.SequenceMatcher(None, baseline.get(frame_name, ""), text).ratio())
+
+        rows.append((
+            name,
+            sum(encode_ms) / len(encode_ms),
+            sum(payload_bytes) / len(payload_bytes) / 1024,
+            sum(agreement) / len(agreement) if agreement else None,
+        ))
+
+    print(f"{len(frames)} 帧，每帧编码 {repeat} 次")
+    print(f"{'预设':<16}{'编码(ms)':>10}{'负载(KB)':>10}{'一致性':>8}")
+    for name, ms, kb, agree in rows:
+        agree_text = f"{agree:.3f}" if agree is not None else "-"
+        print(f"{name:<16}{ms:>10.2f}{kb:>10.1f}{agree_text:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图像预处理预设基准测试")
+    parser.add_argument("frame_dir", help="录制帧所在目录")
+    parser.add_argument("--vl", action="store_true", help="调用视觉模型计算识别一致性（需要 Ollama）")
+    parser.add_argument("--repeat", type=int, default=3, help="每帧编码的重复次数")
+    args = parser.parse_args()
+    run(args.frame_dir, args.vl, args.repeat)
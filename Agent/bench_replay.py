@@ -0,0 +1,275 @@
+"""
+离线回放基准测试：把录制的整屏帧依次当作“屏幕”，经过 capture_between_icons / describe_screen_capture /
+AgentPipeline 的完整逻辑，向本地模拟的 /api/chat 服务（mock_ollama.py）发起请求，
+报告帧率、端到端回复延迟分位数以及各阶段的耗时与 CPU 时间。不需要桌面环境和 GPU。
+
+用法:
+    python bench_replay.py [帧目录] [--fps F] [--vl-latency S] [--chat-latency S] [--max-p95 S] [--min-fps F] [--max-loads N]
+
+帧目录中的 .png 为按文件名排序的整屏截图（需包含 ICON1_PATH / ICON2_PATH 两个图标）；
+不指定帧目录时生成合成帧：两个图标之间的聊天区域每帧出现一条新消息并向上滚动。
+模拟服务默认只能容纳一个模型、每次加载耗时 LOAD_TIME 秒，换模型次数过多会直接反映在延迟和 --max-loads 上。
+设置 --max-p95 / --min-fps / --max-loads 时，不达标则以非零状态退出；tests/test_bench_replay.py 在常规测试中
+用较短的合成回放做同样的检查。
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from mock_ollama import MockOllamaServer
+from pipeline import AgentPipeline
+from poller import AdaptivePoller
+from session import ChatSession
+from store import ConversationStore, set_conversation_store
+from residency import ModelResidencyManager
+from service import OllamaClient, RequestScheduler, set_client, set_scheduler
+from static import ICON1_PATH, ICON2_PATH, MODEL_NAME_CHAT, MODEL_NAME_VL, MODEL_WARMUP
+from frame_source import VirtualDisplaySource, set_frame_source
+
+SYNTHETIC_SIZE = (1280, 800)  # 合成帧的 (宽, 高)
+LINE_HEIGHT = 90  # 合成帧中每条消息（头像、名称行和气泡）占用的高度
+SENDERS = ("Chrome", "李四", "晓羽")
+LOAD_TIME = 0.5  # 模拟加载一个模型的默认耗时（秒）
+MAX_LOADED = 1  # 模拟显存默认能同时容纳的模型数
+
+
+class ReplayScreen(VirtualDisplaySource):
+    """
+    按时间推进的回放屏幕：第 i 帧在开始后 i / fps 秒出现，全部播放完后停留在最后一帧。
+    作为 frame_source.set_frame_source 的截图来源。
+    """
+
+    def __init__(self, frames: List[np.ndarray], fps: float):
+        super().__init__()
+        self.frames = frames
+        self.fps = fps
+        self.start_time = None
+        self.last_index = 0  # 截图线程最近一次彩色截图所在的帧，即视觉模型看到的帧
+
+    def start(self) -> None:
+        self.start_time = time.perf_counter()
+
+    def _position(self) -> float:
+        return (time.perf_counter() - self.start_time) * self.fps
+
+    @property
+    def index(self) -> int:
+        return min(int(self._position()), len(self.frames) - 1)
+
+    @property
+    def finished(self) -> bool:
+        return self._position() >= len(self.frames)
+
+    def grab(self, region: Optional[tuple] = None, gray: bool = False) -> np.ndarray:
+        index = self.index
+        # 探针（灰度）和发送后刷新缓存（对话线程）的截图不会交给视觉模型
+        if not gray and threading.current_thread().name == "capture":
+            self.last_index = index
+        self.set_frame(self.frames[index])
+        return super().grab(region, gray)
+
+
+def load_frames(frame_dir: str) -> List[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(frame_dir, "*.png")))
+    frames = [cv2.imread(p, cv2.IMREAD_COLOR) for p in paths]
+    return [img for img in frames if img is not None]
+
+
+def synthetic_message(j: int) -> Dict[str, str]:
+    return {"sender": SENDERS[j % len(SENDERS)], "message": f"message {j}"}
+
+
+def synthetic_frames(count: int) -> List[np.ndarray]:
+    """
+    生成 count 张合成整屏帧：左上角 icon1、右下角 icon2，中间是逐帧新增并向上滚动的消息，
+    每条消息由头像、名称行和气泡组成，他人的消息在左侧，自己（SENDERS 中最后一个）的在右侧。
+    """
+    width, height = SYNTHETIC_SIZE
+    icon1 = cv2.imread(ICON1_PATH, cv2.IMREAD_COLOR)
+    icon2 = cv2.imread(ICON2_PATH, cv2.IMREAD_COLOR)
+    if icon1 is None or icon2 is None:
+        raise FileNotFoundError("无法加载图标文件，请在 Agent 目录下运行。")
+    (h1, w1), (h2, w2) = icon1.shape[:2], icon2.shape[:2]
+    x2, y2 = width - 40 - w2, height - 40 - h2
+    top, bottom = 40 + h1, y2
+
+    frames = []
+    for i in range(count):
+        frame = np.full((height, width, 3), 236, np.uint8)
+        frame[40:40 + h1, 40:40 + w1] = icon1
+        frame[y2:y2 + h2, x2:x2 + w2] = icon2
+        # 最新的消息在最下面，更早的消息依次向上
+        for j in range(i, -1, -1):
+            y = bottom - (i - j + 1) * LINE_HEIGHT
+            if y < top:
+                break
+            msg = synthetic_message(j)
+            sender = j % len(SENDERS)
+            own = sender == len(SENDERS) - 1
+            avatar_x = width - 150 if own else 110
+            bubble_x = avatar_x - 430 if own else avatar_x + 46
+            color = (80 + 60 * sender, 160, 220 - 60 * sender)
+            cv2.rectangle(frame, (avatar_x, y + 8), (avatar_x + 36, y + 44), color, -1)
+            cv2.putText(frame, f"user{sender}", (bubble_x if not own else bubble_x + 340, y + 20),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.45, (120, 120, 120), 1)
+            cv2.rectangle(frame, (bubble_x, y + 28), (bubble_x + 420, y + LINE_HEIGHT - 6), (255, 255, 255), -1)
+            cv2.putText(frame, msg["message"], (bubble_x + 12, y + 62),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2)
+        frames.append(frame)
+    return frames
+
+
+def visible_messages(index: int, region_height: int) -> List[Dict[str, str]]:
+    """
+    合成帧 index 中聊天区域内可见的消息，作为模拟视觉模型的识别结果。
+    """
+    first = max(0, index + 1 - region_height // LINE_HEIGHT)
+    return [synthetic_message(j) for j in range(first, index + 1)]
+
+
+def run(frames: List[np.ndarray], fps: float, vl_latency: float, chat_latency: float,
+        token_interval: float, interval: float, synthetic: bool, drain_timeout: float = 30,
+        load_time: float = LOAD_TIME, max_loaded: int = MAX_LOADED) -> Dict[str, float]:
+    screen = ReplayScreen(frames, fps)
+    region_height = SYNTHETIC_SIZE[1]
+
+    def vl_reply(payload: dict) -> str:
+        if synthetic:
+            return json.dumps(visible_messages(screen.last_index, region_height), ensure_ascii=False)
+        # 录制帧没有标注，用帧号生成一条不同的消息，让每个变化的帧都产生新批次
+        return json.dumps([{"sender": "回放", "message": f"第 {screen.last_index} 帧"}], ensure_ascii=False)
+
+    metrics.reset()
+    metrics.jsonl_path = None
+    server = MockOllamaServer(
+        replies={MODEL_NAME_VL: vl_reply},
+        latency={MODEL_NAME_VL: vl_latency, MODEL_NAME_CHAT: chat_latency},
+        token_interval=token_interval,
+        load_time={"*": load_time},
+        max_loaded=max_loaded,
+    ).start()
+    set_client(OllamaClient(server.url))
+    # 调度器按模拟的显存大小决定是否按模型分批
+    scheduler = RequestScheduler(residency=ModelResidencyManager(exclusive=max_loaded == 1))
+    set_scheduler(scheduler)
+    scheduler.warm(MODEL_WARMUP)
+    set_frame_source(screen)
+    # 会话存储放在内存中，每次回放从空历史开始，不读写 conversations.db
+    set_conversation_store(ConversationStore(":memory:"))
+
+    sent = []
+    session = ChatSession("replay", sender=sent.append)
+    pipeline = AgentPipeline([session], poller=AdaptivePoller([session], min_interval=interval))
+
+    screen.start()
+    pipeline.start()
+    chat_thread = threading.Thread(target=pipeline.chat_loop, name="chat", daemon=True)
+    chat_thread.start()
+    try:
+        while not screen.finished:
+            time.sleep(0.05)
+        # 回放结束后等待最后的批次处理完：队列为空且一段时间内没有新的回复
+        settle = vl_latency + chat_latency + 1.0
+        deadline = time.perf_counter() + drain_timeout
+        last = (-1, 0.0)
+        while time.perf_counter() < deadline:
+            done = metrics.summary().get("reply_latency", {}).get("count", 0)
+            if done != last[0]:
+                last = (done, time.perf_counter())
+            elif pipeline.batches.empty() and time.perf_counter() - last[1] > settle:
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - screen.start_time
+    finally:
+        pipeline.stop()
+        chat_thread.join(timeout=5)
+        set_frame_source(None)
+        set_scheduler(None)
+        set_conversation_store(None)
+        server.stop()
+
+    processed = metrics.counter("frames_changed")
+    result = {
+        "frames": len(frames),
+        "processed": processed,
+        "replies": len(sent),
+        "elapsed": elapsed,
+        "fps": processed / elapsed if elapsed else 0.0,
+        "loads": server.loads,
+    }
+    for q in (50, 90, 95, 99):
+        result[f"p{q}"] = metrics.percentile("reply_latency", q)
+    return result
+
+
+def check(result: Dict[str, float], max_p95: Optional[float] = None, min_fps: Optional[float] = None,
+          max_loads: Optional[int] = None) -> List[str]:
+    """
+    按阈值检查回放结果，返回不达标的项（全部达标时为空列表）。
+    """
+    failed = []
+    if max_p95 is not None and (result["p95"] is None or result["p95"] > max_p95):
+        failed.append(f"p95 延迟超出上限 {max_p95}s")
+    if min_fps is not None and result["fps"] < min_fps:
+        failed.append(f"帧率低于下限 {min_fps}")
+    if max_loads is not None and result["loads"] > max_loads:
+        failed.append(f"加载模型 {result['loads']} 次，超出上限 {max_loads}")
+    return failed
+
+
+def report(result: Dict[str, float]) -> None:
+    print(f"回放 {result['frames']} 帧，识别 {result['processed']:.0f} 个变化帧，发送 {result['replies']} 条回复，"
+          f"耗时 {result['elapsed']:.2f}s，{result['fps']:.2f} 帧/秒，加载模型 {result['loads']} 次")
+    latencies = "  ".join(f"p{q}={result[f'p{q}'] * 1000:.0f}ms" if result[f"p{q}"] is not None else f"p{q}=-"
+                          for q in (50, 90, 95, 99))
+    print(f"端到端回复延迟: {latencies}")
+    print(f"{'阶段':<40}{'次数':>6}{'平均(ms)':>10}{'CPU(ms)':>10}{'最大(ms)':>10}")
+    for stage, stats in sorted(metrics.summary().items()):
+        print(f"{stage:<40}{stats['count']:>6}{stats['avg'] * 1000:>10.2f}"
+              f"{stats['avg_cpu'] * 1000:>10.2f}{stats['max'] * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线回放基准测试")
+    parser.add_argument("frame_dir", nargs="?", help="录制的整屏帧目录，省略时使用合成帧")
+    parser.add_argument("--frames", type=int, default=40, help="合成帧的数量")
+    parser.add_argument("--fps", type=float, default=2.0, help="回放帧率")
+    parser.add_argument("--vl-latency", type=float, default=0.3, help="模拟视觉模型的延迟（秒）")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="模拟聊天模型首个 token 前的延迟（秒）")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="模拟流式输出每个数据块的间隔（秒）")
+    parser.add_argument("--interval", type=float, default=0.05, help="自适应轮询的最短间隔（秒）")
+    parser.add_argument("--load-time", type=float, default=LOAD_TIME, help="模拟加载一个模型的耗时（秒）")
+    parser.add_argument("--max-loaded", type=int, default=MAX_LOADED, help="模拟显存能同时容纳的模型数，0 表示不限")
+    parser.add_argument("--max-p95", type=float, help="端到端延迟 p95 上限（秒），超出则返回非零状态")
+    parser.add_argument("--min-fps", type=float, help="识别帧率下限，低于则返回非零状态")
+    parser.add_argument("--max-loads", type=int, help="加载模型次数上限，超出则返回非零状态")
+    parser.add_argument("--verbose", action="store_true", help="输出流水线日志")
+    args = parser.parse_args()
+    if not args.verbose:
+        # 回放中大量“截图未变化”等日志会淹没结果
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    if args.frame_dir:
+        frames = load_frames(args.frame_dir)
+        if not frames:
+            sys.exit(f"{args.frame_dir} 中没有可用的 .png 帧")
+    else:
+        frames = synthetic_frames(args.frames)
+
+    result = run(frames, args.fps, args.vl_latency, args.chat_latency, args.token_interval,
+                 args.interval, synthetic=not args.frame_dir, load_time=args.load_time, max_loaded=args.max_loaded)
+    report(result)
+
+    failed = check(result, args.max_p95, args.min_fps, args.max_loads)
+    if failed:
+        sys.exit("性能回退: " + "；".join(failed))
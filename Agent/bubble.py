@@ -0,0 +1,288 @@
+import hashlib
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from static import (BUBBLE_BG_TOLERANCE, BUBBLE_TEXT_KERNEL, BUBBLE_MIN_SIZE, BUBBLE_AVATAR_SIZE,
+                    BUBBLE_CONTEXT, BUBBLE_HISTORY, BUBBLE_MERGE_GAP)
+
+# (left, top, right, bottom)，聊天区域内的坐标
+Box = Tuple[int, int, int, int]
+
+
+class Bubble:
+    """
+    一个消息气泡。
+
+    box 为气泡本身；head 为气泡上方标明发送者的头像和名称行（同一发送者连续发送、没有自己的头像时，
+    沿用同侧上一条气泡的 head）；side 为 "left"（他人）或 "right"（自己）；
+    partial 表示气泡被聊天区域的上/下边缘截断。
+    """
+    __slots__ = ("box", "side", "head", "partial")
+
+    def __init__(self, box: Box, side: str, head: Optional[Box] = None, partial: bool = False):
+        self.box = box
+        self.side = side
+        self.head = head
+        self.partial = partial
+
+    def __repr__(self) -> str:
+        return f"Bubble(box={self.box}, side={self.side!r}, head={self.head}, partial={self.partial})"
+
+
+def background_color(region: np.ndarray) -> np.ndarray:
+    """
+    聊天背景色：抽样像素中出现最多的颜色（每个通道量化为 32 级后统计，再取该组像素的均值）。
+    """
+    sample = region[::4, ::4].reshape(-1, 3)
+    q = (sample >> 3).astype(np.int32)
+    codes = (q[:, 0] << 10) | (q[:, 1] << 5) | q[:, 2]
+    mode = np.bincount(codes, minlength=1 << 15).argmax()
+    return sample[codes == mode].mean(axis=0).astype(np.uint8)
+
+
+def foreground_mask(region: np.ndarray, bg: np.ndarray, tolerance: int = BUBBLE_BG_TOLERANCE) -> np.ndarray:
+    """
+    与背景色任一通道相差超过 tolerance 的像素。
+    """
+    lower = np.clip(bg.astype(np.int32) - tolerance, 0, 255).astype(np.uint8)
+    upper = np.clip(bg.astype(np.int32) + tolerance, 0, 255).astype(np.uint8)
+    return cv2.bitwise_not(cv2.inRange(region, lower, upper))
+
+
+def _boxes(mask: np.ndarray, kernel: int) -> List[Box]:
+    # 开运算去掉细的文字笔画，只留下气泡、头像、图片这类实心区域
+    solid = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (kernel, kernel)))
+    contours, _ = cv2.findContours(solid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        boxes.append((x, y, x + w, y + h))
+    return sorted(boxes, key=lambda b: (b[1], b[0]))
+
+
+def _is_avatar(box: Box, width: int) -> bool:
+    left, top, right, bottom = box
+    w, h = right - left, bottom - top
+    lo, hi = BUBBLE_AVATAR_SIZE
+    if not (lo <= w <= hi and lo <= h <= hi) or abs(w - h) > max(w, h) * 0.25:
+        return False
+    # 头像贴着聊天区域的左右两侧
+    center = (left + right) / 2
+    return center < width * 0.2 or center > width * 0.8
+
+
+def _match_avatar(box: Box, avatars: List[Box], used: set) -> Optional[Box]:
+    """
+    气泡左上方（他人）或右上方（自己）紧挨着的头像。
+    """
+    left, top, right, _ = box
+    best = None
+    for avatar in avatars:
+        if avatar in used:
+            continue
+        a_left, a_top, a_right, a_bottom = avatar
+        size = a_bottom - a_top
+        if not (a_top <= top + 4 and top - a_top <= size * 2):
+            continue
+        if a_right <= left + 4 and left - a_right <= size or a_left >= right - 4 and a_left - right <= size:
+            if best is None or a_top > best[1]:
+                best = avatar
+    return best
+
+
+def _head_box(mask: np.ndarray, box: Box, avatar: Box, side: str, max_gap: int = 24) -> Box:
+    """
+    头像与名称行的外接矩形：名称位于头像顶端到气泡顶端之间、头像朝向气泡的一侧，
+    从头像开始、中间空白不超过 max_gap 的连续文字都属于名称行。
+    """
+    left, top, right, _ = box
+    a_left, a_top, a_right, _ = avatar
+    head = [min(left, a_left), a_top, max(right, a_right), top]
+    if top > a_top:
+        if side == "left":
+            cols = a_right + np.flatnonzero(mask[a_top:top, a_right:].any(axis=0))
+            gaps = np.flatnonzero(np.diff(cols) > max_gap)
+            if cols.size:
+                head[2] = max(head[2], int(cols[gaps[0]] if gaps.size else cols[-1]) + 1)
+        else:
+            cols = np.flatnonzero(mask[a_top:top, :a_left].any(axis=0))
+            gaps = np.flatnonzero(np.diff(cols) > max_gap)
+            if cols.size:
+                head[0] = min(head[0], int(cols[gaps[-1] + 1] if gaps.size else cols[0]))
+    return tuple(head)
+
+
+def segment_bubbles(region: np.ndarray) -> List[Bubble]:
+    """
+    把聊天区域切分成消息气泡，并按几何位置把头像/名称行关联到气泡上。
+
+    前景为与背景色不同的像素；开运算后剩下的实心连通区域中，贴着左右两侧的近似正方形为头像，
+    足够大的其余区域为气泡（居中的窄条，如时间戳，会被忽略）。
+    气泡左上方（或右上方）紧挨的头像决定气泡属于哪一侧，头像顶端到气泡顶端之间为名称行；
+    没有头像的气泡视为同侧上一条气泡的发送者连续发送的消息。
+
+    :param region: BGR 聊天区域
+    :return: 从上到下排列的气泡
+    """
+    height, width = region.shape[:2]
+    mask = foreground_mask(region, background_color(region))
+    boxes = _boxes(mask, BUBBLE_TEXT_KERNEL)
+
+    avatars = [box for box in boxes if _is_avatar(box, width)]
+    min_w, min_h = BUBBLE_MIN_SIZE
+    candidates = []
+    for box in boxes:
+        left, top, right, bottom = box
+        if box in avatars or right - left < min_w or bottom - top < min_h:
+            continue
+        # 居中的窄条（时间戳、系统提示）不是消息
+        if abs((left + right) / 2 - width / 2) < width * 0.05 and right - left < width * 0.3:
+            continue
+        candidates.append(box)
+
+    bubbles: List[Bubble] = []
+    used = set()
+    for box in candidates:
+        left, top, right, bottom = box
+        partial = (top <= 0) != (bottom >= height)
+        avatar = _match_avatar(box, avatars, used)
+        if avatar is not None:
+            used.add(avatar)
+            side = "left" if avatar[0] < left else "right"
+            bubbles.append(Bubble(box, side, _head_box(mask, box, avatar, side), partial))
+            continue
+        # 连续发送的消息：与上一条气泡左对齐或右对齐时沿用它的发送者
+        previous = bubbles[-1] if bubbles else None
+        if previous is not None and previous.side == "left" and abs(previous.box[0] - left) <= 4:
+            bubbles.append(Bubble(box, "left", previous.head, partial))
+        elif previous is not None and previous.side == "right" and abs(previous.box[2] - right) <= 4:
+            bubbles.append(Bubble(box, "right", previous.head, partial))
+        else:
+            side = "left" if left <= width - right else "right"
+            bubbles.append(Bubble(box, side, None, partial))
+    return bubbles
+
+
+def bubble_key(region: np.ndarray, bubble: Bubble) -> bytes:
+    """
+    气泡内容的哈希。只使用气泡本身（不含名称行），名称行滚出可见范围后哈希仍然不变。
+    """
+    left, top, right, bottom = bubble.box
+    crop = np.ascontiguousarray(region[top:bottom, left:right])
+    digest = hashlib.blake2b(crop.data, digest_size=16)
+    digest.update(np.array(crop.shape, np.int32).tobytes())
+    return digest.digest()
+
+
+def compose_bubbles(region: np.ndarray, bubbles: List[Bubble], gap: int = 8) -> np.ndarray:
+    """
+    把选中的气泡（连同它们的头像和名称行）按原来的顺序和相对位置拼成一张图。
+
+    行范围相距不超过 BUBBLE_MERGE_GAP 的部分合并为一段，各段之间用背景色隔开；
+    列范围取所有气泡和名称行的外接范围，保留原来的左右布局。
+    """
+    spans = []
+    boxes = []
+    for bubble in bubbles:
+        boxes.append(bubble.box)
+        spans.append((bubble.box[1], bubble.box[3]))
+        if bubble.head is not None:
+            boxes.append(bubble.head)
+            spans.append((bubble.head[1], bubble.head[3]))
+    spans.sort()
+    merged = [list(spans[0])]
+    for top, bottom in spans[1:]:
+        if top <= merged[-1][1] + BUBBLE_MERGE_GAP:
+            merged[-1][1] = max(merged[-1][1], bottom)
+        else:
+            merged.append([top, bottom])
+
+    x0 = min(box[0] for box in boxes)
+    x1 = max(box[2] for box in boxes)
+    height = sum(bottom - top for top, bottom in merged) + gap * (len(merged) - 1)
+    canvas = np.empty((height, x1 - x0, 3), np.uint8)
+    canvas[:] = background_color(region)
+    y = 0
+    for top, bottom in merged:
+        canvas[y:y + bottom - top] = region[top:bottom, x0:x1]
+        y += bottom - top + gap
+    return canvas
+
+
+class BubbleTracker:
+    """
+    记住每个会话已经识别过的气泡，只把新出现的气泡交给视觉模型。
+
+    把当前帧完整气泡的哈希序列与上一帧对齐（滚动时两帧的序列只是错开了位置）：
+    最后一个对齐的气泡之后未对齐的气泡都是新消息（即使内容与以前的消息相同）；
+    之前未对齐的气泡（如向上翻页看到的旧消息）只有在最近见过的哈希中找不到时才算新消息。
+    发送时再附带新气泡之前 context 条已识别的气泡，供 MessageTimeline 对齐。
+    """
+
+    def __init__(self, history: int = BUBBLE_HISTORY, context: int = BUBBLE_CONTEXT):
+        """
+        :param history: 记住的气泡哈希数
+        :param context: 新气泡之前附带的已识别气泡数
+        """
+        self.history = history
+        self.context = context
+        self._previous: List[bytes] = []
+        self._seen: "OrderedDict[bytes, None]" = OrderedDict()
+
+    def _new_indices(self, keys: List[bytes]) -> List[int]:
+        matched = set()
+        last_match = -1
+        for block in SequenceMatcher(None, self._previous, keys, autojunk=False).get_matching_blocks():
+            if block.size:
+                matched.update(range(block.b, block.b + block.size))
+                last_match = block.b + block.size - 1
+        new = []
+        for i, key in enumerate(keys):
+            if i in matched:
+                continue
+            # 没有任何对齐（如跳转到了别处）时，只能依靠见过的哈希判断
+            if (i > last_match and last_match >= 0) or key not in self._seen:
+                new.append(i)
+        return new
+
+    def _remember(self, keys: List[bytes]) -> None:
+        self._previous = keys
+        for key in keys:
+            self._seen[key] = None
+            self._seen.move_to_end(key)
+        while len(self._seen) > self.history:
+            self._seen.popitem(last=False)
+
+    def extract(self, region: np.ndarray) -> Optional[np.ndarray]:
+        """
+        找出区域中的新气泡并拼成一张图。
+
+        :param region: BGR 聊天区域（整个区域，不是增量裁剪后的部分）
+        :return: 拼好的新气泡图像；没有新气泡时返回 None；
+                 完全分割不出气泡（界面与预期不符）时返回整个区域，由视觉模型直接识别
+        """
+        with metrics.timer("bubble_segment"):
+            bubbles = segment_bubbles(region)
+            if not bubbles:
+                metrics.incr("bubble_fallback")
+                return region
+            # 被上下边缘截断的气泡内容不完整，等它完整出现时再发送
+            complete = [bubble for bubble in bubbles if not bubble.partial]
+            keys = [bubble_key(region, bubble) for bubble in complete]
+            new = self._new_indices(keys)
+            self._remember(keys)
+            metrics.incr("bubbles_new", len(new))
+            if not new:
+                return None
+            first = new[0]
+            selected = sorted(set(range(max(0, first - self.context), first)) | set(new))
+            return compose_bubbles(region, [complete[i] for i in selected])
+
+    def clear(self) -> None:
+        self._previous = []
+        self._seen.clear()
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+from typing import Optional, Tuple
+
+from static import CHANGE_SENSITIVITY, CHANGE_MAX_SHIFT, CHANGE_SIGNATURE_SIZE
+
+
+class ChangeDetector:
+    """
+    基于缩略图行签名的廉价变化检测。
+
+    区域先用 INTER_AREA 缩放到固定大小的灰度缩略图（签名），比较时允许上下左右
+    少量偏移，取各偏移下“最差一行”的平均差值中的最小值作为变化分数。
+    缩放到固定尺寸使区域大小的 1px 抖动不再被当作变化，按行取最大值则保证
+    底部新出现的一条消息也能被检测到。
+    """
+
+    def __init__(self, sensitivity: float = CHANGE_SENSITIVITY, max_shift: int = CHANGE_MAX_SHIFT,
+                 signature_size: Tuple[int, int] = CHANGE_SIGNATURE_SIZE):
+        """
+        :param sensitivity: 判定为变化的分数阈值（灰度级 0~255），越小越敏感
+        :param max_shift: 比较时允许的最大偏移（签名像素）
+        :param signature_size: 签名的 (宽, 高)
+        """
+        self.sensitivity = sensitivity
+        self.max_shift = max_shift
+        self.signature_size = signature_size
+        # 先比较不偏移的情况，画面未变化时通常第一次比较就能返回
+        self._shifts = sorted(((dy, dx) for dy in range(-max_shift, max_shift + 1) for dx in range(-max_shift, max_shift + 1)),
+                              key=lambda d: abs(d[0]) + abs(d[1]))
+
+    def signature(self, region: np.ndarray) -> np.ndarray:
+        """
+        计算区域的签名。
+        """
+        w, h = self.signature_size
+        # 区域远大于签名时先隔行隔列取样，减少 INTER_AREA 需要处理的像素
+        step = max(1, min(region.shape[0] // (h * 4), region.shape[1] // (w * 4)))
+        small = cv2.resize(region[::step, ::step], self.signature_size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.float32)
+
+    def score(self, sig1: np.ndarray, sig2: np.ndarray, stop_below: float = -1.0) -> float:
+        """
+        计算两个签名之间容忍偏移后的变化分数。
+
+        :param stop_below: 某个偏移下的分数不超过该值时提前返回（用于只需回答“是否变化”的场景）
+        """
+        h, w = sig1.shape
+        best = float("inf")
+        for dy, dx in self._shifts:
+            a = sig1[max(0, dy):h + min(0, dy), max(0, dx):w + min(0, dx)]
+            b = sig2[max(0, -dy):h + min(0, -dy), max(0, -dx):w + min(0, -dx)]
+            row_diff = float(cv2.reduce(cv2.absdiff(a, b), 1, cv2.REDUCE_AVG).max())
+            if row_diff < best:
+                best = row_diff
+                if best <= stop_below:
+                    break
+        return best
+
+    def changed(self, sig1: Optional[np.ndarray], sig2: np.ndarray) -> bool:
+        """
+        判断签名对应的画面是否发生了变化；没有旧签名时视为变化。
+        """
+        if sig1 is None or sig1.shape != sig2.shape:
+            return True
+        return self.score(sig1, sig2, stop_below=self.sensitivity) > self.sensitivity
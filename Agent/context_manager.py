@@ -1,49 +1,90 @@
-from typing import List, Dict, Optional, Any
-from utils import image_to_base64, image_to_base64_NumPy
+import base64
+import logging
+import threading
+from typing import List, Dict, Optional, Any, Set, Union
+from utils import estimate_tokens, parse_json_from_markdown
+from preprocess import encode_image
 from service import ollama_query
-from static import SUMMARIZE_PROMPT
+from metrics import metrics
+from static import SUMMARIZE_PROMPT, SUMMARIZE_UPDATE_TEMPLATE, CONTEXT_TOKEN_BUDGET, SUMMARIZE_TOKEN_THRESHOLD, MESSAGE_TOKEN_OVERHEAD, IMAGE_TOKEN_ESTIMATE, PROMPT_LAYOUT, WINDOW_SHRINK, MEMORY_BLOCK_TEMPLATE
+from static import SUMMARIZE_NOTES_PROMPT, SUMMARIZE_NOTES_TEMPLATE, STORE_NOTE_LIMIT
 
 
 class Message:
-    def __init__(self, role: str, content: str, images: Optional[List[str]] = None):
+    """
+    对话历史中的一条消息。
+
+    图片保存为编码后的原始字节（也接受已经是 Base64 的字符串），只在序列化时转为 Base64；
+    to_dict() 的结果会被缓存，消息留在历史中时多次 build() 不再重复构造和编码，调用方不能修改返回的字典。
+    """
+    __slots__ = ("role", "content", "_images", "tokens", "_dict")
+
+    def __init__(self, role: str, content: str, images: Optional[List[Union[bytes, str]]] = None):
         self.role = role
         self.content = content
-        self.images: Optional[List[str]] = images  # 支持多张图
+        self._images: Optional[List[Union[bytes, str]]] = images  # 支持多张图
+        self._dict: Optional[Dict[str, Any]] = None
+        # 未校准的 token 估计（含模板开销），实际使用时乘以 PayloadBuilder.token_ratio
+        self.tokens = 0.0
+        self._estimate()
+
+    def _estimate(self) -> None:
+        self.tokens = estimate_tokens(self.content) + MESSAGE_TOKEN_OVERHEAD + IMAGE_TOKEN_ESTIMATE * len(self._images or [])
+
+    @property
+    def images(self) -> Optional[List[str]]:
+        """
+        Base64 编码的图片列表。
+        """
+        if self._images is None:
+            return None
+        return self.to_dict()["images"]
 
     def to_dict(self) -> Dict[str, Any]:
-        message_dict = {
-            "role": self.role,
-            "content": self.content
-        }
-        if self.images is not None:
-            message_dict["images"] = self.images # type: ignore
-        return message_dict
+        if self._dict is None:
+            message_dict = {
+                "role": self.role,
+                "content": self.content
+            }
+            if self._images is not None:
+                message_dict["images"] = [image if isinstance(image, str) else base64.b64encode(image).decode("ascii")
+                                          for image in self._images]  # type: ignore
+            self._dict = message_dict
+        return self._dict
 
 
 class MessageManager:
     def __init__(self):
         self.messages: List[Message] = []
 
+    def _append(self, message: Message) -> None:
+        self.messages.append(message)
+
     def add_user_message(self, content: str) -> None:
-        self.messages.append(Message("user", content))
+        self._append(Message("user", content))
 
     def add_user_message_with_imagepath(self, content: str, image_path: str) -> None:
-        image_b64 = image_to_base64(image_path)
-        self.messages.append(Message("user", content, [image_b64]))  # 这里是 list
-    
+        with open(image_path, "rb") as image_file:
+            self._append(Message("user", content, [image_file.read()]))  # 这里是 list
+
     def add_user_message_with_image(self, content: str, image) -> None:
-        image_b64 = image_to_base64(image)
-        # 假设 image 是一个图片的对象
-        self.messages.append(Message("user", content, [image_b64]))
+        # 假设 image 是一个 NumPy 图像，编码后保存原始字节
+        self._append(Message("user", content, [encode_image(image)]))
 
     def add_user_message_with_base64(self, content: str, image_b64: str) -> None:
-        self.messages.append(Message("user", content, [image_b64]))
+        self._append(Message("user", content, [image_b64]))
+
+    def add_user_message_with_images_base64(self, content: str, images_b64: List[str]) -> None:
+        self._append(Message("user", content, list(images_b64)))
+
+    def add_user_message_with_images_bytes(self, content: str, images: List[bytes]) -> None:
+        self._append(Message("user", content, list(images)))
 
     def add_assistant_message(self, content: str) -> None:
-        self.messages.append(Message("assistant", content))
+        self._append(Message("assistant", content))
 
     def add_system_prompt(self, content: str) -> None:
-        self.messages.append(Message("system", content))
+        self._append(Message("system", content))
 
     def clear_messages(self) -> None:
         self.messages.clear()
@@ -53,7 +94,13 @@ class MessageManager:
 
 
 class PayloadBuilder:
-    def __init__(self, model_name: str, stream: bool = False, system_prompt: Optional[str] = None, settings: Optional[Dict[str, Any]] = None):
+    def __init__(self, model_name: str, stream: bool = False, system_prompt: Optional[str] = None, settings: Optional[Dict[str, Any]] = None,
+                 context_budget: int = CONTEXT_TOKEN_BUDGET, summarize_threshold: int = SUMMARIZE_TOKEN_THRESHOLD, layout: str = PROMPT_LAYOUT):
+        """
+        :param context_budget: 每次请求的 prompt token 上限，超出时只保留最近的消息（滑动窗口）
+        :param summarize_threshold: 估计的 prompt token 数超过该值时 auto_summarize_and_clear 才进行摘要
+        :param layout: "stable" 为前缀稳定布局（记忆放在最新消息前），"merged" 为把记忆合并进 system 消息
+        """
         self.model_name = model_name
         self.stream = stream
         self.message_manager = MessageManager()
@@ -62,6 +109,25 @@ class PayloadBuilder:
         self.memory = ""
         self.settings = settings if settings is not None else {}
 
+        self.layout = layout
+        self.context_budget = context_budget
+        self._window_first: Optional[Message] = None
+        # 最近一次 build() 的 prompt token 估计
+        self.last_built_tokens = 0.0
+        self.summarize_threshold = summarize_threshold
+        # 估计值与 Ollama 实际计数之比，由 record_usage() 持续校准
+        self.token_ratio = 1.0
+        self.last_prompt_tokens = 0
+        self.last_eval_tokens = 0
+
+        # 设置了会话存储（store.ConversationStore）时，摘要只更新存储中各发送者的笔记，memory 由 ChatSession.recall 每轮检索生成
+        self.store = None
+        self.session = ""
+
+        # 后台摘要线程与保护 memory/消息历史交换的锁
+        self._lock = threading.RLock()
+        self._summary_thread: Optional[threading.Thread] = None
+
     def set_stream(self, stream: bool) -> "PayloadBuilder":
         self.stream = stream
         return self
@@ -78,6 +144,17 @@ class PayloadBuilder:
         self.message_manager.add_user_message_with_base64(content, image_b64)
         return self
 
+    def add_user_message_with_images_b64(self, content: str, images_b64: List[str]) -> "PayloadBuilder":
+        self.message_manager.add_user_message_with_images_base64(content, images_b64)
+        return self
+
+    def add_user_message_with_images(self, content: str, images: List[bytes]) -> "PayloadBuilder":
+        """
+        添加带图片的消息，images 为编码后的原始字节（如 preprocess.encode_with_preset 的结果），序列化时才转为 Base64。
+        """
+        self.message_manager.add_user_message_with_images_bytes(content, images)
+        return self
+
     def add_assistant_message(self, content: str) -> "PayloadBuilder":
         self.message_manager.add_assistant_message(content)
         return self
@@ -87,25 +164,44 @@ class PayloadBuilder:
         return self
 
     def build(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._build()
+
+    def _build(self) -> Dict[str, Any]:
         # 构建最终的 messages 列表
         built_messages = []
 
-        # 合并 system_prompt 和 memory
-        system_content = ""
-        if self.system_prompt:
-            system_content += self.system_prompt
-        if self.memory:
-            if system_content:
-                system_content += "\n\n" + self.memory
-            else:
-                system_content = self.memory
+        if self.layout == "stable":
+            # 前缀稳定布局：system 消息只包含静态的 system_prompt，记忆等易变内容放在最新一条消息前，
+            # 使 system_prompt 与历史消息的前缀在多次请求间逐字节一致，Ollama 可以复用 KV 缓存
+            if self.system_prompt:
+                built_messages.append(Message("system", self.system_prompt).to_dict())
+            window = self._window(self.estimate(self.system_prompt or "") + self.estimate(self.memory))
+            built_messages.extend(msg.to_dict() for msg in window[:-1])
+            if window:
+                last = window[-1].to_dict()
+                if self.memory:
+                    # to_dict() 的结果是缓存的，不能直接修改
+                    last = dict(last)
+                    last["content"] = MEMORY_BLOCK_TEMPLATE.format(memory=self.memory, content=last["content"])
+                built_messages.append(last)
+        else:
+            # 合并 system_prompt 和 memory
+            system_content = ""
+            if self.system_prompt:
+                system_content += self.system_prompt
+            if self.memory:
+                if system_content:
+                    system_content += "\n\n" + self.memory
+                else:
+                    system_content = self.memory
 
-        if system_content.strip():
-            # 插入 system 消息到最前面
-            built_messages.append(Message("system", system_content).to_dict())
+            if system_content.strip():
+                # 插入 system 消息到最前面
+                built_messages.append(Message("system", system_content).to_dict())
 
-        # 添加其余消息
-        built_messages.extend(self.message_manager.get_messages())
+            # 添加其余消息：超出预算时只保留最近的消息
+            built_messages.extend(msg.to_dict() for msg in self._window(self.estimate(system_content)))
 
         request =  {
             "model": self.model_name,
@@ -120,51 +216,198 @@ class PayloadBuilder:
         return request
 
     def reset_messages(self) -> None:
-        self.message_manager.clear_messages()
+        with self._lock:
+            self.message_manager.clear_messages()
+
+    def history_lines(self) -> Set[str]:
+        """
+        消息历史中的每一行（识别出的消息为 "sender:message"），用于检索时跳过已在上下文中的消息。
+        """
+        with self._lock:
+            return {line for msg in self.message_manager.messages for line in msg.content.splitlines()}
+
+    def estimate(self, text: str) -> float:
+        """
+        使用校准后的比例估计文本的 token 数。
+        """
+        return estimate_tokens(text) * self.token_ratio
+
+    def history_tokens(self) -> float:
+        """
+        消息历史的 token 估计值。
+        """
+        return sum(msg.tokens for msg in self.message_manager.messages) * self.token_ratio
+
+    def prompt_tokens(self) -> float:
+        """
+        完整 prompt（系统提示、记忆与消息历史）的 token 估计值。
+        """
+        return self.estimate(self.system_prompt or "") + self.estimate(self.memory) + self.history_tokens()
+
+    def _window(self, used: float) -> List[Message]:
+        """
+        选取放入 prompt 的消息窗口；最新的一条消息总会被保留。
+
+        窗口起点只在超出预算时才向后移动，并且一次移动到只占预算的 WINDOW_SHRINK 比例，
+        这样大多数请求的历史前缀保持不变，不会因为每轮丢弃一条旧消息而使 KV 缓存失效。
+        """
+        messages = self.message_manager.messages
+        if not messages:
+            return []
+        start = 0
+        for i, msg in enumerate(messages):
+            if msg is self._window_first:
+                start = i
+                break
+
+        costs = [msg.tokens * self.token_ratio for msg in messages]
+        if used + sum(costs[start:]) > self.context_budget:
+            target = self.context_budget * WINDOW_SHRINK
+            total = used + sum(costs[start:])
+            while start < len(messages) - 1 and total > target:
+                total -= costs[start]
+                start += 1
+        self._window_first = messages[start]
+        self.last_built_tokens = used + sum(costs[start:])
+        return messages[start:]
+
+    def record_usage(self, stats: Dict[str, Any], output_text: str = "") -> None:
+        """
+        根据 Ollama 返回的 prompt_eval_count/eval_count 校准 token 估计。
 
-    def auto_summarize_and_clear(self) -> None:
+        :param stats: Ollama 响应（或其中的统计字段）
+        :param output_text: 本次生成的完整文本（含思考部分），eval_count 即为它的真实 token 数
         """
-        使用当前对话历史生成摘要，并重置消息历史。
+        prompt_count = stats.get("prompt_eval_count")
+        eval_count = stats.get("eval_count")
+        if eval_count and output_text:
+            observed = eval_count / max(estimate_tokens(output_text), 1.0)
+            # 指数滑动平均，避免单次偏差过大
+            self.token_ratio = 0.8 * self.token_ratio + 0.2 * observed
+            self.last_eval_tokens = eval_count
+        if prompt_count:
+            self.last_prompt_tokens = prompt_count
+            # 命中 KV 缓存时 prompt_eval_count 只会偏小；若比估计值还大，说明估计偏低
+            estimated = self.last_built_tokens or self.prompt_tokens()
+            if not estimated:
+                # 没有可比较的估计（如空的请求），无法判断缓存复用情况
+                return
+            if prompt_count > estimated:
+                self.token_ratio *= prompt_count / estimated
+            else:
+                logging.info(f"[{self.model_name}] prompt_eval_count={prompt_count}，完整 prompt 估计约 {estimated:.0f} tokens，"
+                             f"约 {max(0.0, 1 - prompt_count / estimated):.0%} 由 KV 缓存复用")
+
+    def auto_summarize_and_clear(self, background: bool = True) -> None:
         """
+        把当前对话历史滚动合并进 memory 摘要，并从历史中移除已摘要的消息。
 
-        # 0. 如果没有足够的消息，则不进行摘要
-        MAX_TOKENS = 2048  # 假设的最大 token 数
-        all_messages = self.message_manager.get_messages()
-        total_length = sum(len(msg["content"]) for msg in all_messages)
-        if total_length < MAX_TOKENS:
+        摘要基于历史的快照生成；后台运行时新消息照常追加，摘要完成后在锁内原子地
+        替换 memory 并只移除快照中的消息，之后到达的消息保留在摘要之后。
+        :param background: 是否在后台线程中生成摘要（默认），False 时同步执行
+        """
+        # 0. 如果 prompt 还没有接近预算，或者已有摘要任务在运行，则不进行摘要
+        if self.summarizing() or self.prompt_tokens() < self.summarize_threshold:
             return
-        
-        # 1. 复制当前 builder（不共享引用）
-        summarize_builder = PayloadBuilder(
-            model_name=self.model_name,
-            stream=False,
-            system_prompt=SUMMARIZE_PROMPT  # 专门用于自动总结的系统提示
-        )
 
-        # 2. 将当前消息复制给新 builder（除了 system_prompt）
-        summarize_builder.memory = self.message_manager.memory
+        # 1. 对当前历史和记忆做快照（不共享列表引用）
+        with self._lock:
+            snapshot = list(self.message_manager.messages)
+            memory = self.memory
+        if not snapshot:
+            return
+
+        if background:
+            self._summary_thread = threading.Thread(target=self._summarize, args=(snapshot, memory), name="summarize", daemon=True)
+            self._summary_thread.start()
+        else:
+            self._summarize(snapshot, memory)
+
+    def summarizing(self) -> bool:
+        """
+        是否有后台摘要任务正在运行。
+        """
+        return self._summary_thread is not None and self._summary_thread.is_alive()
 
-        for msg in self.message_manager.messages:
+    def _summarize(self, snapshot: List[Message], memory: str) -> None:
+        if self.store is not None:
+            self._summarize_notes(snapshot)
+            return
+        # 2. 增量摘要：只把快照中的新对话合并进已有记忆，而不是重新阅读全部内容
+        turns = []
+        for msg in snapshot:
             if msg.role == "user":
-                if msg.images:
-                    # 如果有图片 Base64，需要处理成原始字符串格式
-                    image_b64 = msg.images[0] if isinstance(msg.images[0], str) else ""
-                    summarize_builder.add_user_message_with_base64(msg.content, image_b64)
-                else:
-                    summarize_builder.add_user_message(msg.content)
+                turns.append(msg.content)
             elif msg.role == "assistant":
-                summarize_builder.add_assistant_message(msg.content)
+                turns.append(f"[自己的回复]{msg.content}")
+        summarize_builder = PayloadBuilder(
+            model_name=self.model_name,
+            stream=False,
+            system_prompt=SUMMARIZE_PROMPT,  # 专门用于自动总结的系统提示
+            context_budget=int(self.prompt_tokens()) + 1  # 摘要需要看到全部快照，不做滑动窗口裁剪
+        )
+        summarize_builder.add_user_message(SUMMARIZE_UPDATE_TEMPLATE.format(memory=memory or "（无）", turns="\n".join(turns)))
 
         # 3. 调用 Ollama 获取摘要
         try:
-            summary_response = ollama_query(summarize_builder.build())
+            with metrics.timer("summarize"):
+                summary_response = ollama_query(summarize_builder.build(), "summary")
         except Exception as e:
-            print(f"摘要生成失败: {e}")
+            logging.error(f"摘要生成失败: {e}")
             return
 
-        # 4. 保存摘要到 memory 并清空消息历史
-        self.memory = summary_response
-        self.reset_messages()
+        # 4. 原子地替换 memory，并只移除已经被摘要的消息
+        with self._lock:
+            summarized = {id(msg) for msg in snapshot}
+            self.message_manager.messages = [msg for msg in self.message_manager.messages if id(msg) not in summarized]
+            self.memory = summary_response
+        logging.debug(f"记忆摘要已更新，剩余 {len(self.message_manager.messages)} 条消息")
+
+    def _summarize_notes(self, snapshot: List[Message]) -> None:
+        """
+        会话存储模式的摘要：消息本身已经保存在存储中，需要时按相关度检索，这里只更新快照中出现的发送者的笔记，
+        然后把快照中的消息移出历史。prompt 中只放相关的笔记和检索结果，不再随运行时间增长。
+        """
+        turns, senders = [], []
+        for msg in snapshot:
+            if msg.role == "user":
+                for line in msg.content.splitlines():
+                    sender, sep, _ = line.partition(":")
+                    if sep and sender not in senders:
+                        senders.append(sender)
+                turns.append(msg.content)
+            elif msg.role == "assistant":
+                turns.append(f"[自己的回复]{msg.content}")
+
+        notes = {}
+        if senders:
+            existing = self.store.notes(self.session, senders)
+            summarize_builder = PayloadBuilder(
+                model_name=self.model_name,
+                stream=False,
+                system_prompt=SUMMARIZE_NOTES_PROMPT,
+                settings={"format": "json"},
+                context_budget=int(self.prompt_tokens()) + 1
+            )
+            summarize_builder.add_user_message(SUMMARIZE_NOTES_TEMPLATE.format(
+                notes="\n".join(f"{sender}: {note}" for sender, note in existing.items()) or "（无）",
+                turns="\n".join(turns), senders="、".join(senders), limit=STORE_NOTE_LIMIT))
+            try:
+                with metrics.timer("summarize"):
+                    summary_response = ollama_query(summarize_builder.build(), "summary")
+            except Exception as e:
+                logging.error(f"笔记生成失败: {e}")
+                return
+            updated = parse_json_from_markdown(summary_response, dict)
+            if isinstance(updated, dict):
+                notes = {sender: str(note)[:STORE_NOTE_LIMIT] for sender, note in updated.items()
+                         if sender in senders and isinstance(note, str) and note.strip()}
+            self.store.set_notes(self.session, notes)
+
+        with self._lock:
+            summarized = {id(msg) for msg in snapshot}
+            self.message_manager.messages = [msg for msg in self.message_manager.messages if id(msg) not in summarized]
+        logging.debug(f"已更新 {len(notes)} 位发送者的笔记，剩余 {len(self.message_manager.messages)} 条消息")
 
     def settings_fix_loop(self):
         """
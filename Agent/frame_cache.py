@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+from typing import Dict, Optional
+
+from change_detect import ChangeDetector
+
+
+# 比较两张图像是否几乎相同（允许一定误差）
+def is_similar(img1, img2, threshold=500):
+    if img1.shape != img2.shape:
+        # 尺寸不一致时默认认为不同
+        return False
+    
+    diff = cv2.absdiff(img1, img2)
+    non_zero = cv2.countNonZero(cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY))
+    
+    return non_zero < threshold
+
+
+class FrameCache:
+    """
+    在内存中保存上一次接受的截图区域，用于判断屏幕是否发生变化。
+    只有开启调试快照时才会写入磁盘。
+    """
+
+    def __init__(self, snapshot_path: Optional[str] = None, detector: Optional[ChangeDetector] = None):
+        """
+        :param snapshot_path: 调试快照的保存路径，None 表示不写盘
+        :param detector: 变化检测器，默认使用 static 中的灵敏度配置
+        """
+        self.region: Optional[np.ndarray] = None
+        self.signature: Optional[np.ndarray] = None
+        self.snapshot_path = snapshot_path
+        self.detector = detector if detector is not None else ChangeDetector()
+        self._candidate = None
+
+    def is_unchanged(self, region: np.ndarray) -> bool:
+        """
+        判断新区域与缓存相比是否没有显著变化。
+        """
+        signature = self.detector.signature(region)
+        unchanged = not self.detector.changed(self.signature, signature)
+        # 发生变化时，紧接着的 update() 可以复用这次计算的签名
+        self._candidate = None if unchanged else (region, signature)
+        return unchanged
+
+    def update(self, region: np.ndarray) -> None:
+        """
+        用当前帧更新缓存。
+        区域通常是截图（可能是截图来源复用的缓冲区）的切片，这里复制一份，
+        既避免缓存让整张截图一直驻留内存，也避免下一次截图覆盖缓存的内容。
+        """
+        if self._candidate is not None and self._candidate[0] is region:
+            self.signature = self._candidate[1]
+        else:
+            self.signature = self.detector.signature(region)
+        self._candidate = None
+        # 只复制一次：np.ascontiguousarray(...).copy() 对不连续的切片会复制两次
+        self.region = np.array(region, order="C")
+        if self.snapshot_path:
+            cv2.imwrite(self.snapshot_path, self.region)
+
+    def clear(self) -> None:
+        self.region = None
+        self.signature = None
+
+
+_caches: Dict[str, FrameCache] = {}
+
+
+def get_frame_cache(name: str, snapshot_path: Optional[str] = None) -> FrameCache:
+    """
+    获取（必要时创建）指定名称的共享帧缓存。
+    """
+    cache = _caches.get(name)
+    if cache is None:
+        cache = FrameCache(snapshot_path)
+        _caches[name] = cache
+    return cache
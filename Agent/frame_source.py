@@ -0,0 +1,179 @@
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from static import FRAME_SOURCE
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+# (left, top, width, height)，None 表示整个主屏幕
+Region = Optional[Tuple[int, int, int, int]]
+
+
+class FrameSource(ABC):
+    """
+    截图来源。grab() 返回 BGR（或 gray=True 时的灰度）图像。
+
+    为减少每帧的内存分配，实现可以复用预分配的缓冲区：返回的数组在同一线程下一次截取
+    相同大小的区域时可能被覆盖，需要保留时请自行复制（FrameCache.update 会复制）。
+    """
+
+    @abstractmethod
+    def grab(self, region: Region = None, gray: bool = False) -> np.ndarray:
+        """
+        :param region: (left, top, width, height)，None 表示整个主屏幕
+        :param gray: 是否返回灰度图
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class _BufferPool(threading.local):
+    """
+    每个线程按 (高, 宽, 通道数) 保存一个可复用的缓冲区。
+    """
+
+    def __init__(self):
+        self.buffers: Dict[tuple, np.ndarray] = {}
+
+    def get(self, shape: tuple) -> np.ndarray:
+        buf = self.buffers.get(shape)
+        if buf is None:
+            buf = self.buffers[shape] = np.empty(shape, np.uint8)
+        return buf
+
+
+class PyAutoGuiSource(FrameSource):
+    """
+    通过 pyautogui（PIL）截图，原有实现。颜色转换直接写入复用的缓冲区，省去一次整帧分配。
+    """
+
+    def __init__(self):
+        import pyautogui
+        self._pyautogui = pyautogui
+        self._pool = _BufferPool()
+
+    def grab(self, region: Region = None, gray: bool = False) -> np.ndarray:
+        rgb = np.asarray(self._pyautogui.screenshot(region=region))
+        h, w = rgb.shape[:2]
+        if gray:
+            return cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY, dst=self._pool.get((h, w)))
+        return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=self._pool.get((h, w, 3)))
+
+
+class MssSource(FrameSource):
+    """
+    通过 mss 截图：只截取请求的区域，返回的原始数据本身就是 BGRA，
+    彩色图只需丢弃 alpha 通道（不做 RGB→BGR 转换），灰度图直接从 BGRA 转换。
+    mss 的实例不能跨线程使用，因此每个线程各自创建。
+    """
+
+    def __init__(self):
+        if mss is None:
+            raise ImportError("未安装 mss，请运行 pip install mss")
+        self._local = threading.local()
+        self._pool = _BufferPool()
+
+    def _sct(self):
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            sct = self._local.sct = mss.mss()
+        return sct
+
+    def grab(self, region: Region = None, gray: bool = False) -> np.ndarray:
+        sct = self._sct()
+        # 与 pyautogui 一致，坐标相对于主屏幕
+        monitor = sct.monitors[1]
+        if region is None:
+            box = monitor
+        else:
+            left, top, width, height = region
+            box = {"left": monitor["left"] + left, "top": monitor["top"] + top, "width": width, "height": height}
+        shot = sct.grab(box)
+        bgra = np.frombuffer(shot.raw, np.uint8).reshape(shot.height, shot.width, 4)
+        if gray:
+            return cv2.cvtColor(bgra, cv2.COLOR_BGRA2GRAY, dst=self._pool.get((shot.height, shot.width)))
+        buf = self._pool.get((shot.height, shot.width, 3))
+        np.copyto(buf, bgra[:, :, :3])
+        return buf
+
+    def close(self) -> None:
+        sct = getattr(self._local, "sct", None)
+        if sct is not None:
+            sct.close()
+            self._local.sct = None
+
+
+class VirtualDisplaySource(FrameSource):
+    """
+    内存中的虚拟屏幕，用于测试和无图形界面的环境：截取的是 set_frame() 设置的图像。
+    区域截图直接返回原图的视图，不复制。
+    """
+
+    def __init__(self, frame: Optional[np.ndarray] = None):
+        self._frame = frame
+
+    @property
+    def frame(self) -> np.ndarray:
+        if self._frame is None:
+            raise RuntimeError("虚拟屏幕还没有设置画面")
+        return self._frame
+
+    def set_frame(self, frame: np.ndarray) -> None:
+        self._frame = frame
+
+    def grab(self, region: Region = None, gray: bool = False) -> np.ndarray:
+        image = self.frame
+        if region is not None:
+            left, top, width, height = region
+            image = image[top:top + height, left:left + width]
+        if gray and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+
+def create_frame_source(name: str = FRAME_SOURCE) -> FrameSource:
+    """
+    按名称创建截图来源："auto"（已安装 mss 时用 mss，否则用 pyautogui）、"mss"、"pyautogui"、"virtual"。
+    """
+    if name == "auto":
+        name = "mss" if mss is not None else "pyautogui"
+    if name == "mss":
+        return MssSource()
+    if name == "pyautogui":
+        return PyAutoGuiSource()
+    if name == "virtual":
+        return VirtualDisplaySource()
+    raise ValueError(f"未知的截图来源: {name}")
+
+
+_source: Optional[FrameSource] = None
+
+
+def get_frame_source() -> FrameSource:
+    """
+    获取当前的截图来源，第一次使用时按 static.FRAME_SOURCE 创建。
+    """
+    global _source
+    if _source is None:
+        _source = create_frame_source()
+        logging.info(f"截图来源: {type(_source).__name__}")
+    return _source
+
+
+def set_frame_source(source: Optional[FrameSource]) -> None:
+    """
+    替换截图来源（如回放录制好的帧）；None 表示下次使用时按配置重新创建。
+    """
+    global _source
+    if _source is not None and _source is not source:
+        _source.close()
+    _source = source
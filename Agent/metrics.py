@@ -0,0 +1,283 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+from static import METRICS_JSONL_PATH, METRICS_BUCKETS, METRICS_SAMPLE_SIZE
+from static import METRICS_JSONL_MAX_BYTES, METRICS_JSONL_BACKUPS, METRICS_FLUSH_INTERVAL, METRICS_QUEUE_SIZE
+
+# Ollama 响应中的耗时字段（纳秒）与对应的阶段名
+OLLAMA_DURATIONS = {
+    "total_duration": "ollama_total",
+    "load_duration": "ollama_load",
+    "prompt_eval_duration": "ollama_prompt_eval",
+    "eval_duration": "ollama_eval",
+}
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Optional[Dict[str, Any]]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+class StageStats:
+    """
+    单个阶段的耗时统计：次数、总耗时、总 CPU 时间、最大值、直方图桶，
+    以及最近若干次的原始耗时（用于计算分位数）。
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.cpu = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.samples = deque(maxlen=METRICS_SAMPLE_SIZE)
+
+    def add(self, seconds: float, cpu_seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.cpu += cpu_seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    """
+    轻量的指标收集器：阶段计时（墙钟与线程 CPU 时间）、计数器和仪表值。
+    配置了 JSONL 文件时，每次观测先放入内存队列，由后台线程定期批量写入并按大小轮转，
+    计时的热路径上不做文件 I/O；另外可通过 HTTP 以 Prometheus 文本格式导出。
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = METRICS_JSONL_PATH, max_bytes: int = METRICS_JSONL_MAX_BYTES,
+                 backups: int = METRICS_JSONL_BACKUPS, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        """
+        :param jsonl_path: JSONL 文件路径，None 表示不写
+        :param max_bytes: 文件超过该大小时轮转
+        :param backups: 轮转时保留的旧文件数
+        :param flush_interval: 后台线程写入的间隔（秒）
+        """
+        self.jsonl_path = jsonl_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.stages: Dict[Key, StageStats] = {}
+        self.counters: Dict[Key, float] = {}
+        self.gauges: Dict[Key, float] = {}
+        self._lock = threading.Lock()
+        self._pending: deque = deque(maxlen=METRICS_QUEUE_SIZE)
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._jsonl = None
+        self._server = None
+
+    def _emit(self, event: Dict[str, Any]) -> None:
+        # 调用方持有 self._lock；这里只入队，序列化和写文件在后台线程中进行
+        if not self.jsonl_path:
+            return
+        event["ts"] = time.time()
+        self._pending.append(event)
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.flush)
+
+    def _write_loop(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        把队列中的观测写入 JSONL 文件，超过 max_bytes 时轮转。
+        """
+        with self._write_lock:
+            events = []
+            while self._pending:
+                events.append(self._pending.popleft())
+            if not events or not self.jsonl_path:
+                return
+            try:
+                if self._jsonl is None:
+                    self._jsonl = open(self.jsonl_path, "a", encoding="utf-8")
+                self._jsonl.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+                self._jsonl.flush()
+                if self._jsonl.tell() > self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                logging.warning(f"写入指标文件失败: {e}")
+                self.jsonl_path = None
+
+    def _rotate(self) -> None:
+        # metrics.jsonl -> metrics.jsonl.1 -> ... -> metrics.jsonl.N，最旧的被覆盖
+        self._jsonl.close()
+        self._jsonl = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.jsonl_path}.{i}"):
+                os.replace(f"{self.jsonl_path}.{i}", f"{self.jsonl_path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.jsonl_path, f"{self.jsonl_path}.1")
+        else:
+            os.remove(self.jsonl_path)
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """
+        统计 with 块的墙钟耗时和当前线程的 CPU 时间。
+        """
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, time.thread_time() - cpu_start, **labels)
+
+    def observe(self, stage: str, seconds: float, cpu_seconds: float = 0.0, **labels) -> None:
+        """
+        记录一次阶段耗时。
+        """
+        key = _key(stage, labels)
+        with self._lock:
+            stats = self.stages.get(key)
+            if stats is None:
+                stats = self.stages[key] = StageStats()
+            stats.add(seconds, cpu_seconds)
+            self._emit({"type": "stage", "stage": stage, "seconds": seconds, "cpu_seconds": cpu_seconds, **labels})
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        """
+        计数器加上 value。
+        """
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._emit({"type": "counter", "name": name, "value": value, **labels})
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """
+        设置仪表值（如队列长度、当前轮询间隔）。
+        """
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def record_ollama(self, stats: Dict[str, Any], model: str = "") -> None:
+        """
+        记录 Ollama 响应中的 total/load/prompt_eval/eval 耗时以及 token 计数。
+        """
+        model = model or stats.get("model", "")
+        for field, stage in OLLAMA_DURATIONS.items():
+            if stats.get(field) is not None:
+                self.observe(stage, stats[field] / 1e9, model=model)
+        for field in ("prompt_eval_count", "eval_count"):
+            if stats.get(field) is not None:
+                self.incr(f"ollama_{field}", stats[field], model=model)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        返回各阶段的次数、平均耗时、平均 CPU 时间与最大耗时（秒）。
+        """
+        with self._lock:
+            result = {}
+            for (name, labels), stats in self.stages.items():
+                label = name + "".join(f"[{k}={v}]" for k, v in labels)
+                result[label] = {
+                    "count": stats.count,
+                    "avg": stats.total / stats.count,
+                    "avg_cpu": stats.cpu / stats.count,
+                    "max": stats.max,
+                }
+            return result
+
+    def percentile(self, stage: str, q: float, **labels) -> Optional[float]:
+        """
+        返回阶段最近样本耗时的 q 分位数（0~100，最近邻取值），没有样本时返回 None。
+        """
+        with self._lock:
+            stats = self.stages.get(_key(stage, labels))
+            samples = sorted(stats.samples) if stats else []
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, math.ceil(q / 100 * len(samples)) - 1))
+        return samples[index]
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self.counters.get(_key(name, labels), 0)
+
+    def render_prometheus(self) -> str:
+        """
+        以 Prometheus 文本格式导出所有指标。
+        """
+        def fmt(name: str, labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return name
+            return name + "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for (name, labels), stats in sorted(self.stages.items()):
+                metric = f"agent_{name}_seconds"
+                for bound, count in zip(METRICS_BUCKETS, stats.buckets):
+                    lines.append(f"{fmt(metric + '_bucket', labels, (('le', str(bound)),))} {count}")
+                lines.append(f"{fmt(metric + '_bucket', labels, (('le', '+Inf'),))} {stats.count}")
+                lines.append(f"{fmt(metric + '_sum', labels)} {stats.total}")
+                lines.append(f"{fmt(metric + '_count', labels)} {stats.count}")
+                lines.append(f"{fmt(f'agent_{name}_cpu_seconds_total', labels)} {stats.cpu}")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{fmt(f'agent_{name}_total', labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{fmt(f'agent_{name}', labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1") -> None:
+        """
+        在后台线程中启动 /metrics 接口；端口被占用等无法监听时只记录警告，不影响程序运行。
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logging.warning(f"无法启动指标接口 {host}:{port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"指标接口已启动: http://{host}:{port}/metrics")
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+
+# 全局共享的指标收集器
+metrics = Metrics()
@@ -0,0 +1,274 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# 延迟配置：固定秒数，或 (最小, 最大) 之间均匀随机
+Latency = Union[float, tuple]
+# 回复配置：固定文本，或根据请求体生成文本的函数
+Reply = Union[str, Callable[[dict], str]]
+
+DEFAULT_REPLIES: Dict[str, Reply] = {
+    "*": "<think>\n收到。\n</think>\n\n好的喵~",
+}
+
+
+def _seconds(latency: Latency) -> float:
+    if isinstance(latency, (tuple, list)):
+        return random.uniform(*latency)
+    return float(latency)
+
+
+class MockOllamaServer:
+    """
+    本地的 /api/chat 模拟服务，用于离线回放基准测试。
+
+    按模型名配置固定回复（或回复函数）与模拟延迟：请求先等待 latency（相当于 prompt 处理），
+    流式请求再按 token_interval 逐块返回 NDJSON，非流式请求等待同样的生成时间后一次性返回，
+    最后一个数据块带有与 Ollama 相同的 *_count / *_duration 统计字段。
+    模型名 "*" 为未单独配置的模型的默认值。
+
+    还可以模拟显存只能容纳 max_loaded 个模型的情况：请求的模型没有加载时，先等显存中其他模型的请求结束、
+    卸载最久未用的模型，再等待 load_time 加载，耗时计入 load_duration；没有消息的请求只加载模型。
+
+    faults 按顺序为接下来的请求注入故障，每个请求取走一项：整数为直接返回的 HTTP 状态码，
+    "hang" 表示先等待 hang_time 秒再正常处理（用于触发客户端的读取超时）。
+    """
+
+    def __init__(self, replies: Optional[Dict[str, Reply]] = None, latency: Optional[Dict[str, Latency]] = None,
+                 token_interval: float = 0.0, chunk_size: int = 4, host: str = "127.0.0.1", port: int = 0,
+                 load_time: Optional[Dict[str, Latency]] = None, max_loaded: int = 0,
+                 faults: Optional[List[Union[int, str]]] = None, hang_time: float = 5.0):
+        """
+        :param replies: 模型名 -> 回复文本或回复函数
+        :param latency: 模型名 -> 首个 token 前的模拟延迟（秒）
+        :param token_interval: 流式返回时每个数据块之间的间隔（秒）
+        :param chunk_size: 流式返回时每个数据块的字符数
+        :param host: 监听地址
+        :param port: 监听端口，0 表示随机分配
+        :param load_time: 模型名 -> 加载模型的模拟耗时（秒）
+        :param max_loaded: 同时加载的模型数上限，0 表示不限（不模拟加载）
+        :param faults: 依次注入的故障，HTTP 状态码或 "hang"
+        :param hang_time: "hang" 故障的等待时间（秒）
+        """
+        self.replies = dict(DEFAULT_REPLIES, **(replies or {}))
+        self.latency = {"*": 0.0, **(latency or {})}
+        self.token_interval = token_interval
+        self.chunk_size = chunk_size
+        self.load_time = {"*": 0.0, **(load_time or {})}
+        self.max_loaded = max_loaded
+        self.faults = list(faults or [])
+        self.hang_time = hang_time
+        # 已加载的模型（按最近使用排序）-> 加载完成的时间，以及各模型进行中的请求数
+        self.loaded: "OrderedDict[str, float]" = OrderedDict()
+        self.loads = 0
+        self._running: Dict[str, int] = {}
+        self._gpu = threading.Condition()
+        # 已处理的请求：模型名、是否流式、加载耗时、总耗时、是否被客户端提前断开、HTTP 状态码
+        self.requests: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/chat"
+
+    def _lookup(self, table: Dict[str, Any], model: str) -> Any:
+        return table.get(model, table["*"])
+
+    def _use_model(self, model: str) -> float:
+        """
+        占用模型，必要时先换出其他模型并加载；返回本次请求等待加载的时间（秒）。
+        """
+        if not self.max_loaded:
+            return 0.0
+        start = time.perf_counter()
+        with self._gpu:
+            if model not in self.loaded:
+                while len(self.loaded) >= self.max_loaded:
+                    idle = [m for m in self.loaded if not self._running.get(m)]
+                    if idle:
+                        del self.loaded[idle[0]]
+                    else:
+                        self._gpu.wait()
+                self.loaded[model] = time.perf_counter() + _seconds(self._lookup(self.load_time, model))
+                self.loads += 1
+            self.loaded.move_to_end(model)
+            self._running[model] = self._running.get(model, 0) + 1
+            ready = self.loaded[model]
+        # 同一模型的其他请求也要等加载完成
+        time.sleep(max(0.0, ready - time.perf_counter()))
+        return time.perf_counter() - start
+
+    def _release_model(self, model: str) -> None:
+        if not self.max_loaded:
+            return
+        with self._gpu:
+            self._running[model] -= 1
+            self._gpu.notify_all()
+
+    def _next_fault(self) -> Optional[Union[int, str]]:
+        with self._lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def reply_for(self, payload: dict) -> str:
+        reply = self._lookup(self.replies, payload.get("model", ""))
+        return reply(payload) if callable(reply) else reply
+
+    def _stats(self, payload: dict, content: str, start: float, eval_start: float, load: float = 0.0) -> Dict[str, Any]:
+        # token 数按字符粗略估计，只用于让客户端的统计和校准逻辑有数据可用
+        prompt_chars = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+        now = time.perf_counter()
+        return {
+            "model": payload.get("model", ""),
+            "done": True,
+            "total_duration": int((now - start) * 1e9),
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": max(1, prompt_chars // 2),
+            "prompt_eval_duration": int((eval_start - start - load) * 1e9),
+            "eval_count": max(1, len(content) // 2),
+            "eval_duration": int((now - eval_start) * 1e9),
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/api/chat":
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                model = payload.get("model", "")
+                stream = payload.get("stream", True)
+                start = time.perf_counter()
+
+                fault = server._next_fault()
+                if isinstance(fault, int):
+                    body = json.dumps({"error": f"模拟故障 {fault}"}, ensure_ascii=False).encode("utf-8")
+                    self._send(body, "application/json", fault)
+                    with server._lock:
+                        server.requests.append({"model": model, "stream": stream, "aborted": False, "load": 0.0,
+                                                "seconds": time.perf_counter() - start, "status": fault})
+                    return
+                if fault == "hang":
+                    time.sleep(server.hang_time)
+
+                load = server._use_model(model)
+                aborted = False
+                try:
+                    if not payload.get("messages"):
+                        # 与 Ollama 相同：没有消息的请求只加载模型
+                        body = dict(server._stats(payload, "", start, time.perf_counter(), load),
+                                    done_reason="load", message={"role": "assistant", "content": ""})
+                        self._send(json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+                    else:
+                        time.sleep(_seconds(server._lookup(server.latency, model)))
+                        content = server.reply_for(payload)
+                        eval_start = time.perf_counter()
+                        if stream:
+                            self._stream(payload, content, start, eval_start, load)
+                        else:
+                            # 与流式相同的生成耗时，只是一次性返回
+                            if server.token_interval:
+                                time.sleep(server.token_interval * -(-len(content) // server.chunk_size))
+                            body = dict(server._stats(payload, content, start, eval_start, load),
+                                        message={"role": "assistant", "content": content})
+                            self._send(json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+                except (BrokenPipeError, ConnectionResetError):
+                    aborted = True
+                finally:
+                    server._release_model(model)
+                with server._lock:
+                    server.requests.append({"model": model, "stream": stream, "aborted": aborted, "load": load,
+                                            "seconds": time.perf_counter() - start, "status": 200})
+
+            def _send(self, body: bytes, content_type: str, status: int = 200) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, payload: dict, content: str, start: float, eval_start: float, load: float = 0.0) -> None:
+                """
+                以分块传输编码逐块发送 NDJSON；客户端提前断开（如回答中出现控制指令）时写入会抛出异常。
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def write(obj: dict) -> None:
+                    data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+
+                model = payload.get("model", "")
+                for i in range(0, len(content), server.chunk_size):
+                    write({"model": model, "done": False,
+                           "message": {"role": "assistant", "content": content[i:i + server.chunk_size]}})
+                    if server.token_interval:
+                        time.sleep(server.token_interval)
+                write(dict(server._stats(payload, content, start, eval_start, load),
+                           message={"role": "assistant", "content": ""}))
+                self.wfile.write(b"0\r\n\r\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockOllamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-ollama", daemon=True)
+        self._thread.start()
+        logging.info(f"模拟 Ollama 服务已启动: {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockOllamaServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    # 独立运行时可直接替代本地 Ollama，例如: python mock_ollama.py --port 11434 --latency qwen3:14b=2 --latency qwen2.5vl:7b=0.8
+    parser = argparse.ArgumentParser(description="本地 /api/chat 模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", action="append", default=[], metavar="MODEL=SECONDS", help="模型的模拟延迟，可重复")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="流式返回每个数据块的间隔（秒）")
+    parser.add_argument("--load-time", action="append", default=[], metavar="MODEL=SECONDS", help="模型的模拟加载耗时，可重复")
+    parser.add_argument("--max-loaded", type=int, default=0, help="同时加载的模型数上限，0 表示不模拟加载")
+    args = parser.parse_args()
+
+    def per_model(items):
+        table = {}
+        for item in items:
+            model, _, seconds = item.rpartition("=")
+            table[model or "*"] = float(seconds)
+        return table
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockOllamaServer(latency=per_model(args.latency), token_interval=args.token_interval, host=args.host,
+                              port=args.port, load_time=per_model(args.load_time), max_loaded=args.max_loaded).start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
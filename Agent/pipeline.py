@@ -0,0 +1,393 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from service import OllamaError, get_scheduler, summarize_payload
+from static import PIPELINE_QUEUE_SIZE, CAPTURE_WORKERS, MODEL_NAME_CHAT
+from utils import format_response_to_string, grab_screen
+from task import describe_regions, handle_response, stream_chat_reply
+from session import ChatSession
+from poller import AdaptivePoller
+from metrics import metrics
+
+# 队列元素为 (截图开始时间, 格式化后的新消息)
+Batch = Tuple[float, str]
+
+
+class FairQueue:
+    """
+    按会话分组的有界队列。
+
+    put 在所有会话的批次总数达到上限时阻塞（背压）；get 在有积压的会话之间轮流取，
+    每次取出某个会话积压的全部批次，避免一个很活跃的群占满聊天模型。同一会话内保持入队顺序。
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._pending: "OrderedDict[str, Deque[Batch]]" = OrderedDict()
+        self._sessions: Dict[str, ChatSession] = {}
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def put(self, session: ChatSession, batch: Batch, timeout: Optional[float] = None) -> None:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size < self.maxsize, timeout):
+                raise queue.Full
+            self._sessions[session.name] = session
+            self._pending.setdefault(session.name, deque()).append(batch)
+            self._size += 1
+            self._cond.notify_all()
+
+    def merge(self, session: ChatSession, batch: Batch) -> bool:
+        """
+        不等待地放入批次：会话已有积压时合并进它最后一个批次（保留较早的截图时间），不占用新的名额；
+        否则在队列未满时入队。队列已满时返回 False。
+        """
+        with self._cond:
+            pending = self._pending.get(session.name)
+            if pending:
+                captured_at, text = pending[-1]
+                pending[-1] = (captured_at, text + "\n" + batch[1])
+            elif self._size < self.maxsize:
+                self._sessions[session.name] = session
+                self._pending.setdefault(session.name, deque()).append(batch)
+                self._size += 1
+            else:
+                return False
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> Tuple[ChatSession, List[Batch]]:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+            # 最早有积压的会话排在最前；取出后该会话之后再有批次时排到队尾
+            name, batches = self._pending.popitem(last=False)
+            self._size -= len(batches)
+            self._cond.notify_all()
+            return self._sessions[name], list(batches)
+
+    def take(self, session: ChatSession) -> List[Batch]:
+        """
+        不等待地取出某个会话当前积压的全部批次（可能为空）。
+        """
+        with self._cond:
+            batches = self._pending.pop(session.name, None)
+            if not batches:
+                return []
+            self._size -= len(batches)
+            self._cond.notify_all()
+            return list(batches)
+
+
+class AgentPipeline:
+    """
+    分阶段的 截图 → 视觉识别 → 对话 流水线，可同时监视多个聊天窗口（会话）。
+
+    截图与视觉识别在后台线程中运行：每一轮只截取一次屏幕（定位后只截取各会话所在的范围），各会话的图标定位、变化检测和裁剪
+    在线程池中并行执行（OpenCV 运算会释放 GIL），有变化的会话再合并为批量请求交给视觉模型，
+    起始会话每轮轮换，保证各会话公平地使用视觉模型。
+    识别出的新消息批次放入按会话分组的有界队列（FairQueue），对话阶段在各会话之间轮流取批次，
+    聊天模型同一时间只处理一个会话，因此多个群共享一个进程和一块 GPU。
+
+    显存只能容纳一个模型时，对话阶段会等视觉模型这一轮识别结束再换入聊天模型，并把期间到达的批次合并为一次回复。
+    背压：队列已满时截图线程会阻塞等待，不会无限堆积未处理的批次。
+    顺序保证：同一会话的批次按截图顺序入队，对话阶段每次把该会话已积压的批次按顺序合并为一条用户消息。
+    """
+
+    def __init__(self, sessions: List[ChatSession], queue_size: int = PIPELINE_QUEUE_SIZE,
+                 poller: Optional[AdaptivePoller] = None, capture_workers: int = CAPTURE_WORKERS):
+        """
+        :param sessions: 要监视的会话
+        :param queue_size: 待回复批次队列的最大长度（所有会话合计）
+        :param poller: 决定何时做完整截图的自适应轮询器，默认使用 static 中的 POLL_* 配置
+        :param capture_workers: 并行处理各会话截图的线程数
+        """
+        self.sessions = sessions
+        self.batches = FairQueue(queue_size)
+        self.poller = poller if poller is not None else AdaptivePoller(sessions)
+        self.stop_event = threading.Event()
+        # 截图与发送消息（可能会点击切换窗口）及之后的缓存更新不能交错进行
+        self.screen_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(capture_workers, len(sessions))),
+                                            thread_name_prefix="capture-worker")
+        self._turn = 0
+        self._capture_thread = None
+        # 最近一次整屏截图的 (宽, 高)，只截取部分屏幕时用来把范围限制在屏幕内
+        self._screen_size: Optional[Tuple[int, int]] = None
+
+    def _capture_session(self, session: ChatSession, screen_img: np.ndarray, origin: Tuple[int, int],
+                         partial: bool = False) -> Optional[np.ndarray]:
+        try:
+            return session.capture(screen_img, origin)
+        except ValueError as e:
+            # 找不到图标（窗口被遮挡或最小化）时跳过该会话；只截取了部分屏幕时稍后会用整屏重试
+            (logging.debug if partial else logging.warning)(f"[{session.name}] {e}")
+            return None
+
+    def _capture_bounds(self) -> Optional[Tuple[int, int, int, int]]:
+        """
+        所有会话图标范围的外接矩形 (left, top, right, bottom)；有会话还没定位到图标时返回 None。
+        """
+        bounds = [session.tracker.bounds(self._screen_size) for session in self.sessions]
+        if any(b is None for b in bounds):
+            return None
+        return min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)
+
+    def _capture_sessions(self, sessions: List[ChatSession], screen_img: np.ndarray,
+                          origin: Tuple[int, int], partial: bool = False) -> List[Optional[np.ndarray]]:
+        if len(sessions) == 1:
+            return [self._capture_session(sessions[0], screen_img, origin, partial)]
+        return list(self._executor.map(lambda s: self._capture_session(s, screen_img, origin, partial), sessions))
+
+    def capture_all(self) -> List[Tuple[ChatSession, np.ndarray]]:
+        """
+        截取一次屏幕，并行处理所有会话，返回有变化的 (会话, 新内容)。
+
+        所有会话都已定位时只截取它们图标范围的外接矩形，否则截取整个屏幕；
+        在截取的范围内找不到图标（窗口移动）的会话会立即用整屏截图重新定位。
+        返回的新内容可能是截图缓冲区的切片，下一次截图前（同一线程中）必须用完或复制。
+        """
+        with self.screen_lock:
+            bounds = self._capture_bounds()
+            with metrics.timer("screenshot"):
+                if bounds is None:
+                    origin = (0, 0)
+                    screen_img = grab_screen()
+                    self._screen_size = (screen_img.shape[1], screen_img.shape[0])
+                else:
+                    left, top, right, bottom = bounds
+                    origin = (left, top)
+                    screen_img = grab_screen((left, top, right - left, bottom - top))
+            regions = self._capture_sessions(self.sessions, screen_img, origin, partial=bounds is not None)
+
+            lost = [i for i, session in enumerate(self.sessions) if bounds is not None and session.tracker.region is None]
+            if lost:
+                logging.debug(f"{len(lost)} 个会话的窗口位置已变化，截取整个屏幕重新定位")
+                with metrics.timer("screenshot"):
+                    screen_img = grab_screen()
+                    self._screen_size = (screen_img.shape[1], screen_img.shape[0])
+                retried = self._capture_sessions([self.sessions[i] for i in lost], screen_img, (0, 0))
+                for i, region in zip(lost, retried):
+                    regions[i] = region
+        return [(session, region) for session, region in zip(self.sessions, regions) if region is not None]
+
+    def capture_loop(self) -> None:
+        """
+        截图 + 视觉识别阶段：由 AdaptivePoller 决定何时截图，识别后把新消息批次放入队列。
+        """
+        while not self.stop_event.is_set():
+            try:
+                captured_at = time.perf_counter()
+                changed = self.capture_all()
+            except Exception as e:
+                # 处理其他所有异常
+                logging.error(f"截图时出错: {e}")
+                self.poller.idle()
+                self.poller.wait(self.stop_event)
+                continue
+            if not changed:
+                logging.debug("截图内容未发生显著变化")
+                self.poller.idle()
+                self.poller.wait(self.stop_event)
+                continue
+            self.poller.active()
+
+            # 每轮从不同的会话开始使用视觉模型
+            start = self._turn % len(changed)
+            self._turn += 1
+            self._describe_all(changed[start:] + changed[:start], captured_at)
+            self.poller.wait(self.stop_event)
+
+    def _describe_all(self, changed: List[Tuple[ChatSession, np.ndarray]], captured_at: float) -> None:
+        """
+        识别所有有变化的会话。使用相同识别提示词的会话合并为批量请求（见 describe_regions），
+        单独识别时使用各会话自己的视觉模型 PayloadBuilder。
+        流式识别时每收到一条消息就与时间线对齐，新消息不等待地合并进该会话待回复的批次（FairQueue.merge），
+        对话阶段不必等视觉模型输出完毕；回调在 Ollama 的流中执行，不能阻塞，
+        队列已满时先暂存，等这次识别请求结束（流已关闭、调度名额已释放）后再按顺序阻塞入队。
+        """
+        groups: Dict[str, List[Tuple[ChatSession, np.ndarray]]] = {}
+        for session, region in changed:
+            groups.setdefault(session.read_prompt, []).append((session, region))
+        for prompt, items in groups.items():
+            if self.stop_event.is_set():
+                break
+            received: Dict[int, list] = {}
+            held: Dict[int, List[Batch]] = {}
+
+            def on_message(index: int, message: dict, items=items, received=received, held=held) -> None:
+                received.setdefault(index, []).append(message)
+                batch = self._new_batch(items[index][0], received[index], captured_at, partial=True)
+                # 已有暂存的批次时后来的也要暂存，保持顺序
+                if batch is not None and (index in held or not self.batches.merge(items[index][0], batch)):
+                    held.setdefault(index, []).append(batch)
+
+            try:
+                results = describe_regions([region for _, region in items], prompt,
+                                           [session.vl_builder for session, _ in items], on_message)
+            except Exception as e:
+                logging.error(f"[{', '.join(session.name for session, _ in items)}] 描述屏幕截图时出错: {e}")
+                self._flush_held(items, held)
+                # 中途出错时，已经收到的消息仍按完整结果处理
+                for index, messages in received.items():
+                    self._accept(items[index][0], messages, captured_at)
+                continue
+            self._flush_held(items, held)
+            for (session, _), responce in zip(items, results):
+                self._accept(session, responce, captured_at)
+
+    def _flush_held(self, items: List[Tuple[ChatSession, np.ndarray]], held: Dict[int, List[Batch]]) -> None:
+        """
+        识别请求结束后把流式识别时因队列已满而暂存的批次合并为一个批次，阻塞地放入队列。
+        """
+        for index, batches in held.items():
+            self._put(items[index][0], (batches[0][0], "\n".join(text for _, text in batches)))
+
+    def _accept(self, session: ChatSession, responce: list, captured_at: float) -> None:
+        """
+        把会话的完整识别结果与时间线对齐，去重后的新消息放入队列（队列满时阻塞）。
+        """
+        batch = self._new_batch(session, responce, captured_at)
+        if batch is not None:
+            self._put(session, batch)
+
+    def _new_batch(self, session: ChatSession, responce: list, captured_at: float, partial: bool = False) -> Optional[Batch]:
+        """
+        把会话的识别结果与时间线对齐，保存去重后的新消息并返回它们组成的批次；没有新消息时返回 None。
+
+        :param partial: responce 只是流式识别到目前为止的消息（见 MessageTimeline.add）
+        """
+        if not partial:
+            logging.debug(f"[{session.name}] 描述屏幕截图的响应: {responce}")
+
+        # 与时间线中已知的历史对齐，只保留真正的新消息
+        with metrics.timer("dedup"):
+            result_responce = session.timeline.add(responce, partial)
+            formatted_response = format_response_to_string(result_responce) if result_responce else ""
+        logging.debug(f"[{session.name}] 新响应: {result_responce}")
+        metrics.incr("new_messages", len(result_responce), session=session.name)
+        if not result_responce:
+            return None
+        session.remember(result_responce)
+
+        print(f"[{session.name}] Formatted response: {formatted_response}")
+        return captured_at, formatted_response
+
+    def _put(self, session: ChatSession, batch: Batch) -> None:
+        """
+        将批次放入队列；队列满时阻塞（背压），但仍响应停止信号。
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.batches.put(session, batch, timeout=0.5)
+                metrics.set_gauge("queue_depth", self.batches.qsize())
+                return
+            except queue.Full:
+                logging.debug("待回复队列已满，等待对话阶段消费")
+
+    def _take_batches(self) -> Tuple[ChatSession, float, str]:
+        """
+        取出轮到的会话积压的全部批次并按顺序合并。
+
+        :return: (会话, 最早一个批次的截图时间, 合并后的消息文本)
+        """
+        session, batches = self.batches.get(timeout=0.5)
+        if len(batches) > 1:
+            logging.debug(f"[{session.name}] 合并了 {len(batches)} 个积压批次")
+        return session, batches[0][0], "\n".join(text for _, text in batches)
+
+    def _defer_for_swap(self, session: ChatSession, formatted_response: str) -> str:
+        """
+        视觉模型还在连续识别时先不换入聊天模型：等这一轮识别结束（最多 MODEL_SWAP_MAX_DEFER 秒），
+        再把期间新到的批次合并进来，用一次聊天调用回复，而不是每个批次各换一次模型。
+        """
+        residency = get_scheduler().residency
+        if not residency.would_swap(MODEL_NAME_CHAT):
+            return formatted_response
+        with metrics.timer("swap_defer"):
+            residency.wait_turn(MODEL_NAME_CHAT, stop_event=self.stop_event)
+        more = self.batches.take(session)
+        if more:
+            logging.debug(f"[{session.name}] 等待换模型期间又合并了 {len(more)} 个批次")
+            formatted_response = "\n".join([formatted_response] + [text for _, text in more])
+        return formatted_response
+
+    def chat_loop(self) -> None:
+        """
+        对话阶段：消费新消息批次，调用聊天模型并处理回复。
+        """
+        while not self.stop_event.is_set():
+            try:
+                session, captured_at, formatted_response = self._take_batches()
+            except queue.Empty:
+                continue
+            try:
+                self._reply(session, captured_at, formatted_response)
+            except Exception:
+                # 与截图阶段一样，单次回复出错（发送消息、会话存储、构建请求等）只记录日志，不结束对话线程
+                logging.exception(f"[{session.name}] 处理回复时出错")
+
+    def _reply(self, session: ChatSession, captured_at: float, formatted_response: str) -> None:
+        """
+        一次对话周期：为会话积压的新消息调用聊天模型，发送回复并更新上下文。
+        """
+        formatted_response = self._defer_for_swap(session, formatted_response)
+        metrics.set_gauge("queue_depth", self.batches.qsize())
+        cycle_start = time.perf_counter()
+        builder = session.builder
+
+        session.recall(formatted_response)
+        builder.add_user_message(formatted_response)
+        payload = builder.build()
+        logging.debug(f"[{session.name}] 检查builder结构：{summarize_payload(payload)}")
+        try:
+            thinking, response, stats = stream_chat_reply(payload)
+        except OllamaError as e:
+            # 消息已留在对话历史中，下一批新消息到来时会一并回复
+            logging.error(f"[{session.name}] 聊天模型调用失败: {e}")
+            return
+        builder.record_usage(stats, thinking + response)
+        if stats["aborted_by"]:
+            logging.info(f"[{session.name}] 回复中出现 {stats['aborted_by']}，已提前停止生成")
+        with self.screen_lock:
+            handle_response(response, session.send)
+            session.refresh()
+        # 端到端延迟：从截到新消息到回复（或放弃回复）完成
+        metrics.observe("reply_latency", time.perf_counter() - captured_at)
+        builder.auto_summarize_and_clear()
+        metrics.observe("chat_cycle", time.perf_counter() - cycle_start)
+
+    def start(self) -> None:
+        """
+        启动后台截图线程。
+        """
+        self._capture_thread = threading.Thread(target=self.capture_loop, name="capture", daemon=True)
+        self._capture_thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self._executor.shutdown(wait=False)
+
+    def run(self) -> None:
+        """
+        启动流水线，并在当前线程中运行对话阶段（[quit] 会在此线程中退出程序）。
+        """
+        self.start()
+        try:
+            self.chat_loop()
+        finally:
+            self.stop()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from session import ChatSession
+from static import POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF, POLL_PROBE_SIZE, POLL_PROBE_THRESHOLD, POLL_FORCE_INTERVAL
+from utils import grab_screen
+
+
+def probe_image(region: np.ndarray, size: tuple = POLL_PROBE_SIZE) -> np.ndarray:
+    """
+    把聊天区域缩成极小的灰度探针图。先按步长抽样再缩放，避免对整块区域做插值。
+    """
+    w, h = size
+    step = max(1, min(region.shape[0] // (h * 4), region.shape[1] // (w * 4)))
+    sampled = region[::step, ::step]
+    if sampled.ndim == 3:
+        sampled = cv2.cvtColor(sampled, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(sampled, (w, h), interpolation=cv2.INTER_AREA)
+
+
+class AdaptivePoller:
+    """
+    事件驱动的自适应轮询。
+
+    以较高频率截取各会话聊天区域的小图（只截取上次定位到的区域），缩成极小的探针图与上一次比较，
+    一旦有变化立即返回，触发完整的截图识别；持续没有变化时轮询间隔按 backoff 指数增长到 max_interval。
+    还没有定位到区域的会话无法探测，只能按当前间隔退避后做完整截图；
+    此外每隔 force_interval 秒强制做一次完整截图，以便发现窗口移动等探针看不到的情况。
+    """
+
+    def __init__(self, sessions: List[ChatSession], min_interval: float = POLL_MIN_INTERVAL,
+                 max_interval: float = POLL_MAX_INTERVAL, backoff: float = POLL_BACKOFF,
+                 threshold: float = POLL_PROBE_THRESHOLD, probe_size: tuple = POLL_PROBE_SIZE,
+                 force_interval: Optional[float] = POLL_FORCE_INTERVAL):
+        """
+        :param sessions: 要探测的会话
+        :param min_interval: 最短轮询间隔（秒），有活动时使用
+        :param max_interval: 最长轮询间隔（秒），空闲时退避到该值
+        :param backoff: 每次没有变化时间隔乘以的系数
+        :param threshold: 探针图平均灰度差超过该值视为变化
+        :param probe_size: 探针图的 (宽, 高)
+        :param force_interval: 强制完整截图的间隔（秒），None 表示不强制
+        """
+        self.sessions = sessions
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.threshold = threshold
+        self.probe_size = probe_size
+        self.force_interval = force_interval
+        self.interval = min_interval
+        self._probes: Dict[str, np.ndarray] = {}
+        self._last_full = time.monotonic()
+
+    def active(self) -> None:
+        """
+        完整截图发现了新内容：回到最短间隔，对话很可能还在继续。
+        """
+        self.interval = self.min_interval
+        self._last_full = time.monotonic()
+        metrics.set_gauge("poll_interval", self.interval)
+
+    def idle(self) -> None:
+        """
+        完整截图没有发现新内容：间隔指数退避。
+        """
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+        self._last_full = time.monotonic()
+        metrics.set_gauge("poll_interval", self.interval)
+
+    def probe(self, session: ChatSession) -> Optional[bool]:
+        """
+        探测会话区域是否变化；还没有定位到区域时返回 None。
+        """
+        region = session.tracker.region
+        if region is None:
+            return None
+        left, top, right, bottom = region
+        with metrics.timer("probe"):
+            try:
+                image = probe_image(grab_screen((left, top, right - left, bottom - top), gray=True), self.probe_size)
+            except Exception as e:
+                logging.debug(f"[{session.name}] 探测截图失败: {e}")
+                return None
+            previous = self._probes.get(session.name)
+            self._probes[session.name] = image
+            if previous is None or previous.shape != image.shape:
+                return True
+            return float(cv2.absdiff(previous, image).mean()) > self.threshold
+
+    def wait(self, stop_event: threading.Event) -> str:
+        """
+        阻塞直到需要做完整截图。
+
+        :return: 触发原因："change"（探针发现变化）、"unknown"（有会话尚未定位）、"forced"（定期强制）或 "stopped"
+        """
+        while not stop_event.wait(self.interval):
+            if any(session.tracker.region is None for session in self.sessions):
+                reason = "unknown"
+            # 用列表而不是生成器，保证每个会话的探针基准都被更新
+            elif any([self.probe(session) for session in self.sessions]):
+                reason = "change"
+                self.interval = self.min_interval
+            elif self.force_interval is not None and time.monotonic() - self._last_full >= self.force_interval:
+                reason = "forced"
+            else:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+                metrics.set_gauge("poll_interval", self.interval)
+                continue
+            metrics.incr("poll_triggers", reason=reason)
+            metrics.set_gauge("poll_interval", self.interval)
+            return reason
+        return "stopped"
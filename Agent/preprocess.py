@@ -0,0 +1,94 @@
+import base64
+import cv2
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+from static import IMAGE_PRESETS, IMAGE_PRESET
+
+# 各格式对应的 OpenCV 质量参数
+_QUALITY_FLAGS = {
+    "png": cv2.IMWRITE_PNG_COMPRESSION,
+    "jpeg": cv2.IMWRITE_JPEG_QUALITY,
+    "jpg": cv2.IMWRITE_JPEG_QUALITY,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+
+def preprocess_image(image: np.ndarray, max_side: Optional[int] = None, grayscale: bool = False, normalize: bool = False) -> np.ndarray:
+    """
+    编码前的图像预处理。
+
+    :param image: BGR 图像
+    :param max_side: 最长边的上限（像素），超过时等比缩小，None 表示不缩放
+    :param grayscale: 是否转为灰度
+    :param normalize: 是否做对比度拉伸（把灰度范围拉伸到 0~255）
+    :return: 处理后的图像（未做任何处理时返回原图）
+    """
+    if max_side and max(image.shape[:2]) > max_side:
+        scale = max_side / max(image.shape[:2])
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    if grayscale and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if normalize:
+        image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
+    return image
+
+
+def encode_image(image: np.ndarray, format: str = "png", quality: Optional[int] = None) -> bytes:
+    """
+    将图像编码为指定格式的字节串。
+
+    :param format: 'png'、'jpeg' 或 'webp'
+    :param quality: png 为压缩级别 0~9，jpeg/webp 为质量 0~100，None 表示使用 OpenCV 默认值
+    """
+    params = []
+    if quality is not None:
+        params = [_QUALITY_FLAGS[format], int(quality)]
+    success, encoded_image = cv2.imencode(f'.{format}', image, params)
+    if not success:
+        raise ValueError("图像编码失败，请检查图像格式或数据是否正确。")
+    return encoded_image.tobytes()
+
+
+def get_preset(name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    获取预处理预设，name 为 None 时使用 static.IMAGE_PRESET。
+    """
+    name = name or IMAGE_PRESET
+    if name not in IMAGE_PRESETS:
+        raise ValueError(f"未知的图像预设: {name}")
+    return IMAGE_PRESETS[name]
+
+
+def encode_with_preset(image: np.ndarray, preset: Optional[str] = None) -> bytes:
+    """
+    按预设预处理并编码图像。
+    """
+    options = get_preset(preset)
+    processed = preprocess_image(image, options.get("max_side"), options.get("grayscale", False), options.get("normalize", False))
+    return encode_image(processed, options.get("format", "png"), options.get("quality"))
+
+
+def image_to_base64_preset(image: np.ndarray, preset: Optional[str] = None) -> str:
+    """
+    按预设预处理、编码图像并转为 Base64 字符串。
+    """
+    return base64.b64encode(encode_with_preset(image, preset)).decode('utf-8')
+
+
+def tile_images(images: List[np.ndarray], gap: int = 8, label_height: int = 28) -> np.ndarray:
+    """
+    把多张 BGR 图像从上到下拼成一张图，每张上方加一条标有 #序号 的标签，供视觉模型分别识别。
+    """
+    width = max(image.shape[1] for image in images)
+    height = sum(image.shape[0] + label_height for image in images) + gap * (len(images) - 1)
+    canvas = np.full((height, width, 3), 255, np.uint8)
+    y = 0
+    for index, image in enumerate(images, 1):
+        canvas[y:y + label_height] = (48, 48, 48)
+        cv2.putText(canvas, f"#{index}", (8, y + label_height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        y += label_height
+        canvas[y:y + image.shape[0], :image.shape[1]] = image
+        y += image.shape[0] + gap
+    return canvas
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from metrics import metrics
+from static import MODEL_KEEP_ALIVE, MODEL_EXCLUSIVE, MODEL_SWAP_MAX_DEFER, MODEL_SWAP_SETTLE
+
+# 排队中的请求：(优先级序号, 入队序号, 模型名, 入队时间)
+Waiting = tuple
+
+
+class ModelResidencyManager:
+    """
+    跟踪 Ollama 当前加载的模型，按模型分批安排请求，减少视觉模型与聊天模型互相换出的次数。
+
+    显存只能容纳一个模型时（exclusive），Ollama 每换一次模型都要花几秒重新加载（load_duration）。
+    RequestScheduler 在选下一个开始的请求时调用 choose()：
+    - 当前模型还有请求在进行时，只开始同一模型的请求，不同模型的请求并发执行只会让 Ollama 来回换模型；
+    - 排队的请求中优先选不需要换模型的，同一模型内仍按优先级和先后顺序；
+    - 其他模型的请求最多被推迟 max_defer 秒，超过后不再开始当前模型的新请求，等进行中的请求结束后换入。
+    显存足够同时容纳所有模型时（exclusive=False）只按优先级调度。
+    """
+
+    def __init__(self, keep_alive: Any = MODEL_KEEP_ALIVE, exclusive: bool = MODEL_EXCLUSIVE,
+                 max_defer: float = MODEL_SWAP_MAX_DEFER, settle: float = MODEL_SWAP_SETTLE):
+        """
+        :param keep_alive: 请求没有指定 keep_alive 时使用的值（Ollama 格式，如 "30m"、-1）
+        :param exclusive: 显存是否只能容纳一个模型
+        :param max_defer: 为了少换模型，其他模型的请求最多被推迟的时间（秒）
+        :param settle: wait_turn 中其他模型空闲这么久才认为它这一轮连续的请求已经结束（秒）
+        """
+        self.keep_alive = keep_alive
+        self.exclusive = exclusive
+        self.max_defer = max_defer
+        self.settle = settle
+        # 最近一次完成请求的模型，即 Ollama 当前（最可能）加载的模型
+        self.resident: Optional[str] = None
+        self._inflight: Dict[str, int] = {}
+        self._last_finished: Dict[str, float] = {}
+        self._cond = threading.Condition()
+
+    def apply(self, payload: dict) -> dict:
+        """
+        为没有指定 keep_alive 的请求补上默认值，避免模型空闲几分钟后被 Ollama 卸载。
+        """
+        if "keep_alive" in payload:
+            return payload
+        return dict(payload, keep_alive=self.keep_alive)
+
+    def _current(self) -> Optional[str]:
+        # 正在使用的模型：有请求在进行时为该请求的模型，否则为最近加载的模型
+        for model, count in self._inflight.items():
+            if count:
+                return model
+        return self.resident
+
+    def would_swap(self, model: str) -> bool:
+        """
+        现在开始 model 的请求是否需要换模型。
+        """
+        with self._cond:
+            current = self._current()
+            return self.exclusive and current is not None and current != model
+
+    def choose(self, waiting: List[Waiting]) -> Optional[Waiting]:
+        """
+        从排队的请求中选出下一个可以开始的请求；没有可以开始的请求时返回 None。
+        """
+        if not waiting:
+            return None
+        if not self.exclusive:
+            return min(waiting)
+        with self._cond:
+            busy = any(self._inflight.values())
+            current = self._current()
+        now = time.monotonic()
+        overdue = [entry for entry in waiting if entry[2] != current and now - entry[3] >= self.max_defer]
+        if overdue:
+            # 已经推迟太久：等当前模型的请求结束后换入
+            return None if busy else min(overdue)
+        same = [entry for entry in waiting if entry[2] == current]
+        if same:
+            return min(same)
+        return None if busy else min(waiting)
+
+    def started(self, model: str) -> None:
+        with self._cond:
+            self._inflight[model] = self._inflight.get(model, 0) + 1
+
+    def finished(self, model: str, stats: Optional[Dict[str, Any]] = None) -> None:
+        """
+        记录一个请求结束；stats 为 Ollama 返回的统计（请求失败时为 None），其中 load_duration 表示本次是否加载了模型。
+        """
+        with self._cond:
+            self._inflight[model] -= 1
+            self._last_finished[model] = time.monotonic()
+            if stats is not None:
+                if stats.get("load_duration", 0) > 1e8 or (self.resident is not None and self.resident != model):
+                    metrics.incr("model_swaps", model=model)
+                    logging.debug(f"Ollama 加载了模型 {model}，耗时 {stats.get('load_duration', 0) / 1e9:.2f}s")
+                self.resident = model
+            self._cond.notify_all()
+
+    def wait_turn(self, model: str, timeout: Optional[float] = None, stop_event: Optional[threading.Event] = None) -> bool:
+        """
+        等到其他模型的请求都已结束且空闲了 settle 秒（连续的一轮请求告一段落，可以换入 model）或超时。
+        调用方可以利用这段时间合并要发给 model 的工作。
+
+        :param timeout: 最长等待时间（秒），默认 max_defer
+        :return: 是否等到了（超时或收到停止信号时返回 False）
+        """
+        deadline = time.monotonic() + (self.max_defer if timeout is None else timeout)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if any(count for m, count in self._inflight.items() if m != model):
+                    wait = 0.5
+                else:
+                    idle_since = max((t for m, t in self._last_finished.items() if m != model), default=0.0)
+                    wait = idle_since + self.settle - now
+                    if wait <= 0:
+                        return True
+                remaining = deadline - now
+                if remaining <= 0 or (stop_event is not None and stop_event.is_set()):
+                    return False
+                self._cond.wait(min(remaining, wait))
+
+
+_manager: Optional[ModelResidencyManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_residency_manager() -> ModelResidencyManager:
+    """
+    获取全局共享的模型驻留管理器（首次调用时按 static 中的配置创建）。
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ModelResidencyManager()
+        return _manager
@@ -0,0 +1,71 @@
+import cv2
+import numpy as np
+from typing import Optional
+
+from static import SCROLL_OVERLAP, SCROLL_MIN_STRIP, SCROLL_ROW_TOLERANCE
+
+# 行轮廓的列数：每一行被压缩成这么多个灰度值
+PROFILE_WIDTH = 64
+
+
+def row_profile(region: np.ndarray) -> np.ndarray:
+    """
+    将区域压缩为每行 PROFILE_WIDTH 个灰度值的行轮廓（保持行数不变）。
+    """
+    gray = region if region.ndim == 2 else cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (PROFILE_WIDTH, gray.shape[0]), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def estimate_scroll(prev_profile: np.ndarray, curr_profile: np.ndarray, tolerance: float = SCROLL_ROW_TOLERANCE) -> Optional[int]:
+    """
+    用相位相关估计两帧之间内容向上滚动的像素数 d（即 curr[y] ≈ prev[y + d]）。
+
+    :return: 滚动距离；重叠部分对不上（无法可靠估计）时返回 None
+    """
+    h = prev_profile.shape[0]
+    window = cv2.createHanningWindow((PROFILE_WIDTH, h), cv2.CV_32F)
+    # phaseCorrelate 会就地修改输入，这里传入副本
+    (_, shift_y), _ = cv2.phaseCorrelate(prev_profile.copy(), curr_profile.copy(), window)
+    guess = int(round(-shift_y))
+
+    # 相位相关的结果可能有 1~2 像素误差，在附近取重叠部分差异最小的偏移
+    best_d, best_diff = None, float("inf")
+    for d in range(guess - 2, guess + 3):
+        if d < 0 or d >= h - SCROLL_MIN_STRIP:
+            continue
+        diff = float(np.abs(curr_profile[:h - d] - prev_profile[d:]).mean())
+        if diff < best_diff:
+            best_d, best_diff = d, diff
+    if best_d is None or best_diff > tolerance:
+        return None
+    return best_d
+
+
+def crop_new_content(prev: np.ndarray, curr: np.ndarray, overlap: int = SCROLL_OVERLAP) -> np.ndarray:
+    """
+    只截取相对上一帧新出现的内容（以及上方少量重叠作为上下文）。
+
+    先估计滚动距离，再把当前帧与对齐后的上一帧逐行比较，
+    从第一行不一致的位置开始裁剪；无法可靠对齐时返回整帧。
+
+    :param prev: 上一次接受的区域
+    :param curr: 当前区域
+    :param overlap: 新内容上方额外保留的像素数
+    :return: 当前区域的一个切片
+    """
+    if prev is None or prev.shape != curr.shape:
+        return curr
+
+    prev_profile = row_profile(prev)
+    curr_profile = row_profile(curr)
+    d = estimate_scroll(prev_profile, curr_profile)
+    if d is None:
+        return curr
+
+    h = curr.shape[0]
+    row_diff = np.abs(curr_profile[:h - d] - prev_profile[d:]).max(axis=1)
+    changed = np.flatnonzero(row_diff > SCROLL_ROW_TOLERANCE * 4)
+    new_top = int(changed[0]) if changed.size else h - d
+
+    top = max(0, min(new_top, h - SCROLL_MIN_STRIP) - overlap)
+    return curr[top:]
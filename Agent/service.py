@@ -1,9 +1,18 @@
 import requests
+import itertools
 import logging
 import json
+import random
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from static import OLLAMA_API, MODEL_NAME_VL
-from utils import image_to_base64
+from metrics import metrics
+from residency import ModelResidencyManager, get_residency_manager
+from static import (OLLAMA_API, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT, OLLAMA_POOL_SIZE, LOG_CONTENT_LIMIT,
+                    OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_RETRIES, OLLAMA_RETRY_BACKOFF, OLLAMA_DEADLINES,
+                    OLLAMA_BREAKER_THRESHOLD, OLLAMA_BREAKER_COOLDOWN)
 
 # 配置日志：输出到控制台
 logging.basicConfig(
@@ -13,92 +22,497 @@ logging.basicConfig(
 )
 
 
+class OllamaError(Exception):
+    """Ollama 调用失败的基类"""
+    pass
 
 
-def ollama_query(payload :dict):
+class OllamaConnectionError(OllamaError, ConnectionError):
+    """无法连接到 Ollama 服务"""
+    pass
+
+
+class OllamaTimeoutError(OllamaError, TimeoutError):
+    """请求 Ollama 超时"""
+    pass
+
+
+class OllamaHTTPError(OllamaError):
+    """Ollama 返回了非 200 状态码"""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"请求失败，状态码：{status_code}, 错误信息：{text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class OllamaResponseError(OllamaError):
+    """Ollama 返回的内容无法解析"""
+    pass
+
+
+class OllamaDeadlineError(OllamaTimeoutError):
+    """请求（含排队和重试）超过了时限，不再重试"""
+    pass
+
+
+class OllamaUnavailableError(OllamaConnectionError):
+    """连续失败次数过多，熔断期间不再发送请求"""
+    pass
+
+
+def summarize_payload(payload: Any, limit: int = LOG_CONTENT_LIMIT) -> Any:
     """
-    使用 Ollama API 进行查询
-    :param payload: 请求体，包含模型名称、消息等信息
+    生成适合写入日志的请求体副本：图片只保留大小，过长的文本被截断。
     """
+    if isinstance(payload, dict):
+        result = {}
+        for key, value in payload.items():
+            if key == "images" and isinstance(value, list):
+                result[key] = [f"<image {len(img)} bytes>" for img in value]
+            else:
+                result[key] = summarize_payload(value, limit)
+        return result
+    if isinstance(payload, list):
+        return [summarize_payload(item, limit) for item in payload]
+    if isinstance(payload, str) and len(payload) > limit:
+        return payload[:limit] + f"...<共 {len(payload)} 字符>"
+    return payload
 
-    logging.debug(f"发送给 Ollama 的请求体: {payload}")
 
-    # 发送 POST 请求
-    response = requests.post(OLLAMA_API, json=payload, timeout=180)
+class OllamaClient:
+    """
+    复用连接池的 Ollama /api/chat 客户端，提供同步与异步两种调用方式。
+    所有失败都以 OllamaError 的子类抛出。
+    """
 
-    logging.debug(f"HTTP 状态码: {response.status_code}")
-    
-    if response.status_code == 200:
+    def __init__(self, api_url: str = OLLAMA_API, connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout: float = OLLAMA_READ_TIMEOUT, pool_size: int = OLLAMA_POOL_SIZE):
+        """
+        :param api_url: /api/chat 接口地址
+        :param connect_timeout: 建立连接的超时（秒）
+        :param read_timeout: 等待响应数据的超时（秒）
+        :param pool_size: 保持的长连接数量
+        """
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._async_session = None
+
+    def _post(self, payload: dict, stream: bool, read_timeout: Optional[float] = None) -> requests.Response:
+        logging.debug(f"发送给 Ollama 的请求体: {summarize_payload(payload)}")
+        timeout = self.timeout if read_timeout is None else (self.timeout[0], min(self.timeout[1], read_timeout))
         try:
-            result = response.json()
-            logging.debug(f"完整响应内容: {result}")
-
-            reply = result.get("message", {}).get("content", "")
-            return reply
-        except Exception as e:
-            logging.error(f"解析 JSON 出错: {e}")
-            return "解析 AI 返回内容时出错"
-    else:
-        error_text = response.text
-        logging.error(f"API 请求失败: {error_text}")
-        return f"请求失败，状态码：{response.status_code}, 错误信息：{error_text}"
-    
-def ollama_query_stream(payload :dict):
+            response = self.session.post(self.api_url, json=payload, stream=stream, timeout=timeout)
+        except requests.Timeout as e:
+            raise OllamaTimeoutError(f"请求 Ollama 超时: {e}") from e
+        except requests.ConnectionError as e:
+            raise OllamaConnectionError(f"无法连接到 Ollama: {e}") from e
+
+        logging.debug(f"HTTP 状态码: {response.status_code}")
+        if response.status_code != 200:
+            text = response.text
+            response.close()
+            logging.error(f"API 请求失败: {text}")
+            raise OllamaHTTPError(response.status_code, text)
+        return response
+
+    def chat(self, payload: dict, read_timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        非流式调用，返回 Ollama 的完整响应（包含 message 以及各项耗时统计）。
+        :param read_timeout: 本次请求的读取超时（秒），不超过 OLLAMA_READ_TIMEOUT
+        """
+        model = payload.get("model", "")
+        with metrics.timer("ollama_request", model=model):
+            response = self._post(dict(payload, stream=False), stream=False, read_timeout=read_timeout)
+            try:
+                result = response.json()
+            except ValueError as e:
+                raise OllamaResponseError(f"解析 JSON 出错: {e}") from e
+        logging.debug(f"完整响应内容: {summarize_payload(result)}")
+        metrics.record_ollama(result, model)
+        return result
+
+    def chat_stream(self, payload: dict, read_timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        流式调用，逐个产出 Ollama 返回的数据块。
+        提前关闭生成器会同时关闭连接，Ollama 随之停止生成。
+        :param read_timeout: 等待每个数据块的读取超时（秒），不超过 OLLAMA_READ_TIMEOUT
+        """
+        model = payload.get("model", "")
+        start = time.perf_counter()
+        response = self._post(dict(payload, stream=True), stream=True, read_timeout=read_timeout)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    raise OllamaResponseError(f"解析流式数据出错: {e}") from e
+                if "error" in data:
+                    raise OllamaResponseError(data["error"])
+                if data.get("done"):
+                    metrics.record_ollama(data, model)
+                yield data
+        except requests.Timeout as e:
+            raise OllamaTimeoutError(f"读取流式响应超时: {e}") from e
+        except requests.ConnectionError as e:
+            raise OllamaConnectionError(f"流式响应连接中断: {e}") from e
+        finally:
+            response.close()
+            metrics.observe("ollama_request", time.perf_counter() - start, model=model)
+
+    async def achat(self, payload: dict) -> Dict[str, Any]:
+        """
+        chat() 的异步版本，基于 aiohttp，连接池在同一事件循环内复用。
+        """
+        import aiohttp
+        import asyncio
+
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            )
+
+        logging.debug(f"发送给 Ollama 的请求体: {summarize_payload(payload)}")
+        try:
+            async with self._async_session.post(self.api_url, json=dict(payload, stream=False)) as response:
+                logging.debug(f"HTTP 状态码: {response.status}")
+                if response.status != 200:
+                    text = await response.text()
+                    logging.error(f"API 请求失败: {text}")
+                    raise OllamaHTTPError(response.status, text)
+                try:
+                    result = await response.json(content_type=None)
+                except ValueError as e:
+                    raise OllamaResponseError(f"解析 JSON 出错: {e}") from e
+        except asyncio.TimeoutError as e:
+            raise OllamaTimeoutError(f"请求 Ollama 超时: {e}") from e
+        except aiohttp.ClientConnectionError as e:
+            raise OllamaConnectionError(f"无法连接到 Ollama: {e}") from e
+
+        logging.debug(f"完整响应内容: {summarize_payload(result)}")
+        metrics.record_ollama(result, payload.get("model", ""))
+        return result
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def aclose(self) -> None:
+        if self._async_session is not None:
+            await self._async_session.close()
+
+
+_client: Optional[OllamaClient] = None
+
+
+def get_client() -> OllamaClient:
     """
-    使用 Ollama API 进行流式查询
-    :param payload: 请求体，包含模型名称、消息等信息
+    获取全局共享的客户端（首次调用时创建）。
     """
+    global _client
+    if _client is None:
+        _client = OllamaClient()
+    return _client
 
-    logging.debug(f"发送给 Ollama 的请求体: {payload}")
-    response = requests.post(OLLAMA_API, json=payload, stream=True, timeout=180)
 
-    logging.debug(f"HTTP 状态码: {response.status_code}")
+def set_client(client: OllamaClient) -> None:
+    """
+    替换全局客户端，例如指向另一个 Ollama 地址。
+    """
+    global _client
+    _client = client
 
-    full_reply = ""
-    if response.status_code == 200:
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_line = line.decode('utf-8')
-                    logging.debug(f"收到的流式数据: {json_line}")
-                    data = json.loads(json_line)
-                    content = data.get("message", {}).get("content", "")
-                    if content:
-                        full_reply += content
-                        print(content, end="", flush=True)  # 实时打印
-                except Exception as e:
-                    logging.warning(f"解析流式数据出错: {e}")
-        return full_reply
-    else:
-        logging.error(f"API 请求失败: {response.text}")
-        return f"请求失败，状态码：{response.status_code}"
-    
-def describe_image_with_ollama(payload: dict):
+
+# 优先级从高到低：用户能看到的对话回复、聊天记录识别、后台摘要
+PRIORITIES = ("reply", "transcribe", "summary")
+
+
+class RequestScheduler:
     """
-    使用 qwen2.5vl 模型对图片进行描述（可扩展为 OCR 或其他任务）
-    :param image_path: 图像文件路径
-    :param prompt: 提供给 AI 的指令（默认是“请描述这张图片的内容”）
-    :return: AI 返回的回答内容
+    所有 Ollama 请求的统一入口，避免多个阶段同时把请求压到同一块 GPU 上。
+
+    - 并发上限：同时进行的请求不超过 max_concurrency，其余请求排队，按优先级（PRIORITIES）出队，同级按先来后到；
+    - 时限：每个请求有一个截止时间（默认按优先级取 OLLAMA_DEADLINES），排队、重试等待和读取超时都不会超过它，
+      过期时抛出 OllamaDeadlineError，不再占用 GPU；
+    - 重试：超时、连接失败和 5xx/429 按指数退避加随机抖动重试，等待期间让出并发名额；
+      流式请求只在还没收到任何数据块时重试；
+    - 熔断：连续失败 breaker_threshold 次后熔断 breaker_cooldown 秒，期间请求直接抛出 OllamaUnavailableError，
+      之后放行的请求成功一次即恢复，失败则再次熔断；
+    - 模型驻留：由 ModelResidencyManager 决定排队的请求中下一个开始哪个，尽量连续处理同一模型的请求，减少换模型。
+    请求通过 get_client() 发出，因此 set_client() 替换的客户端同样受调度。
     """
 
+    def __init__(self, max_concurrency: int = OLLAMA_MAX_CONCURRENCY, max_retries: int = OLLAMA_MAX_RETRIES,
+                 backoff: Tuple[float, float] = OLLAMA_RETRY_BACKOFF, deadlines: Optional[Dict[str, float]] = None,
+                 breaker_threshold: int = OLLAMA_BREAKER_THRESHOLD, breaker_cooldown: float = OLLAMA_BREAKER_COOLDOWN,
+                 residency: Optional[ModelResidencyManager] = None):
+        """
+        :param max_concurrency: 同时发往 Ollama 的请求数上限
+        :param max_retries: 单个请求的最多重试次数
+        :param backoff: 重试等待时间的 (初始值, 上限)，单位秒
+        :param deadlines: 优先级 -> 默认时限（秒）
+        :param breaker_threshold: 熔断前允许的连续失败次数
+        :param breaker_cooldown: 熔断持续时间（秒）
+        :param residency: 模型驻留管理器，默认使用全局共享的实例
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.deadlines = dict(OLLAMA_DEADLINES, **(deadlines or {}))
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.residency = residency if residency is not None else get_residency_manager()
 
-    logging.debug(f"-发送给 Ollama 的图像请求-")
+        self._cond = threading.Condition()
+        self._waiting: List[tuple] = []  # (优先级序号, 入队序号, 模型名, 入队时间)
+        self._seq = itertools.count()
+        self._active = 0
+        self._failures = 0
+        self._open_until = 0.0
 
-    #发起请求
-    response = requests.post(OLLAMA_API, json=payload, timeout=180)
+    def _deadline(self, priority: str, deadline: Optional[float]) -> float:
+        if priority not in PRIORITIES:
+            raise ValueError(f"未知的请求优先级: {priority}")
+        return deadline if deadline is not None else time.monotonic() + self.deadlines[priority]
 
-    logging.debug(f"HTTP 状态码: {response.status_code}")
+    def _acquire(self, priority: str, deadline: float, model: str) -> None:
+        """
+        排队等待并发名额，轮到且有空闲名额时返回；熔断中或等到截止时间时抛出异常。
+        """
+        with self._cond:
+            if time.monotonic() < self._open_until:
+                metrics.incr("ollama_rejected", priority=priority)
+                raise OllamaUnavailableError(f"Ollama 连续失败 {self._failures} 次，暂停请求")
+            start = time.monotonic()
+            entry = (PRIORITIES.index(priority), next(self._seq), model, start)
+            self._waiting.append(entry)
+            try:
+                while self._active >= self.max_concurrency or self.residency.choose(self._waiting) != entry:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.incr("ollama_deadline_exceeded", priority=priority)
+                        raise OllamaDeadlineError(f"{priority} 请求排队超过时限")
+                    # 被推迟的请求超过 max_defer 后可以开始，定期醒来重新判断
+                    self._cond.wait(min(remaining, self.residency.max_defer))
+            except BaseException:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(entry)
+            self._active += 1
+            self.residency.started(model)
+            metrics.set_gauge("ollama_active", self._active)
+            metrics.set_gauge("ollama_waiting", len(self._waiting))
+            # 其他排队的请求可能可以一起开始（同一模型且还有空闲名额）
+            self._cond.notify_all()
+        metrics.observe("ollama_queue_wait", time.monotonic() - start, priority=priority)
 
-    if response.status_code == 200:
-        try:
-            result = response.json()
-            logging.debug(f"完整响应内容: {result}")
-            reply = result.get("message", {}).get("content", "")
-            return reply
-        except Exception as e:
-            logging.error(f"解析 JSON 出错: {e}")
-            return "解析 AI 返回内容时出错"
-    else:
-        error_text = response.text
-        logging.error(f"API 请求失败: {error_text}")
-        return f"请求失败，状态码：{response.status_code}, 错误信息：{error_text}"
\ No newline at end of file
+    def _release(self, model: str, stats: Optional[Dict[str, Any]]) -> None:
+        self.residency.finished(model, stats)
+        with self._cond:
+            self._active -= 1
+            metrics.set_gauge("ollama_active", self._active)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _retryable(error: OllamaError) -> bool:
+        if isinstance(error, OllamaDeadlineError):
+            return False
+        if isinstance(error, OllamaHTTPError):
+            return error.status_code >= 500 or error.status_code == 429
+        return isinstance(error, (OllamaTimeoutError, OllamaConnectionError))
+
+    def _record(self, error: Optional[OllamaError]) -> None:
+        """
+        记录一次请求的结果，更新熔断状态。只有说明服务异常的错误（可重试的错误）计入连续失败。
+        """
+        with self._cond:
+            if error is None:
+                self._failures = 0
+                return
+            if not self._retryable(error):
+                return
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                self._open_until = time.monotonic() + self.breaker_cooldown
+                metrics.incr("ollama_breaker_open")
+                logging.error(f"Ollama 连续失败 {self._failures} 次，{self.breaker_cooldown} 秒内不再发送请求")
+
+    def _backoff(self, attempt: int, error: OllamaError, priority: str, deadline: float) -> None:
+        """
+        重试前等待；不可重试、次数用完或等待后会超过截止时间时直接抛出 error。
+        """
+        if not self._retryable(error) or attempt > self.max_retries:
+            raise error
+        base, cap = self.backoff
+        delay = min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        if time.monotonic() + delay >= deadline:
+            # 等待之后已经来不及完成
+            raise error
+        metrics.incr("ollama_retries", priority=priority)
+        logging.warning(f"Ollama 请求失败，{delay:.1f} 秒后重试 ({attempt}/{self.max_retries}): {error}")
+        time.sleep(delay)
+
+    @staticmethod
+    def _expired(error: OllamaError, priority: str, deadline: float) -> OllamaError:
+        """
+        读取超时被截止时间截短时，超时是时限用完造成的，不说明服务异常。
+        """
+        if isinstance(error, OllamaTimeoutError) and not isinstance(error, OllamaDeadlineError) \
+                and time.monotonic() >= deadline:
+            metrics.incr("ollama_deadline_exceeded", priority=priority)
+            expired = OllamaDeadlineError(f"{priority} 请求超过时限: {error}")
+            expired.__cause__ = error
+            return expired
+        return error
+
+    @staticmethod
+    def _read_timeout(deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise OllamaDeadlineError("请求超过时限")
+        return remaining
+
+    def chat(self, payload: dict, priority: str = "transcribe", deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        经调度的非流式调用，参见 OllamaClient.chat。
+        :param priority: PRIORITIES 之一
+        :param deadline: 截止时间（time.monotonic() 的值），None 表示按优先级的默认时限
+        """
+        deadline = self._deadline(priority, deadline)
+        model = payload.get("model", "")
+        payload = self.residency.apply(payload)
+        attempt = 0
+        while True:
+            self._acquire(priority, deadline, model)
+            result = None
+            try:
+                result = get_client().chat(payload, read_timeout=self._read_timeout(deadline))
+            except OllamaError as e:
+                error = self._expired(e, priority, deadline)
+            else:
+                self._record(None)
+                return result
+            finally:
+                self._release(model, result)
+            self._record(error)
+            attempt += 1
+            self._backoff(attempt, error, priority, deadline)
+
+    def chat_stream(self, payload: dict, priority: str = "reply", deadline: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        经调度的流式调用，参见 OllamaClient.chat_stream。并发名额一直占用到生成器结束或被关闭；
+        超过截止时间时关闭连接并抛出 OllamaDeadlineError。
+        """
+        deadline = self._deadline(priority, deadline)
+        model = payload.get("model", "")
+        payload = self.residency.apply(payload)
+        attempt = 0
+        while True:
+            self._acquire(priority, deadline, model)
+            received = False
+            stream = None
+            stats = None
+            try:
+                stream = get_client().chat_stream(payload, read_timeout=self._read_timeout(deadline))
+                for chunk in stream:
+                    received = True
+                    if chunk.get("done"):
+                        stats = chunk
+                    yield chunk
+                    if time.monotonic() > deadline and not chunk.get("done"):
+                        metrics.incr("ollama_deadline_exceeded", priority=priority)
+                        raise OllamaDeadlineError(f"{priority} 请求超过时限，已停止生成")
+            except OllamaError as e:
+                error = self._expired(e, priority, deadline)
+            else:
+                self._record(None)
+                return
+            finally:
+                if stream is not None:
+                    stream.close()
+                self._release(model, stats)
+            self._record(error)
+            if received:
+                # 已经交出去的数据块无法撤回
+                raise error
+            attempt += 1
+            self._backoff(attempt, error, priority, deadline)
+
+    def warm(self, models: List[str]) -> None:
+        """
+        按顺序预先加载模型（Ollama 收到没有消息的请求时只加载模型），让第一次识别和回复不必等待加载。
+        加载失败只记录警告。
+        """
+        for model in models:
+            start = time.perf_counter()
+            try:
+                self.chat({"model": model, "messages": []}, "summary")
+            except OllamaError as e:
+                logging.warning(f"预加载模型 {model} 失败: {e}")
+                continue
+            logging.info(f"已预加载模型 {model}，耗时 {time.perf_counter() - start:.1f}s")
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """
+    获取全局共享的请求调度器（首次调用时创建）。
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler: Optional[RequestScheduler]) -> None:
+    """
+    替换全局调度器（如修改并发上限）；None 表示下次使用时按配置重新创建。
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+def ollama_query(payload :dict, priority: str = "transcribe") -> str:
+    """
+    使用 Ollama API 进行查询
+    :param payload: 请求体，包含模型名称、消息等信息
+    :param priority: 请求优先级，见 PRIORITIES
+    :return: 模型回复的文本
+    """
+    return get_scheduler().chat(payload, priority).get("message", {}).get("content", "")
+    
+def ollama_query_stream(payload :dict) -> str:
+    """
+    使用 Ollama API 进行流式查询，实时打印并返回完整回复
+    :param payload: 请求体，包含模型名称、消息等信息
+    """
+    full_reply = ""
+    for data in get_scheduler().chat_stream(payload, "reply"):
+        content = data.get("message", {}).get("content", "")
+        if content:
+            full_reply += content
+            print(content, end="", flush=True)  # 实时打印
+    return full_reply
+    
+def describe_image_with_ollama(payload: dict) -> str:
+    """
+    使用 qwen2.5vl 模型对图片进行描述（可扩展为 OCR 或其他任务）
+    :param payload: 包含图片的请求体
+    :return: AI 返回的回答内容
+    """
+    logging.debug(f"-发送给 Ollama 的图像请求-")
+    return get_scheduler().chat(payload, "transcribe").get("message", {}).get("content", "")
@@ -0,0 +1,181 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from anchor import AnchorTracker
+from bubble import BubbleTracker
+from context_manager import PayloadBuilder
+from frame_cache import FrameCache
+from metrics import metrics
+from static import BUBBLE_SEGMENTATION, DEBUG_SNAPSHOT, ICON1_PATH, ICON2_PATH, MODEL_NAME_CHAT, PROMPT_CHAT_READ, PROMPT_ROLE_CHAT, SESSIONS
+from static import NOTES_BLOCK_TEMPLATE, RECALL_BLOCK_TEMPLATE, STORE_NOTE_SENDERS, STORE_RETRIEVE_K, STORE_WARM_MESSAGES
+from store import StoredMessage, get_conversation_store
+from task import new_vl_builder
+from timeline import MessageTimeline
+from utils import capture_region, send_message, update_screenshot_cache, ScreenshotNotChangedException
+
+
+class ChatSession:
+    """
+    一个被监视的聊天窗口（群）。
+
+    每个会话有自己的图标锚点、帧缓存、气泡记录、消息时间线，以及聊天模型和视觉模型各自的 PayloadBuilder，
+    互不干扰；视觉模型和聊天模型本身由 AgentPipeline 在所有会话之间轮流共享。
+    启用会话存储时，消息和回复按会话名保存，重启后恢复最近的消息，回复前检索相关的历史消息和发送者笔记。
+    """
+
+    def __init__(self, name: str, icon1_path: str = ICON1_PATH, icon2_path: str = ICON2_PATH,
+                 system_prompt: str = PROMPT_ROLE_CHAT, threshold: float = 0.8,
+                 search_area: Optional[Tuple[int, int, int, int]] = None,
+                 input_point: Optional[Tuple[int, int]] = None,
+                 builder: Optional[PayloadBuilder] = None,
+                 sender: Optional[Callable[[str], None]] = None,
+                 read_prompt: str = PROMPT_CHAT_READ):
+        """
+        :param name: 会话名称，用于日志和指标
+        :param icon1_path: 左上角图标路径
+        :param icon2_path: 右下角图标路径
+        :param system_prompt: 聊天模型的角色提示词
+        :param threshold: 模板匹配的置信度阈值
+        :param search_area: 只在屏幕的 (left, top, right, bottom) 范围内寻找图标，多个窗口使用相同图标时必须设置
+        :param input_point: 发送前点击的输入框坐标 (x, y)，多个窗口时用来切换焦点
+        :param builder: 聊天模型使用的 PayloadBuilder，默认新建
+        :param sender: 发送回复的函数，默认模拟键盘粘贴发送
+        :param read_prompt: 视觉模型识别聊天记录的提示词
+        """
+        self.name = name
+        self.icon1_path = icon1_path
+        self.icon2_path = icon2_path
+        self.input_point = input_point
+        self.sender = sender
+        self.read_prompt = read_prompt
+        self.tracker = AnchorTracker(icon1_path, icon2_path, threshold, search_area=search_area)
+        self.frame_cache = FrameCache(f"capture_{name}.png" if DEBUG_SNAPSHOT else None)
+        self.bubbles = BubbleTracker() if BUBBLE_SEGMENTATION else None
+        self.timeline = MessageTimeline()
+        if builder is None:
+            builder = PayloadBuilder(MODEL_NAME_CHAT, stream=True)
+            builder.system_prompt = system_prompt
+        self.builder = builder
+        self.vl_builder = new_vl_builder(read_prompt)
+        self.store = get_conversation_store()
+        if self.store is not None:
+            builder.store = self.store
+            builder.session = name
+            self._restore()
+
+    def _restore(self) -> None:
+        """
+        从会话存储恢复最近的消息：识别出的消息按回复分隔成批、自己的回复作为 assistant 消息放回聊天模型的对话历史，
+        并记入时间线，屏幕上仍显示的旧消息不会再被当作新消息。
+        """
+        recent = self.store.recent(self.name, STORE_WARM_MESSAGES)
+        if not recent:
+            return
+        pending: List[StoredMessage] = []
+
+        def flush() -> None:
+            if pending:
+                self.builder.add_user_message("\n".join(m.line() for m in pending))
+                self.timeline.add([m.to_dict() for m in pending])
+                pending.clear()
+
+        for message in recent:
+            if message.role == "assistant":
+                # 与运行时（见 send）一致：自己的回复放进对话历史并记入时间线
+                flush()
+                self.builder.add_assistant_message(message.content)
+                self.timeline.add_own(message.content)
+            else:
+                pending.append(message)
+        flush()
+        logging.info(f"[{self.name}] 从会话存储恢复了 {len(recent)} 条消息")
+
+    def remember(self, messages: List[Dict[str, str]]) -> None:
+        """
+        把识别出的新消息保存到会话存储。
+        """
+        if self.store is not None and messages:
+            self.store.add_messages(self.name, messages)
+
+    def recall(self, text: str) -> None:
+        """
+        回复前为新消息 text 准备记忆：相关发送者的笔记，以及存储中与之最相关、但不在当前上下文中的历史消息，
+        写入聊天模型 PayloadBuilder 的 memory。没有启用会话存储时 memory 仍是整段摘要，不做修改。
+        """
+        if self.store is None:
+            return
+        with metrics.timer("recall"):
+            senders = []
+            for line in text.splitlines():
+                sender, sep, _ = line.partition(":")
+                if sep and sender not in senders:
+                    senders.append(sender)
+            notes = self.store.notes(self.name, senders[:STORE_NOTE_SENDERS])
+            exclude = self.builder.history_lines() | set(text.splitlines())
+            found = self.store.search(self.name, text, STORE_RETRIEVE_K, exclude)
+        blocks = []
+        if notes:
+            blocks.append(NOTES_BLOCK_TEMPLATE.format(notes="\n".join(f"{sender}: {note}" for sender, note in notes.items())))
+        if found:
+            history = "\n".join(f"[{time.strftime('%m-%d %H:%M', time.localtime(m.created_at))}] {m.line()}" for m in found)
+            blocks.append(RECALL_BLOCK_TEMPLATE.format(history=history))
+        self.builder.memory = "\n\n".join(blocks)
+
+    def capture(self, screen_img: Optional[np.ndarray] = None, origin: Tuple[int, int] = (0, 0)) -> Optional[np.ndarray]:
+        """
+        在屏幕截图中截取本会话的区域并做变化检测；开启气泡分割时只返回新出现的气泡拼成的图。
+        :param origin: screen_img 左上角的屏幕坐标
+        :return: 需要识别的新内容，没有变化时返回 None
+        :raises ValueError: 找不到图标
+        """
+        try:
+            region = capture_region(self.icon1_path, self.icon2_path, frame_cache=self.frame_cache,
+                                    tracker=self.tracker, screen_img=screen_img, origin=origin,
+                                    incremental=self.bubbles is None)
+        except ScreenshotNotChangedException:
+            return None
+        if self.bubbles is None:
+            return region
+        return self.bubbles.extract(region)
+
+    def send(self, response: str) -> None:
+        """
+        发送回复，并作为 assistant 消息加入聊天模型的对话历史（计入上下文预算），使模型知道自己说过什么；
+        同时记入时间线，之后识别到自己发出的这条消息时不会再当作新消息。
+        """
+        if self.sender is not None:
+            self.sender(response)
+        else:
+            send_message(response, click_at=self.input_point)
+        self.builder.add_assistant_message(response)
+        self.timeline.add_own(response)
+        if self.store is not None:
+            self.store.add_reply(self.name, response)
+
+    def refresh(self) -> None:
+        """
+        发送消息后刷新帧缓存，使自己发出的消息不会被当作屏幕变化。
+        """
+        update_screenshot_cache(self.icon1_path, self.icon2_path, frame_cache=self.frame_cache, tracker=self.tracker)
+
+
+def load_sessions(configs: Optional[List[dict]] = None) -> List[ChatSession]:
+    """
+    按 static.SESSIONS 创建会话；没有配置时只监视 ICON1_PATH/ICON2_PATH 指定的一个窗口。
+    """
+    configs = SESSIONS if configs is None else configs
+    if not configs:
+        return [ChatSession("default")]
+
+    sessions = []
+    for config in configs:
+        config = dict(config)
+        name = config.pop("name")
+        icon1_path = config.pop("icon1", ICON1_PATH)
+        icon2_path = config.pop("icon2", ICON2_PATH)
+        sessions.append(ChatSession(name, icon1_path, icon2_path, **config))
+    logging.info(f"已加载 {len(sessions)} 个会话: {', '.join(s.name for s in sessions)}")
+    return sessions
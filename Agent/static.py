@@ -1,10 +1,140 @@
 OLLAMA_API = "http://localhost:11434/api/chat"
+OLLAMA_CONNECT_TIMEOUT = 5  # 建立连接的超时（秒）
+OLLAMA_READ_TIMEOUT = 180  # 等待模型响应的超时（秒）
+OLLAMA_POOL_SIZE = 4  # 与 Ollama 保持的长连接数量
+OLLAMA_MAX_CONCURRENCY = 2  # 同时发往 Ollama 的请求数上限，超出的请求按优先级排队（对话回复 > 识别 > 摘要）
+OLLAMA_MAX_RETRIES = 3  # 超时、连接失败或 5xx 时的最多重试次数
+OLLAMA_RETRY_BACKOFF = (0.5, 8.0)  # 重试等待时间的初始值和上限（秒），每次翻倍并加随机抖动
+OLLAMA_DEADLINES = {"reply": 180, "transcribe": 120, "summary": 600}  # 各优先级请求从排队到完成的总时限（秒）
+OLLAMA_BREAKER_THRESHOLD = 5  # 连续失败多少次后熔断，熔断期间请求直接失败
+OLLAMA_BREAKER_COOLDOWN = 30  # 熔断持续时间（秒），之后放行请求试探服务是否恢复
+LOG_CONTENT_LIMIT = 500  # 日志中单个文本字段的最大长度，图片只记录大小
 MODEL_NAME_CHAT = "qwen3:14b"
 #MODEL_NAME_CHAT = "qwen3:8b"
 MODEL_NAME_VL = "qwen2.5vl:7b"
 #MODEL_NAME_VL = "gemma3:4b"
+# 模型驻留配置
+MODEL_KEEP_ALIVE = "30m"  # 请求没有指定 keep_alive 时使用，避免模型空闲几分钟就被 Ollama 卸载
+MODEL_EXCLUSIVE = True  # 显存只能容纳一个模型（视觉模型和聊天模型会互相换出）时按模型分批安排请求
+MODEL_SWAP_MAX_DEFER = 3.0  # 为了少换模型，其他模型的请求最多被推迟的时间（秒）
+MODEL_SWAP_SETTLE = 0.5  # 当前模型空闲这么久（秒）才认为这一轮连续的请求已经结束，可以换模型
+MODEL_WARMUP = [MODEL_NAME_VL]  # 启动时按顺序预先加载的模型，显存只能容纳一个模型时只有最后一个会留下
 ICON1_PATH = "assets/icon1.png"
 ICON2_PATH = "assets/icon2.png"
+# 变化检测配置
+CHANGE_SENSITIVITY = 12  # 变化分数阈值（灰度级），越小越敏感
+CHANGE_MAX_SHIFT = 1  # 比较签名时容忍的偏移（签名像素）
+CHANGE_SIGNATURE_SIZE = (32, 128)  # 签名缩略图的 (宽, 高)
+# 增量裁剪配置：只把新滚动进来的内容发给视觉模型
+INCREMENTAL_CROP = True
+SCROLL_OVERLAP = 48  # 新内容上方额外保留的像素，提供上下文
+SCROLL_MIN_STRIP = 80  # 发送给视觉模型的最小高度
+SCROLL_ROW_TOLERANCE = 6  # 对齐后重叠部分允许的平均灰度差
+# 气泡分割配置：在本地把聊天区域切分成消息气泡，只把新出现的气泡（连同头像和名称行）发给视觉模型，
+# 开启后代替增量裁剪；分割不出任何气泡时退回发送整个区域
+BUBBLE_SEGMENTATION = True
+BUBBLE_BG_TOLERANCE = 12  # 与背景色的最大通道差超过该值视为前景
+BUBBLE_TEXT_KERNEL = 7  # 开运算的核大小，需大于文字笔画宽度、小于气泡高度
+BUBBLE_MIN_SIZE = (40, 24)  # 气泡的最小 (宽, 高)
+BUBBLE_AVATAR_SIZE = (20, 80)  # 头像边长范围
+BUBBLE_MERGE_GAP = 24  # 拼图时行间距不超过该值的气泡合并为一段，保持原来的排版
+BUBBLE_CONTEXT = 1  # 新气泡之前附带的已识别气泡数，帮助消息时间线对齐
+BUBBLE_HISTORY = 500  # 每个会话记住的气泡哈希数
+# 发送给视觉模型前的图像预处理预设，可用 bench_preprocess.py 在录制的帧上比较
+IMAGE_PRESETS = {
+    "raw": {"format": "png"},  # 原分辨率 PNG（原有行为）
+    "png_1280": {"format": "png", "max_side": 1280},
+    "jpeg_1280": {"format": "jpeg", "quality": 85, "max_side": 1280},
+    "gray_jpeg_1280": {"format": "jpeg", "quality": 80, "max_side": 1280, "grayscale": True, "normalize": True},
+    "webp_1280": {"format": "webp", "quality": 80, "max_side": 1280},
+}
+IMAGE_PRESET = "raw"
+DEBUG_SNAPSHOT = False  # 是否把每次接受的截图区域写入 capture_result.png 以便调试
+# 视觉识别结果缓存：画面与之前识别过的相同时直接复用结果
+VL_CACHE_ENABLED = True
+VL_CACHE_SIZE = 256  # 最多缓存的识别结果数（LRU）
+VL_CACHE_TTL = 3600  # 缓存有效期（秒），None 表示不过期
+VL_CACHE_HASH_SIZE = 16  # 感知哈希的边长，哈希位数为其平方
+VL_CACHE_MAX_DISTANCE = 3  # 作为候选的最大汉明距离
+VL_CACHE_THUMB_WIDTH = 320  # 确认命中用的缩略图宽度
+VL_CACHE_PIXEL_TOLERANCE = 12  # 缩略图 4×4 块平均灰度差的上限，超过即视为内容不同
+VL_CACHE_PATH = None  # 持久化文件路径（如 "vl_cache.json"），None 表示只保存在内存中
+
+# 批量识别配置：同一轮中有多段新内容（如多个会话）时合并为一次视觉模型请求，分摊每次请求的固定开销
+VL_BATCH_SIZE = 4  # 一次请求最多包含的截图数，1 表示不合并
+VL_BATCH_MODE = "images"  # "images"：一条消息附带多张图片；"tile"：拼成一张标有序号的大图
+
+# 视觉模型输出配置
+VL_STRUCTURED_OUTPUT = True  # 通过 Ollama 的 format 字段传入 JSON Schema，约束输出为消息数组
+VL_STREAM = True  # 流式接收识别结果，每解析出一条完整的消息就去重并交给对话阶段，不等整个回复结束
+VL_MESSAGE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "sender": {"type": "string"},
+            "message": {"type": "string"},
+        },
+        "required": ["sender", "message"],
+    },
+}
+
+# 上下文预算（token），保持 prompt 在模型的快速上下文范围内
+CONTEXT_TOKEN_BUDGET = 3072  # 单次请求的 prompt 上限，超出时只保留最近的消息
+SUMMARIZE_TOKEN_THRESHOLD = 2048  # 估计的 prompt 超过该值时进行摘要
+MESSAGE_TOKEN_OVERHEAD = 4  # 每条消息的聊天模板开销
+IMAGE_TOKEN_ESTIMATE = 512  # 每张图片的粗略 token 估计
+WINDOW_SHRINK = 0.6  # 超出预算时，滑动窗口一次收缩到预算的该比例，减少前缀变化的次数
+PROMPT_LAYOUT = "stable"  # "stable"：静态前缀在前、易变内容在后，便于复用 KV 缓存；"merged"：原有布局
+MEMORY_BLOCK_TEMPLATE = "[记忆摘要]\n{memory}\n\n[新消息]\n{content}"
+
+# 会话存储配置
+STORE_PATH = "conversations.db"  # SQLite 会话存储（消息全文索引与发送者笔记），None 表示不使用，沿用整段记忆摘要
+STORE_RETRIEVE_K = 5  # 每次回复时检索的相关历史消息数
+STORE_MAX_TERMS = 48  # 检索查询最多使用的词（3 字组）数
+STORE_NOTE_LIMIT = 200  # 每个发送者笔记的最大字数
+STORE_NOTE_SENDERS = 8  # 每次回复最多附带几位发送者的笔记
+STORE_WARM_MESSAGES = 30  # 重启时从存储中恢复到上下文和消息时间线的最近消息数
+
+# 指标配置
+METRICS_JSONL_PATH = None  # 记录每次观测的 JSONL 文件（如 "metrics.jsonl"），None 表示不写
+METRICS_JSONL_MAX_BYTES = 10 * 1024 * 1024  # JSONL 文件超过该大小时轮转
+METRICS_JSONL_BACKUPS = 3  # 轮转时保留的旧文件数（metrics.jsonl.1 ~ .N）
+METRICS_FLUSH_INTERVAL = 1.0  # 后台线程写入 JSONL 文件的间隔（秒）
+METRICS_QUEUE_SIZE = 10000  # 等待写入的观测数上限，写入跟不上时丢弃最旧的
+METRICS_PORT = None  # Prometheus 文本格式的 /metrics 接口端口（如 9108），None 表示不启动
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)  # 耗时直方图的桶上限（秒）
+METRICS_SAMPLE_SIZE = 2048  # 每个阶段保留的最近原始耗时样本数，用于计算分位数
+
+# 消息时间线（去重）配置
+TIMELINE_HISTORY = 500  # 保留的历史消息数
+TIMELINE_WINDOW = 64  # 对齐时使用的历史尾部长度
+TIMELINE_SIMILARITY = 0.85  # 归一化后视为同一条消息的最小相似度，容忍识别误差
+UNKNOWN_SENDER = "[未知发送者]"  # 与 PROMPT_CHAT_READ 中约定的一致
+
+CONTROL_TOKENS = ("[reject]", "[quit]")  # 聊天模型回答中的控制指令，出现后立即停止生成
+
+# 流水线配置
+PIPELINE_QUEUE_SIZE = 4  # 待回复批次队列上限（背压）
+STARTUP_DELAY = 5  # 启动后开始截图前的等待时间（秒），留出切换到聊天窗口的时间
+
+# 自适应轮询配置：高频截取聊天区域的极小探针图，有变化时立即完整截图，空闲时指数退避
+POLL_MIN_INTERVAL = 0.1  # 最短轮询间隔（秒）
+POLL_MAX_INTERVAL = 2.0  # 空闲时退避到的最长间隔（秒）
+POLL_BACKOFF = 1.5  # 每次没有变化时间隔乘以的系数
+POLL_PROBE_SIZE = (32, 32)  # 探针图的 (宽, 高)
+POLL_PROBE_THRESHOLD = 1.0  # 探针图平均灰度差超过该值视为变化
+POLL_FORCE_INTERVAL = 30  # 强制完整截图的间隔（秒），用于发现窗口移动等探针看不到的情况；None 表示不强制
+CAPTURE_WORKERS = 4  # 并行处理各会话截图（定位、变化检测、裁剪）的线程数
+FRAME_SOURCE = "auto"  # 截图来源："auto"（已安装 mss 时使用 mss，否则 pyautogui）、"mss"、"pyautogui"、"virtual"（无桌面测试）
+
+# 多会话配置：每项对应一个聊天窗口（群），为空时只监视 ICON1_PATH/ICON2_PATH 指定的一个窗口。
+# 可选字段：icon1、icon2、search_area（只在该屏幕范围内找图标，多个窗口使用相同图标时必须设置）、
+# input_point（发送前点击的输入框坐标）、system_prompt
+SESSIONS = [
+    # {"name": "群1", "search_area": (0, 0, 960, 1080), "input_point": (480, 1000)},
+    # {"name": "群2", "search_area": (960, 0, 1920, 1080), "input_point": (1440, 1000)},
+]
 
 PROMPT_CHAT_HISTORY = """你是一个图像识别助手。请分析用户提供的截图图像，识别其中的聊天记录内容，并以结构化的方式输出这些信息。
 
@@ -42,6 +172,30 @@ PROMPT_ROLE_CHAT= """你叫巧克力，id是晓羽。你是一只心地善良且
 
 SUMMARIZE_PROMPT = """为虚拟猫娘巧克力生成记忆摘要，简单记录不同发送者的状态和聊天内容，保留关键信息，不要直接重复信息。"""
 
+SUMMARIZE_UPDATE_TEMPLATE = """已有记忆：
+{memory}
+
+新的聊天记录：
+{turns}
+
+请把新的聊天记录合并进已有记忆，输出更新后的完整记忆摘要。"""
+
+SUMMARIZE_NOTES_PROMPT = """为虚拟猫娘巧克力维护群成员的笔记：每位发送者一条，简要记录他的身份、状态、喜好、与巧克力的关系和正在聊的事，保留关键信息，不要照抄原话。"""
+
+SUMMARIZE_NOTES_TEMPLATE = """已有笔记：
+{notes}
+
+新的聊天记录：
+{turns}
+
+请根据新的聊天记录更新下列发送者的笔记：{senders}。
+以 JSON 对象输出，键为发送者，值为更新后的完整笔记（每条不超过 {limit} 字），没有新信息的发送者可以省略。"""
+
+NOTES_BLOCK_TEMPLATE = "[发送者笔记]\n{notes}"  # 会话存储模式下放入记忆块的内容
+RECALL_BLOCK_TEMPLATE = "[相关的历史消息]\n{history}"
+
+PROMPT_CHAT_READ_USER = "识别这张截图中的聊天记录。"  # 前缀稳定布局下随图片发送的固定文本
+
 PROMPT_CHAT_READ = """你的任务是识别聊天记录，将消息的发送者和消息内容以标准JSON格式输出。
 消息是从上往下从左往右排列的。
 每个消息遵循以下结构：
@@ -58,4 +212,14 @@ PROMPT_CHAT_READ = """你的任务是识别聊天记录，将消息的发送者
         "message": "具体的消息内容[图片摘要:简单描述图像的内容和情感]"
     },
     ...
-]"""
\ No newline at end of file
+]"""
+
+PROMPT_BATCH_READ_USER = "依次识别这 {count} 张截图中的聊天记录。"  # 批量识别时随图片发送的文本
+
+# 批量识别时追加在识别提示词之后
+PROMPT_BATCH_READ = """这次会依次给出多张聊天截图（拼成一张图时，每张截图上方标有 #序号），它们可能来自不同的聊天窗口，请分别识别，不要混在一起。
+输出一个JSON对象，键为截图的序号（从1开始），值为该截图中的消息列表，消息格式与上面相同；没有消息的截图输出空列表:
+{
+    "1": [{"sender": "...", "message": "..."}, ...],
+    "2": []
+}"""
\ No newline at end of file
@@ -0,0 +1,208 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from metrics import metrics
+from static import STORE_PATH, STORE_MAX_TERMS
+
+# 中日韩字符的连续片段，trigram 分词下按 3 字一组检索
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session, id);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (session, sender, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+CREATE TABLE IF NOT EXISTS notes (
+    session TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    note TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (session, sender)
+);
+"""
+
+
+class StoredMessage:
+    __slots__ = ("id", "sender", "role", "content", "created_at")
+
+    def __init__(self, id: int, sender: str, role: str, content: str, created_at: float):
+        self.id = id
+        self.sender = sender
+        self.role = role
+        self.content = content
+        self.created_at = created_at
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"sender": self.sender, "message": self.content}
+
+    def line(self) -> str:
+        """
+        与放入对话历史时相同的格式：识别出的消息为 "sender:message"（见 format_response_to_string），自己的回复为原文。
+        """
+        return self.content if self.role == "assistant" else f"{self.sender}:{self.content}"
+
+
+def fts_query(text: str, max_terms: int = STORE_MAX_TERMS) -> str:
+    """
+    把任意文本转换为 FTS5 查询：中日韩片段拆成相邻的 3 字组，英文和数字按词，各项之间为 OR，
+    由 BM25 按命中的项数和稀有程度排序。不足 3 个字的片段无法用 trigram 检索，直接忽略。
+    :return: 查询字符串，没有可检索的内容时为空串
+    """
+    terms = []
+    for run in _CJK_RUN.findall(text):
+        terms.extend(run[i:i + 3] for i in range(len(run) - 2))
+    terms.extend(word for word in _WORD.findall(text) if len(word) >= 3)
+    unique = list(dict.fromkeys(term.lower() for term in terms))[:max_terms]
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in unique)
+
+
+class ConversationStore:
+    """
+    SQLite 会话存储：按会话和发送者保存所有识别出的消息和自己的回复，并用 FTS5（trigram 分词、BM25 排序）建立全文索引；
+    另外为每个会话的每个发送者保存一条笔记。
+
+    回复时不再把整段历史压缩成一份摘要放进 prompt，而是只检索与新消息最相关的 k 条历史消息和相关发送者的笔记，
+    prompt 的大小与运行了多久无关；重启后从数据库恢复最近的消息即可继续（见 ChatSession）。
+    连接在线程间共享，所有操作都在锁内执行。
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        """
+        :param path: 数据库文件路径，":memory:" 表示只保存在内存中
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def add_messages(self, session: str, messages: List[Dict[str, str]], role: str = "user") -> None:
+        """
+        追加识别出的消息（sender/message 字典），或 role="assistant" 时自己的回复（sender 为空）。
+        """
+        now = time.time()
+        rows = [(session, str(item.get("sender") or ""), role, str(item["message"]), now)
+                for item in messages if item.get("message")]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO messages (session, sender, role, content, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def add_reply(self, session: str, content: str) -> None:
+        self.add_messages(session, [{"sender": "", "message": content}], role="assistant")
+
+    def search(self, session: str, text: str, k: int, exclude: Optional[Set[str]] = None) -> List[StoredMessage]:
+        """
+        检索会话中与 text 最相关的 k 条历史消息（BM25），按时间先后返回。
+        :param exclude: 已经在上下文中的消息（StoredMessage.line() 的格式），这些消息不会重复检索
+        """
+        query = fts_query(text)
+        if not query or k <= 0:
+            return []
+        skip = exclude or set()
+        with metrics.timer("store_search"), self._lock:
+            try:
+                rows = self._conn.execute(
+                    "SELECT m.id, m.sender, m.role, m.content, m.created_at FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                    "WHERE messages_fts MATCH ? AND m.session = ? ORDER BY bm25(messages_fts) LIMIT ?",
+                    (query, session, k + len(skip))).fetchall()
+            except sqlite3.OperationalError as e:
+                logging.warning(f"全文检索失败: {e}")
+                return []
+        found = [m for m in (StoredMessage(*row) for row in rows) if m.line() not in skip][:k]
+        return sorted(found, key=lambda m: m.id)
+
+    def recent(self, session: str, limit: int) -> List[StoredMessage]:
+        """
+        会话最近的 limit 条消息（含自己的回复），按时间先后返回。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, sender, role, content, created_at FROM messages WHERE session = ? ORDER BY id DESC LIMIT ?",
+                (session, limit)).fetchall()
+        return [StoredMessage(*row) for row in reversed(rows)]
+
+    def notes(self, session: str, senders: List[str]) -> Dict[str, str]:
+        """
+        指定发送者的笔记（没有笔记的发送者不出现在结果中），按 senders 的顺序返回。
+        """
+        if not senders:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT sender, note FROM notes WHERE session = ? AND sender IN ({', '.join('?' * len(senders))})",
+                (session, *senders)).fetchall()
+        found = dict(rows)
+        return {sender: found[sender] for sender in senders if sender in found}
+
+    def set_notes(self, session: str, notes: Dict[str, str]) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO notes (session, sender, note, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (session, sender) DO UPDATE SET note = excluded.note, updated_at = excluded.updated_at",
+                [(session, sender, note, now) for sender, note in notes.items()])
+
+    def count(self, session: Optional[str] = None) -> int:
+        with self._lock:
+            if session is None:
+                return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM messages WHERE session = ?", (session,)).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_store: Optional[ConversationStore] = None
+_store_loaded = False
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> Optional[ConversationStore]:
+    """
+    获取全局共享的会话存储，第一次使用时打开 static.STORE_PATH；STORE_PATH 为 None 或当前 SQLite 不支持 FTS5 时返回 None。
+    """
+    global _store, _store_loaded
+    with _store_lock:
+        if not _store_loaded:
+            _store_loaded = True
+            if STORE_PATH:
+                try:
+                    _store = ConversationStore(STORE_PATH)
+                    logging.info(f"会话存储: {STORE_PATH}，共 {_store.count()} 条消息")
+                except sqlite3.Error as e:
+                    logging.warning(f"无法打开会话存储 {STORE_PATH}，改用整段记忆摘要: {e}")
+        return _store
+
+
+def set_conversation_store(store: Optional[ConversationStore]) -> None:
+    """
+    替换全局会话存储（如测试时使用内存数据库）；None 表示不使用存储。
+    """
+    global _store, _store_loaded
+    with _store_lock:
+        _store = store
+        _store_loaded = True
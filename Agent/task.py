@@ -1,53 +1,311 @@
-from service import ollama_query, ollama_query_stream, describe_image_with_ollama
-from static import MODEL_NAME_CHAT, MODEL_NAME_VL, ICON1_PATH, ICON2_PATH, PROMPT_CHAT_HISTORY,PROMPT_CHAT_READ
-from utils import image_to_base64, parse_response, capture_between_icons, send_message, ScreenshotNotChangedException
+from service import ollama_query, ollama_query_stream, describe_image_with_ollama, get_scheduler, OllamaError
+from static import MODEL_NAME_CHAT, MODEL_NAME_VL, ICON1_PATH, ICON2_PATH, PROMPT_CHAT_HISTORY,PROMPT_CHAT_READ, PROMPT_CHAT_READ_USER, PROMPT_LAYOUT, IMAGE_PRESET, VL_CACHE_ENABLED, VL_BATCH_SIZE, VL_BATCH_MODE, PROMPT_BATCH_READ, PROMPT_BATCH_READ_USER, VL_STRUCTURED_OUTPUT, VL_STREAM, VL_MESSAGE_SCHEMA
+from utils import image_to_base64, parse_response, capture_region, send_message, ScreenshotNotChangedException, ThinkStreamParser, JsonArrayStreamParser, parse_json_from_markdown
+from preprocess import encode_with_preset, tile_images
+from vl_cache import get_transcription_cache
 from context_manager import PayloadBuilder
+from metrics import metrics
 import logging
 import sys
 import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
 
-def describe_screen_capture(prompt = PROMPT_CHAT_READ) -> str:
+# 按提示词缓存的视觉模型 PayloadBuilder，避免每帧重新构建，并保持请求前缀不变
+_vl_builders: Dict[str, PayloadBuilder] = {}
+
+
+def new_vl_builder(prompt: str = PROMPT_CHAT_READ) -> PayloadBuilder:
+    """
+    创建视觉模型使用的 PayloadBuilder。
+    """
+    # 前缀稳定布局下识别指令作为静态的 system 消息，位于每帧变化的图片之前
+    system_prompt = prompt if PROMPT_LAYOUT == "stable" else None
+    builder = PayloadBuilder(MODEL_NAME_VL, stream=VL_STREAM, system_prompt=system_prompt)
+    builder.settings_fix_loop()
+    if VL_STRUCTURED_OUTPUT:
+        # 约束解码：模型只能输出符合 schema 的消息数组，不会再出现代码块包裹或多余的文字
+        builder.settings["format"] = VL_MESSAGE_SCHEMA
+    return builder
+
+
+def _get_vl_builder(prompt: str) -> PayloadBuilder:
+    builder = _vl_builders.get(prompt)
+    if builder is None:
+        builder = _vl_builders[prompt] = new_vl_builder(prompt)
+    return builder
+
+
+def describe_screen_capture(prompt = PROMPT_CHAT_READ) -> list:
     """
     使用 Ollama API 描述图像内容
-    :param image_path: 图像文件路径
-    :return: 图像描述
+    :param prompt: 识别聊天记录的提示词
+    :return: 解析后的消息列表
+    :raises OllamaError: 请求 Ollama 失败（超时会先重试）
+    """
+    # 截图未变化时 ScreenshotNotChangedException 直接抛给调用方
+    region = capture_region(ICON1_PATH, ICON2_PATH)
+    return describe_region(region, _get_vl_builder(prompt), prompt)
+
+
+def _vl_cache_key(region, prompt: str):
+    cache = get_transcription_cache()
+    return cache.key(region, cache.namespace(MODEL_NAME_VL, IMAGE_PRESET, prompt))
+
+
+def _cached_transcription(region, prompt: str) -> Tuple[Optional[tuple], Optional[list]]:
+    """
+    查找区域的识别缓存。
+    :return: (缓存键, 缓存的识别结果)；未启用缓存时键为 None，未命中时结果为 None
     """
-    payload = PayloadBuilder(MODEL_NAME_VL, stream=False)
-    payload.settings_fix_loop()
+    if not VL_CACHE_ENABLED:
+        return None, None
+    key = _vl_cache_key(region, prompt)
+    cached = get_transcription_cache().get(key, region)
+    if cached is not None:
+        logging.debug("视觉识别缓存命中")
+    return key, cached
+
+
+def _store_transcription(key: Optional[tuple], region, messages: list) -> None:
+    # 解析失败的结果可能只是偶发错误，不写入缓存
+    if key is not None and messages:
+        get_transcription_cache().put(key, region, messages)
+
+
+def _vl_request(payload: PayloadBuilder, overrides: Optional[Dict[str, Any]] = None) -> str:
+    """
+    发送视觉模型请求并返回回答文本。
+    :param overrides: 只用于本次请求的字段（如批量识别的 format），不修改 payload 的 settings
+    :raises OllamaError: 请求 Ollama 失败（重试由 RequestScheduler 负责）
+    """
+    request = payload.build()
+    if overrides:
+        request.update(overrides)
+    with metrics.timer("vl_inference"):
+        result = get_scheduler().chat(request, "transcribe")
+    response = result.get("message", {}).get("content", "")
+    # 记录 prompt_eval_count，用于确认静态前缀是否命中了 KV 缓存
+    payload.record_usage(result, response)
+    return response
+
+
+def _vl_request_stream(payload: PayloadBuilder, on_message: Optional[Callable[[dict], None]] = None) -> list:
+    """
+    以流式方式发送视觉模型请求，边接收边解析消息数组，每解析出一条完整的消息就调用 on_message。
+    :return: 解析出的全部消息
+    :raises OllamaError: 请求 Ollama 失败，且还没有识别出任何消息（重试由 RequestScheduler 负责）
+    """
+    parser = JsonArrayStreamParser()
+    stats: Dict[str, Any] = {}
+    start = time.perf_counter()
+    stream = get_scheduler().chat_stream(payload.build(), "transcribe")
     try:
-        screen_capture = capture_between_icons(ICON1_PATH, ICON2_PATH)
-        payload.add_user_message_with_image_b64(prompt, screen_capture)
-        logging.debug(f"-发送给 Ollama 的图像请求describe_screen_capture()-")
-
-        # 添加重试机制
-        max_retries = 3
-        retry_count = 0
-        response = ""
-        while retry_count < max_retries:
-            try:
-                response = describe_image_with_ollama(payload.build())
-                break  # 如果请求成功，跳出循环
-            except TimeoutError as e:
-                retry_count += 1
-                logging.warning(f"Ollama API 请求超时 (尝试 {retry_count}/{max_retries}): {e}")
-                if retry_count >= max_retries:
-                    logging.error(f"Ollama API 请求多次超时: {e}")
-                    response = "请求超时，请稍后重试"
-                time.sleep(2)  # 等待一段时间再重试
-
-        return response
-    except ScreenshotNotChangedException as snce:
-        raise snce
-    except Exception as e:
-        logging.error(f"描述屏幕截图时出错: {e}")
-        return "描述屏幕截图时出错，请检查日志获取更多信息"
+        with metrics.timer("vl_inference"):
+            for chunk in stream:
+                for message in parser.feed(chunk.get("message", {}).get("content", "")):
+                    if len(parser.items) == 1:
+                        metrics.observe("vl_first_message", time.perf_counter() - start)
+                    if on_message is not None:
+                        on_message(message)
+                if chunk.get("done"):
+                    stats = chunk
+    except OllamaError as e:
+        # 已经交出去的消息无法撤回，保留已识别的部分
+        if not parser.items:
+            raise
+        logging.warning(f"Ollama 流式响应中断，保留已识别的 {len(parser.items)} 条消息: {e}")
+    finally:
+        stream.close()
+
+    payload.record_usage(stats, parser.text)
+    if parser.errors:
+        metrics.incr("vl_parse_errors", parser.errors)
+    if not parser.items and not parser.done and parser.text.strip():
+        # 没有按数组格式输出（如 Ollama 版本不支持 format），按完整回复再解析一次
+        logging.warning(f"视觉模型的回复不是消息数组: {parser.text[:200]}")
+        result = parse_json_from_markdown(parser.text)
+        # 只有一条消息时模型可能直接输出对象；数字、字符串等其他 JSON 值以及数组中的非对象元素都丢弃
+        if isinstance(result, dict):
+            result = [result]
+        elif not isinstance(result, list):
+            result = []
+        for message in result:
+            if not isinstance(message, dict):
+                continue
+            parser.items.append(message)
+            if on_message is not None:
+                on_message(message)
+    return parser.items
+
+
+def describe_region(region, payload: PayloadBuilder, prompt: str = PROMPT_CHAT_READ,
+                    on_message: Optional[Callable[[dict], None]] = None) -> list:
+    """
+    用视觉模型识别截图区域中的聊天记录。
+    :param region: BGR 截图区域
+    :param payload: 视觉模型使用的 PayloadBuilder（每个会话各自一个），每次调用前会清空消息
+    :param prompt: 识别聊天记录的提示词
+    :param on_message: 流式识别（VL_STREAM）时每解析出一条消息就调用一次；缓存命中时不调用
+    :return: 解析后的消息列表
+    :raises OllamaError: 请求 Ollama 失败（超时会先重试）
+    """
+    # 相同画面已经识别过时直接返回缓存结果
+    cache_key, cached = _cached_transcription(region, prompt)
+    if cached is not None:
+        return cached
+
+    messages = _transcribe(region, payload, prompt, on_message)
+    _store_transcription(cache_key, region, messages)
+    return messages
+
+
+def _transcribe(region, payload: PayloadBuilder, prompt: str, on_message: Optional[Callable[[dict], None]] = None) -> list:
+    """
+    不经过缓存，用视觉模型识别单个区域。
+    """
+    with metrics.timer("encode"):
+        screen_capture = encode_with_preset(region)
+    payload.reset_messages()
+    if payload.layout == "stable":
+        payload.add_user_message_with_images(PROMPT_CHAT_READ_USER, [screen_capture])
+    else:
+        payload.add_user_message_with_images(prompt, [screen_capture])
+    logging.debug(f"-发送给 Ollama 的图像请求describe_screen_capture()-")
+    if payload.stream:
+        return _vl_request_stream(payload, on_message)
+    return parse_json_from_markdown(_vl_request(payload))
+
+
+def _split_batch(data, count: int) -> Optional[List[list]]:
+    """
+    把批量识别的结果按截图序号拆开；结构不符合约定时返回 None。
+    """
+    if isinstance(data, dict):
+        keys = {str(key).lstrip("#"): value for key, value in data.items()}
+        if not any(str(i) in keys for i in range(1, count + 1)):
+            return None
+        parts = [keys.get(str(i), []) for i in range(1, count + 1)]
+    elif isinstance(data, list) and len(data) == count and all(isinstance(part, list) for part in data):
+        parts = data
+    else:
+        return None
+    return [part if isinstance(part, list) else [] for part in parts]
+
+
+def _describe_batch(regions: list, prompt: str) -> Optional[List[list]]:
+    """
+    把多个区域放在一次请求中识别；返回结果无法按序号对应时返回 None。
+    """
+    batch_prompt = prompt + "\n\n" + PROMPT_BATCH_READ
+    payload = _get_vl_builder(batch_prompt)
+    overrides = {}
+    if VL_STRUCTURED_OUTPUT:
+        # 按截图数量生成对象 schema，每个序号对应一个消息数组；只放进本次请求，共享的 builder 保持单张识别的 schema
+        overrides["format"] = {
+            "type": "object",
+            "properties": {str(i): VL_MESSAGE_SCHEMA for i in range(1, len(regions) + 1)},
+            "required": [str(i) for i in range(1, len(regions) + 1)],
+        }
+    with metrics.timer("encode"):
+        if VL_BATCH_MODE == "tile":
+            images = [encode_with_preset(tile_images(regions))]
+        else:
+            images = [encode_with_preset(region) for region in regions]
+    text = PROMPT_BATCH_READ_USER.format(count=len(regions))
+    payload.reset_messages()
+    payload.add_user_message_with_images(text if payload.layout == "stable" else batch_prompt + "\n" + text, images)
+    logging.debug(f"-发送给 Ollama 的批量图像请求，共 {len(regions)} 张-")
+
+    response = _vl_request(payload, overrides)
+    parts = _split_batch(parse_json_from_markdown(response, dict), len(regions))
+    if parts is None:
+        logging.warning(f"批量识别结果无法对应到各张截图，改为逐张识别: {response[:200]}")
+        metrics.incr("vl_batch_fallback")
+        return None
+    metrics.incr("vl_batches")
+    metrics.observe("vl_batch_size", len(regions))
+    return parts
+
+
+def describe_regions(regions: list, prompt: str = PROMPT_CHAT_READ, payloads: Optional[List[PayloadBuilder]] = None,
+                     on_message: Optional[Callable[[int, dict], None]] = None) -> List[list]:
+    """
+    识别多个截图区域（如同一轮中有新内容的多个会话），按输入顺序返回各自的消息列表。
+
+    缓存命中的区域直接返回；其余区域每 VL_BATCH_SIZE 个合并为一次请求（VL_BATCH_MODE 决定
+    是一条消息附带多张图片还是拼成一张图），按截图序号把结果对应回各个区域。
+    批量结果无法对应时退回逐个识别。
+    :param payloads: 逐个识别时各区域使用的 PayloadBuilder，默认共用按提示词缓存的 builder
+    :param on_message: 逐个流式识别时每解析出一条消息就调用 on_message(区域序号, 消息)；
+                       缓存命中和批量识别的结果只通过返回值给出
+    :raises OllamaError: 请求 Ollama 失败（超时会先重试）
+    """
+    if payloads is None:
+        payloads = [_get_vl_builder(prompt)] * len(regions)
+    results: List[Optional[list]] = [None] * len(regions)
+    keys: List[Optional[tuple]] = [None] * len(regions)
+    pending = []
+    for i, region in enumerate(regions):
+        keys[i], results[i] = _cached_transcription(region, prompt)
+        if results[i] is None:
+            pending.append(i)
+
+    batch_size = max(1, VL_BATCH_SIZE)
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        parts = _describe_batch([regions[i] for i in chunk], prompt) if len(chunk) > 1 else None
+        if parts is None:
+            parts = [_transcribe(regions[i], payloads[i], prompt,
+                                 None if on_message is None else lambda message, i=i: on_message(i, message))
+                     for i in chunk]
+        for i, messages in zip(chunk, parts):
+            results[i] = messages
+            _store_transcription(keys[i], regions[i], messages)
+    return results
     
     
-def handle_response(response: str) -> None:
+def stream_chat_reply(payload: dict) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    以流式方式调用聊天模型，增量解析思考与回答部分。
+    回答中一出现控制指令（[reject]/[quit]）就关闭连接，让 Ollama 停止生成。
+    :param payload: 聊天请求体
+    :return: (thinking, response, stats)，stats 包含首个回答 token 的耗时 time_to_first_answer、
+             触发提前结束的指令 aborted_by，以及 Ollama 最后一个数据块中的统计字段
+    """
+    parser = ThinkStreamParser()
+    stats: Dict[str, Any] = {"time_to_first_answer": None, "aborted_by": None}
+    start = time.perf_counter()
+    stream = get_scheduler().chat_stream(payload, "reply")
+    try:
+        for chunk in stream:
+            new_text = parser.feed(chunk.get("message", {}).get("content", ""))
+            if new_text and stats["time_to_first_answer"] is None:
+                stats["time_to_first_answer"] = time.perf_counter() - start
+            if parser.control_token is not None:
+                stats["aborted_by"] = parser.control_token
+                break
+            if chunk.get("done"):
+                stats.update({key: value for key, value in chunk.items() if key.endswith(("_count", "_duration"))})
+    finally:
+        # 提前退出时关闭生成器即关闭连接
+        stream.close()
+    stats["elapsed"] = time.perf_counter() - start
+    metrics.observe("chat_inference", stats["elapsed"])
+    if stats["time_to_first_answer"] is not None:
+        metrics.observe("chat_first_answer", stats["time_to_first_answer"])
+    if stats["aborted_by"]:
+        metrics.incr("chat_aborted", token=stats["aborted_by"])
+    logging.debug(f"聊天回复统计: {stats}")
+    return parser.thinking, parser.answer, stats
+
+
+def handle_response(response: str, send: Callable[[str], None] = send_message) -> None:
     """
     处理模型的指令
+
+    :param send: 发送回复的函数，默认模拟键盘粘贴发送
     """
     if "[quit]" in response:
         print("对话结束")
@@ -57,6 +315,6 @@ def handle_response(response: str) -> None:
     if "[reject]" in response:
         print("拒绝执行该指令")
         return
-    send_message(response)
+    send(response)
 
     
@@ -19,7 +19,7 @@ def describe_screen_capture() -> str:
         image = "capture_result.png"
         local_test_img = image_to_base64(image)
         print(local_test_img)
-        payload.add_user_message_with_image_b64(PROMPT_TEST_AVAILABLE, local_test_img)
+        payload.add_user_message_with_image_b64(PROMPT_CHAT_HISTORY, local_test_img)
         logging.debug(f"-发送给 Ollama 的图像请求describe_screen_capture()-")
 
         # 添加重试机制
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# Agent 下的模块以顶层模块互相导入（from static import ...），图标等资源路径相对于 Agent 目录
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+
+
+@pytest.fixture(autouse=True)
+def agent_cwd(monkeypatch):
+    monkeypatch.chdir(AGENT_DIR)
+
+
+@pytest.fixture(autouse=True)
+def no_conversation_store():
+    # ChatSession 默认打开 static.STORE_PATH，测试中不读写磁盘上的会话存储
+    from store import set_conversation_store
+    set_conversation_store(None)
+    yield
+    set_conversation_store(None)
+
+
+@pytest.fixture
+def mock_ollama():
+    """
+    启动模拟 Ollama 服务并让全局客户端和调度器指向它：mock_ollama(replies=..., max_loaded=..., exclusive=...)。
+    exclusive 决定调度器是否按模型分批（ModelResidencyManager），返回 (服务, 调度器)。
+    """
+    from mock_ollama import MockOllamaServer
+    from service import OllamaClient, RequestScheduler, ModelResidencyManager, set_client, set_scheduler
+    servers = []
+
+    def start(exclusive: bool = False, **kwargs):
+        server = MockOllamaServer(**kwargs).start()
+        servers.append(server)
+        set_client(OllamaClient(server.url))
+        scheduler = RequestScheduler(residency=ModelResidencyManager(exclusive=exclusive))
+        set_scheduler(scheduler)
+        return server, scheduler
+
+    yield start
+    set_scheduler(None)
+    set_client(None)
+    for server in servers:
+        server.stop()
@@ -0,0 +1,135 @@
+import cv2
+import numpy as np
+import pytest
+
+from anchor import AnchorTracker
+from frame_source import VirtualDisplaySource, set_frame_source
+from pipeline import AgentPipeline
+from session import ChatSession
+from static import ICON1_PATH, ICON2_PATH
+
+SCREEN = (1280, 800)  # (宽, 高)
+
+
+def screen_with_icons(pos1, pos2, size=SCREEN) -> np.ndarray:
+    frame = np.full((size[1], size[0], 3), 236, np.uint8)
+    # 一些纹理，使模板匹配不会在纯色背景上得到虚高的分数
+    cv2.putText(frame, "chat window", (400, 400), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (60, 60, 60), 2)
+    for path, (x, y) in ((ICON1_PATH, pos1), (ICON2_PATH, pos2)):
+        icon = cv2.imread(path, cv2.IMREAD_COLOR)
+        frame[y:y + icon.shape[0], x:x + icon.shape[1]] = icon
+    return frame
+
+
+class RecordingSource(VirtualDisplaySource):
+    """
+    记录每次截取的区域。
+    """
+
+    def __init__(self, frame):
+        super().__init__(frame)
+        self.regions = []
+
+    def grab(self, region=None, gray=False):
+        self.regions.append(region)
+        return super().grab(region, gray)
+
+
+@pytest.fixture
+def tracker():
+    return AnchorTracker(ICON1_PATH, ICON2_PATH)
+
+
+def icon_sizes():
+    icon1 = cv2.imread(ICON1_PATH, cv2.IMREAD_COLOR)
+    icon2 = cv2.imread(ICON2_PATH, cv2.IMREAD_COLOR)
+    return icon1.shape[:2], icon2.shape[:2]
+
+
+def test_locate_full_screen(tracker):
+    (h1, w1), (_, w2) = icon_sizes()
+    tracker.locate(screen_with_icons((100, 80), (900, 600)))
+    assert tracker.region == (100 + w1, 80 + h1, 900 + w2, 600)
+
+
+def test_roi_locate_uses_window_search(tracker, monkeypatch):
+    frame = screen_with_icons((100, 80), (900, 600))
+    expected = tracker.locate(frame)
+    left, top, right, bottom = tracker.bounds(SCREEN)
+    source = VirtualDisplaySource(frame)
+    roi = source.grab((left, top, right - left, bottom - top))
+
+    def no_full_search(*args):
+        raise AssertionError("应在上次位置附近找到图标")
+
+    monkeypatch.setattr(tracker, "_full_search", no_full_search)
+    assert tracker.locate(roi, origin=(left, top)) == expected
+
+    # 窗口移动了几个像素，仍在 search_margin 之内
+    moved = screen_with_icons((106, 84), (906, 604))
+    roi = VirtualDisplaySource(moved).grab((left, top, right - left, bottom - top))
+    region = tracker.locate(roi, origin=(left, top))
+    assert region == (expected[0] + 6, expected[1] + 4, expected[2] + 6, expected[3] + 4)
+
+
+def test_roi_locate_fails_when_window_moved_away(tracker):
+    tracker.locate(screen_with_icons((100, 80), (900, 600)))
+    left, top, right, bottom = tracker.bounds(SCREEN)
+    moved = screen_with_icons((20, 300), (500, 700))
+    roi = VirtualDisplaySource(moved).grab((left, top, right - left, bottom - top))
+    with pytest.raises(ValueError):
+        tracker.locate(roi, origin=(left, top))
+    assert tracker.region is None and tracker.bounds() is None
+    # 整屏重新定位
+    assert tracker.locate(moved) is not None
+
+
+def test_bounds_clamped_to_screen(tracker):
+    (_, _), (h2, w2) = icon_sizes()
+    x2, y2 = SCREEN[0] - w2 - 4, SCREEN[1] - h2 - 4
+    tracker.locate(screen_with_icons((10, 10), (x2, y2)))
+    left, top, right, bottom = tracker.bounds(SCREEN)
+    assert (left, top) == (0, 0)
+    assert (right, bottom) == SCREEN
+    # 不传屏幕大小时不限制
+    assert tracker.bounds()[2] > SCREEN[0]
+
+
+def test_search_area_selects_window(tracker):
+    frame = screen_with_icons((100, 80), (500, 400))
+    (h1, w1), (_, w2) = icon_sizes()
+    icon1 = cv2.imread(ICON1_PATH, cv2.IMREAD_COLOR)
+    icon2 = cv2.imread(ICON2_PATH, cv2.IMREAD_COLOR)
+    frame[100:100 + icon1.shape[0], 700:700 + icon1.shape[1]] = icon1
+    frame[700:700 + icon2.shape[0], 1100:1100 + icon2.shape[1]] = icon2
+    right_window = AnchorTracker(ICON1_PATH, ICON2_PATH, search_area=(640, 0, 1280, 800))
+    assert right_window.locate(frame) == (700 + w1, 100 + h1, 1100 + w2, 700)
+
+
+def test_pipeline_grabs_only_roi_after_first_frame():
+    source = RecordingSource(screen_with_icons((100, 80), (900, 600)))
+    set_frame_source(source)
+    try:
+        session = ChatSession("roi", sender=lambda text: None)
+        pipeline = AgentPipeline([session])
+        pipeline.capture_all()
+        pipeline.capture_all()
+    finally:
+        set_frame_source(None)
+    assert source.regions[0] is None
+    left, top, width, height = source.regions[-1]
+    assert left > 0 and top > 0 and width < SCREEN[0] and height < SCREEN[1]
+
+
+def test_pipeline_roi_stays_on_screen_near_edge():
+    (_, _), (h2, w2) = icon_sizes()
+    source = RecordingSource(screen_with_icons((40, 40), (SCREEN[0] - w2 - 2, SCREEN[1] - h2 - 2)))
+    set_frame_source(source)
+    try:
+        pipeline = AgentPipeline([ChatSession("edge", sender=lambda text: None)])
+        pipeline.capture_all()
+        pipeline.capture_all()
+    finally:
+        set_frame_source(None)
+    left, top, width, height = source.regions[-1]
+    assert left + width <= SCREEN[0] and top + height <= SCREEN[1]
@@ -0,0 +1,21 @@
+import bench_replay
+
+
+def test_synthetic_replay_meets_thresholds():
+    """
+    较短的合成回放，模拟服务只能容纳一个模型且加载有耗时：延迟、帧率或换模型次数明显回退时失败。
+    """
+    frames = bench_replay.synthetic_frames(8)
+    result = bench_replay.run(frames, fps=4, vl_latency=0.1, chat_latency=0.1, token_interval=0.005,
+                              interval=0.05, synthetic=True, drain_timeout=20, load_time=0.5, max_loaded=1)
+    assert result["replies"] > 0
+    # 至少换入过聊天模型，说明加载耗时确实被模拟
+    assert result["loads"] >= 1
+    assert bench_replay.check(result, max_p95=8, min_fps=0.5, max_loads=6) == []
+
+
+def test_check_reports_each_threshold():
+    result = {"p95": 2.0, "fps": 1.0, "loads": 5}
+    assert bench_replay.check(result) == []
+    assert len(bench_replay.check(result, max_p95=1.0, min_fps=2.0, max_loads=4)) == 3
+    assert bench_replay.check(dict(result, p95=None), max_p95=1.0)
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+from bench_replay import synthetic_frames
+from bubble import BubbleTracker, segment_bubbles
+from frame_source import VirtualDisplaySource, set_frame_source
+from metrics import metrics
+from session import ChatSession
+
+WIDTH, HEIGHT, LINE = 800, 540, 90
+
+
+def chat_region(messages, offset=0) -> np.ndarray:
+    """
+    画出聊天区域：messages 为从上到下的 (side, text)，offset 为向上滚动的像素数。
+    """
+    region = np.full((HEIGHT, WIDTH, 3), 236, np.uint8)
+    for i, (side, text) in enumerate(messages):
+        y = 10 + i * LINE - offset
+        avatar_x = 20 if side == "left" else WIDTH - 56
+        bubble_x = avatar_x + 46 if side == "left" else avatar_x - 330
+        color = (90, 160, 210) if side == "left" else (200, 140, 90)
+        cv2.rectangle(region, (avatar_x, y + 8), (avatar_x + 36, y + 44), color, -1)
+        cv2.putText(region, "user", (bubble_x, y + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (120, 120, 120), 1)
+        cv2.rectangle(region, (bubble_x, y + 28), (bubble_x + 320, y + LINE - 6), (255, 255, 255), -1)
+        cv2.putText(region, text, (bubble_x + 12, y + 62), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2)
+    return region
+
+
+def new_count(tracker, region):
+    before = metrics.counter("bubbles_new")
+    result = tracker.extract(region)
+    return metrics.counter("bubbles_new") - before, result
+
+
+def test_segment_sides_and_heads():
+    bubbles = segment_bubbles(chat_region([("left", "hi"), ("right", "hello"), ("left", "how are you")]))
+    assert [b.side for b in bubbles] == ["left", "right", "left"]
+    assert all(b.head is not None and not b.partial for b in bubbles)
+    tops = [b.box[1] for b in bubbles]
+    assert tops == sorted(tops)
+
+
+def test_cut_off_bubble_is_partial():
+    bubbles = segment_bubbles(chat_region([("left", "a"), ("left", "b"), ("right", "c")], offset=50))
+    assert bubbles[0].partial
+    assert not any(b.partial for b in bubbles[1:])
+
+
+def test_tracker_sends_only_new_bubbles():
+    tracker = BubbleTracker(context=1)
+    messages = [("left", "one"), ("right", "two"), ("left", "three")]
+    count, image = new_count(tracker, chat_region(messages))
+    assert count == 3 and image is not None
+
+    # 画面没有变化：没有新气泡
+    count, image = new_count(tracker, chat_region(messages))
+    assert count == 0 and image is None
+
+    # 滚动一条并出现一条新消息：只发送新气泡和它之前的 1 条上下文
+    count, image = new_count(tracker, chat_region(messages[1:] + [("right", "four")]))
+    assert count == 1
+    assert image is not None and image.shape[0] < HEIGHT // 2
+
+
+def test_repeated_content_after_overlap_is_new():
+    tracker = BubbleTracker()
+    messages = [("left", "ok"), ("right", "see you"), ("left", "fine")]
+    tracker.extract(chat_region(messages))
+    count, _ = new_count(tracker, chat_region(messages[1:] + [("left", "ok")]))
+    assert count == 1
+
+
+def test_scrolling_back_to_seen_bubbles_is_not_new():
+    tracker = BubbleTracker()
+    old = [("left", "a1"), ("right", "a2"), ("left", "a3")]
+    new = [("left", "b1"), ("right", "b2"), ("left", "b3")]
+    tracker.extract(chat_region(old))
+    tracker.extract(chat_region(new))
+    count, image = new_count(tracker, chat_region(old))
+    assert count == 0 and image is None
+
+
+def test_plain_region_falls_back_to_whole_region():
+    region = np.full((200, 400, 3), 236, np.uint8)
+    assert BubbleTracker().extract(region) is region
+
+
+def test_session_capture_uses_bubbles_on_virtual_display():
+    frames = synthetic_frames(3)
+    source = VirtualDisplaySource(frames[0])
+    set_frame_source(source)
+    try:
+        session = ChatSession("bubbles", sender=lambda text: None)
+        assert session.bubbles is not None
+        screen = source.grab()
+        first = session.capture(screen)
+        assert first is not None
+        # 同一画面再次截图：没有变化
+        assert session.capture(source.grab()) is None
+        source.set_frame(frames[1])
+        second = session.capture(source.grab())
+        # 只包含新气泡和 1 条上下文，比整个聊天区域小得多
+        left, top, right, bottom = session.tracker.region
+        assert second is not None and second.shape[0] < (bottom - top) // 2
+    finally:
+        set_frame_source(None)
@@ -0,0 +1,48 @@
+import base64
+
+from context_manager import Message, PayloadBuilder
+
+IMAGE = b"\x89PNG fake image bytes"
+
+
+def test_images_are_base64_encoded_only_on_serialisation():
+    message = Message("user", "看这张图", [IMAGE])
+    assert message._images == [IMAGE]
+    assert message.to_dict()["images"] == [base64.b64encode(IMAGE).decode("ascii")]
+    # 已经是 Base64 的图片原样使用
+    assert Message("user", "", ["YWJj"]).images == ["YWJj"]
+
+
+def test_to_dict_is_cached():
+    message = Message("user", "你好", [IMAGE])
+    assert message.to_dict() is message.to_dict()
+    assert message.images is message.to_dict()["images"]
+
+
+def test_stable_layout_does_not_mutate_cached_dict():
+    builder = PayloadBuilder("chat", system_prompt="你是猫娘", layout="stable")
+    builder.add_user_message("张三:在吗")
+    builder.memory = "张三喜欢爬山"
+    last = builder.build()["messages"][-1]
+    assert "张三喜欢爬山" in last["content"] and last["content"].endswith("张三:在吗")
+    assert builder.message_manager.messages[0].to_dict()["content"] == "张三:在吗"
+    # 历史消息的字典在多次 build() 之间复用
+    builder.add_user_message("李四:在")
+    first = builder.build()["messages"][1]
+    assert first is builder.build()["messages"][1]
+
+
+def test_record_usage_with_empty_payload():
+    builder = PayloadBuilder("chat", layout="stable")
+    # 空的请求没有 token 估计，不能用来校准，也不能除以零
+    builder.record_usage({"prompt_eval_count": 12, "eval_count": 0})
+    assert builder.token_ratio == 1.0
+    assert builder.last_prompt_tokens == 12
+
+
+def test_record_usage_calibrates_ratio():
+    builder = PayloadBuilder("chat", layout="stable")
+    builder.add_user_message("张三:在吗")
+    builder.build()
+    builder.record_usage({"prompt_eval_count": int(builder.last_built_tokens * 2) + 1})
+    assert builder.token_ratio > 1.9
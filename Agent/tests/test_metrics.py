@@ -0,0 +1,30 @@
+import socket
+import urllib.request
+
+from metrics import Metrics
+
+
+def test_http_server_serves_prometheus_text():
+    m = Metrics(jsonl_path=None)
+    m.observe("vl_inference", 0.2)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    m.start_http_server(port)
+    try:
+        body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode("utf-8")
+        assert "agent_vl_inference_seconds_count 1" in body
+    finally:
+        m._server.shutdown()
+        m._server.server_close()
+
+
+def test_http_server_port_in_use_only_warns(caplog):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        s.listen()
+        m = Metrics(jsonl_path=None)
+        # 可选的诊断接口无法监听时不能让程序启动失败
+        m.start_http_server(s.getsockname()[1])
+    assert m._server is None
+    assert "无法启动指标接口" in caplog.text
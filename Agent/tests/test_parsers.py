@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+import task
+from static import MODEL_NAME_VL
+from utils import JsonArrayStreamParser, ThinkStreamParser, parse_json_from_markdown
+
+MESSAGES = [{"sender": "张三", "message": "在吗"}, {"sender": "李四", "message": '在的，说 "好" [1]'}]
+
+
+def feed_chunks(parser, text: str, size: int) -> list:
+    out = []
+    for i in range(0, len(text), size):
+        out.append(parser.feed(text[i:i + size]))
+    return out
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_think_parser_splits_thinking_and_answer(size):
+    parser = ThinkStreamParser()
+    answer = "".join(feed_chunks(parser, "<think>\n要不要拒绝呢 [reject]\n</think>\n\n好的喵~", size))
+    assert parser.thinking == "要不要拒绝呢 [reject]"
+    assert answer == parser.answer == "好的喵~"
+    # 思考部分中的控制指令不计入
+    assert parser.control_token is None
+
+
+def test_think_parser_without_thinking_and_control_token_split_across_chunks():
+    parser = ThinkStreamParser()
+    assert parser.feed("  不想聊了 [re") == "不想聊了 [re"
+    assert parser.control_token is None
+    parser.feed("ject]")
+    assert parser.control_token == "[reject]"
+    assert parser.thinking == ""
+
+
+def test_think_parser_waits_for_partial_tag():
+    parser = ThinkStreamParser()
+    assert parser.feed("<thi") == ""
+    assert parser.feed("nk>\n嗯") == ""
+    assert parser.thinking == "嗯"
+
+
+@pytest.mark.parametrize("size", [1, 5, 1000])
+def test_json_array_parser_yields_complete_items(size):
+    text = "```json\n" + json.dumps(MESSAGES, ensure_ascii=False) + "\n```"
+    parser = JsonArrayStreamParser()
+    items = [item for batch in feed_chunks(parser, text, size) for item in batch]
+    assert items == parser.items == MESSAGES
+    assert parser.done and parser.errors == 0
+
+
+def test_json_array_parser_keeps_items_before_truncation():
+    text = json.dumps(MESSAGES, ensure_ascii=False)
+    parser = JsonArrayStreamParser()
+    parser.feed(text[:-15])
+    assert parser.items == MESSAGES[:1]
+    assert not parser.done
+
+
+def test_json_array_parser_skips_broken_and_non_object_items():
+    parser = JsonArrayStreamParser()
+    parser.feed('[{"sender": "a", "message": "1"}, {"sender": oops}, [1, 2], {"sender": "b", "message": "2"}]')
+    assert [item["sender"] for item in parser.items] == ["a", "b"]
+    assert parser.errors == 1
+
+
+def test_parse_json_from_markdown_salvages_truncated_array():
+    text = "```json\n" + json.dumps(MESSAGES, ensure_ascii=False)[:-15]
+    assert parse_json_from_markdown(text) == MESSAGES[:1]
+    assert parse_json_from_markdown("not json", dict) == {}
+    assert parse_json_from_markdown("") == []
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ('{"sender": "张三", "message": "在吗"}', [{"sender": "张三", "message": "在吗"}]),
+    ('"只是一句话"', []),
+    ('42', []),
+])
+def test_stream_fallback_normalises_non_array_replies(mock_ollama, reply, expected):
+    mock_ollama(replies={MODEL_NAME_VL: reply})
+    seen = []
+    payload = task.new_vl_builder()
+    payload.add_user_message_with_images("识别", [])
+    assert task._vl_request_stream(payload, seen.append) == expected
+    assert seen == expected
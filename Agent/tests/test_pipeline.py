@@ -0,0 +1,132 @@
+import json
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import task
+from pipeline import AgentPipeline, FairQueue
+from session import ChatSession
+from static import MODEL_NAME_VL
+
+MESSAGES = [{"sender": "张三", "message": f"第{i}条消息"} for i in range(8)]
+
+
+def session(name: str):
+    # FairQueue 只用到会话名
+    return SimpleNamespace(name=name)
+
+
+def test_round_robin_across_sessions():
+    q = FairQueue(10)
+    a, b, c = session("a"), session("b"), session("c")
+    q.put(a, (1.0, "a1"))
+    q.put(b, (2.0, "b1"))
+    q.put(a, (3.0, "a2"))
+    q.put(c, (4.0, "c1"))
+
+    got, batches = q.get(timeout=0)
+    assert got is a and batches == [(1.0, "a1"), (3.0, "a2")]
+    q.put(a, (5.0, "a3"))
+    # a 取出后再有批次时排到队尾，不会抢在 b、c 之前
+    assert [q.get(timeout=0)[0].name for _ in range(3)] == ["b", "c", "a"]
+    assert q.empty()
+
+
+def test_get_coalesces_session_backlog_in_order():
+    q = FairQueue(10)
+    a = session("a")
+    for i in range(4):
+        q.put(a, (float(i), f"m{i}"))
+    assert q.qsize() == 4
+    got, batches = q.get(timeout=0)
+    assert [text for _, text in batches] == ["m0", "m1", "m2", "m3"]
+    assert q.qsize() == 0
+
+
+def test_put_times_out_when_full_and_get_times_out_when_empty():
+    q = FairQueue(2)
+    a = session("a")
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.05)
+    q.put(a, (0.0, "1"))
+    q.put(session("b"), (0.0, "2"))
+    start = time.perf_counter()
+    with pytest.raises(queue.Full):
+        q.put(a, (0.0, "3"), timeout=0.1)
+    assert time.perf_counter() - start >= 0.1
+    assert q.qsize() == 2
+
+
+def test_blocked_put_resumes_after_consumer_drains():
+    q = FairQueue(1)
+    a = session("a")
+    q.put(a, (0.0, "1"))
+    done = threading.Event()
+
+    def producer():
+        q.put(a, (1.0, "2"))
+        done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    # 队列满时截图线程阻塞，直到对话线程取走批次
+    assert not done.wait(0.1)
+    assert q.get(timeout=1)[1] == [(0.0, "1")]
+    assert done.wait(1)
+    assert q.get(timeout=1)[1] == [(1.0, "2")]
+    thread.join()
+
+
+def test_take_removes_only_that_session():
+    q = FairQueue(10)
+    a, b = session("a"), session("b")
+    q.put(a, (0.0, "a1"))
+    q.put(b, (0.0, "b1"))
+    assert q.take(a) == [(0.0, "a1")]
+    assert q.take(a) == []
+    assert q.qsize() == 1 and q.get(timeout=0)[0] is b
+
+
+def test_merge_joins_pending_batch_without_blocking():
+    q = FairQueue(1)
+    a, b = session("a"), session("b")
+    assert q.merge(a, (1.0, "a1"))
+    # 已有积压时合并进最后一个批次，不占新名额，保留较早的截图时间
+    assert q.merge(a, (2.0, "a2"))
+    assert q.qsize() == 1
+    # 队列已满且没有积压的会话立即返回 False
+    assert not q.merge(b, (3.0, "b1"))
+    assert q.get(timeout=0) == (a, [(1.0, "a1\na2")])
+
+
+def test_streamed_messages_never_block_the_vl_stream(mock_ollama, monkeypatch):
+    monkeypatch.setattr(task, "VL_CACHE_ENABLED", False)
+    server, _ = mock_ollama(replies={MODEL_NAME_VL: json.dumps(MESSAGES, ensure_ascii=False)}, token_interval=0.005)
+    busy, target = ChatSession("其他群", sender=lambda text: None), ChatSession("群1", sender=lambda text: None)
+    pipeline = AgentPipeline([busy, target], queue_size=1)
+    # 队列已被其他会话占满，对话阶段还没有消费
+    pipeline.batches.put(busy, (0.0, "李四:在吗"))
+
+    thread = threading.Thread(target=pipeline._describe_all,
+                              args=([(target, np.full((200, 300, 3), 236, np.uint8))], time.perf_counter()))
+    thread.start()
+    try:
+        deadline = time.perf_counter() + 10
+        while not server.requests and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        # 流式回调没有阻塞：视觉模型的请求已经完整结束，新消息暂存在识别线程中
+        assert server.requests and not server.requests[0]["aborted"]
+        assert pipeline.batches.qsize() == 1 and thread.is_alive()
+
+        assert pipeline.batches.get(timeout=1)[0] is busy
+        got, batches = pipeline.batches.get(timeout=5)
+        # 暂存的消息按顺序合并为一个批次
+        assert got is target and len(batches) == 1
+        assert batches[0][1].splitlines() == [f"张三:{m['message']}" for m in MESSAGES]
+    finally:
+        pipeline.stop()
+        thread.join(timeout=5)
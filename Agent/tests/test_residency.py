@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+import task
+from metrics import metrics
+from pipeline import AgentPipeline
+from residency import ModelResidencyManager
+from service import RequestScheduler, set_scheduler
+from session import ChatSession
+from static import MODEL_NAME_CHAT, MODEL_NAME_VL
+
+VL = "vl-model"
+CHAT = "chat-model"
+
+
+def request(scheduler, model: str, priority: str) -> threading.Thread:
+    thread = threading.Thread(target=scheduler.chat, args=({"model": model, "stream": False,
+                                                            "messages": [{"role": "user", "content": "hi"}]},
+                                                           priority))
+    thread.start()
+    return thread
+
+
+def run_mixed(mock_ollama, exclusive: bool):
+    """
+    视觉模型已加载且正在识别时，先排入一个聊天请求，再排入两个识别请求，返回 (服务, 处理顺序)。
+    """
+    order = []
+
+    def reply(payload):
+        # 服务在回复发出之后才记入 server.requests，这里在生成回复时记录顺序，不受时序影响
+        order.append(payload["model"])
+        return "好的"
+
+    server, _ = mock_ollama(replies={"*": reply}, latency={"*": 0.3}, load_time={"*": 0.3}, max_loaded=1)
+    scheduler = RequestScheduler(max_concurrency=1,
+                                 residency=ModelResidencyManager(exclusive=exclusive, max_defer=10, settle=0))
+    set_scheduler(scheduler)
+    scheduler.warm([VL])
+    threads = [request(scheduler, VL, "transcribe")]
+    time.sleep(0.1)
+    threads.append(request(scheduler, CHAT, "reply"))
+    time.sleep(0.05)
+    threads += [request(scheduler, VL, "transcribe") for _ in range(2)]
+    for thread in threads:
+        thread.join(timeout=10)
+    return server, order
+
+
+def test_queued_transcriptions_run_before_swapping_to_chat(mock_ollama):
+    server, order = run_mixed(mock_ollama, exclusive=True)
+    # 三次识别连续完成后才换入聊天模型
+    assert order == [VL, VL, VL, CHAT]
+    assert server.loads == 2
+
+
+def test_residency_reduces_swaps(mock_ollama):
+    server, order = run_mixed(mock_ollama, exclusive=False)
+    # 只按优先级调度时聊天请求插在识别之间，多换一次模型
+    assert order == [VL, CHAT, VL, VL]
+    swaps_by_priority = sum(a != b for a, b in zip(order, order[1:]))
+    assert server.loads == 3
+
+    server, order = run_mixed(mock_ollama, exclusive=True)
+    assert sum(a != b for a, b in zip(order, order[1:])) < swaps_by_priority
+    assert server.loads == 2
+
+
+def test_choose_defers_other_model_until_max_defer():
+    manager = ModelResidencyManager(exclusive=True, max_defer=10)
+    manager.started(VL)
+    manager.finished(VL, {"load_duration": 0})
+    now = time.monotonic()
+    chat = (0, 1, CHAT, now)
+    vl = (1, 2, VL, now)
+    # 聊天优先级更高，但识别不需要换模型
+    assert manager.choose([chat, vl]) == vl
+    assert manager.would_swap(CHAT) and not manager.would_swap(VL)
+
+    # 聊天请求推迟超过 max_defer 后优先换入
+    overdue = (0, 1, CHAT, now - 11)
+    assert manager.choose([overdue, vl]) == overdue
+    # 进行中的识别结束前不开始其他模型的请求
+    manager.started(VL)
+    assert manager.choose([overdue, vl]) is None
+    manager.finished(VL, {"load_duration": 0})
+
+
+def test_non_exclusive_orders_by_priority_only():
+    manager = ModelResidencyManager(exclusive=False)
+    manager.started(VL)
+    now = time.monotonic()
+    chat = (0, 5, CHAT, now)
+    assert manager.choose([(1, 1, VL, now), chat]) == chat
+    assert not manager.would_swap(CHAT)
+
+
+def test_long_streamed_transcription_with_small_queue_does_not_deadlock(mock_ollama, monkeypatch):
+    """
+    回归：显存只能容纳一个模型时，流式识别的回调曾在队列满时阻塞、一直占着视觉模型的请求，
+    聊天模型的回复请求因此无法开始，直到超过时限。
+    """
+    monkeypatch.setattr(task, "VL_CACHE_ENABLED", False)
+    words = "今天 明天 吃饭 开会 爬山 电影 周末 晚上 地铁 下雨 咖啡 作业 考试 游戏 猫咪 旅行".split()
+    # 内容互不相似的消息，时间线不会把它们当作重复
+    messages = [{"sender": ("张三", "李四", "王五")[i % 3], "message": "".join(words[(i * k) % 16] for k in (1, 3, 5, 7)) + str(i)}
+                for i in range(30)]
+    server, sched = mock_ollama(exclusive=True, replies={MODEL_NAME_VL: json.dumps(messages, ensure_ascii=False)},
+                                latency={"*": 0.1}, token_interval=0.01, load_time={"*": 0.3}, max_loaded=1)
+    sched.warm([MODEL_NAME_VL])
+    deadline_errors = metrics.counter("ollama_deadline_exceeded", priority="reply")
+    sent = []
+    session = ChatSession("群1", sender=sent.append)
+    pipeline = AgentPipeline([session], queue_size=4)
+    chat_thread = threading.Thread(target=pipeline.chat_loop, daemon=True)
+    chat_thread.start()
+    describe = threading.Thread(target=pipeline._describe_all,
+                                args=([(session, np.full((200, 300, 3), 236, np.uint8))], time.perf_counter()),
+                                daemon=True)
+    try:
+        start = time.perf_counter()
+        describe.start()
+        describe.join(timeout=15)
+        assert not describe.is_alive()
+        # 识别请求不因等待对话阶段消费而被拖长
+        assert time.perf_counter() - start < 8
+        deadline = time.perf_counter() + 15
+        while not sent and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        assert sent
+        assert metrics.counter("ollama_deadline_exceeded", priority="reply") == deadline_errors
+    finally:
+        pipeline.stop()
+        chat_thread.join(timeout=5)
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from metrics import metrics
+from residency import ModelResidencyManager
+from service import (OllamaClient, OllamaDeadlineError, OllamaHTTPError, OllamaUnavailableError, RequestScheduler,
+                     set_client, set_scheduler)
+
+PAYLOAD = {"model": "chat-model", "stream": False, "messages": [{"role": "user", "content": "在吗"}]}
+
+
+def scheduler(**kwargs) -> RequestScheduler:
+    options = dict(max_retries=3, backoff=(0.01, 0.05), residency=ModelResidencyManager(exclusive=False))
+    options.update(kwargs)
+    result = RequestScheduler(**options)
+    set_scheduler(result)
+    return result
+
+
+def content(result: dict) -> str:
+    return result["message"]["content"]
+
+
+def test_retries_5xx_then_succeeds(mock_ollama):
+    server, _ = mock_ollama(replies={"*": "好的"}, faults=[500, 503])
+    retries = metrics.counter("ollama_retries", priority="reply")
+    assert content(scheduler().chat(PAYLOAD, "reply")) == "好的"
+    assert [r["status"] for r in server.requests] == [500, 503, 200]
+    assert metrics.counter("ollama_retries", priority="reply") - retries == 2
+
+
+def test_retries_timeout_then_succeeds(mock_ollama):
+    server, _ = mock_ollama(replies={"*": "好的"}, faults=["hang"], hang_time=1.0)
+    # 读取超时比模拟的卡顿短，第一次请求超时后重试
+    set_client(OllamaClient(server.url, read_timeout=0.3))
+    start = time.perf_counter()
+    assert content(scheduler().chat(PAYLOAD, "reply")) == "好的"
+    assert time.perf_counter() - start < 1.0
+
+
+def test_4xx_is_not_retried(mock_ollama):
+    server, _ = mock_ollama(faults=[400, 400])
+    with pytest.raises(OllamaHTTPError) as info:
+        scheduler().chat(PAYLOAD, "reply")
+    assert info.value.status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_retries_stop_after_max_retries(mock_ollama):
+    server, _ = mock_ollama(faults=[500] * 5)
+    with pytest.raises(OllamaHTTPError):
+        scheduler(max_retries=2).chat(PAYLOAD, "reply")
+    assert len(server.requests) == 3
+
+
+def test_deadline_while_queued(mock_ollama):
+    mock_ollama(replies={"*": "好的"}, latency={"*": 1.0})
+    sched = scheduler(max_concurrency=1, deadlines={"summary": 0.2})
+    first = threading.Thread(target=sched.chat, args=(PAYLOAD, "reply"))
+    first.start()
+    time.sleep(0.1)
+    # 唯一的名额被占用，排队超过摘要请求的时限后放弃，不等第一个请求结束
+    start = time.perf_counter()
+    with pytest.raises(OllamaDeadlineError):
+        sched.chat(PAYLOAD, "summary")
+    assert time.perf_counter() - start < 0.5
+    first.join(timeout=5)
+
+
+def test_breaker_opens_and_half_closes_after_cooldown(mock_ollama):
+    server, _ = mock_ollama(replies={"*": "好的"}, faults=[500, 500, 500])
+    sched = scheduler(max_retries=0, breaker_threshold=2, breaker_cooldown=0.3)
+    for _ in range(2):
+        with pytest.raises(OllamaHTTPError):
+            sched.chat(PAYLOAD, "reply")
+    # 熔断期间请求直接失败，不发往服务
+    with pytest.raises(OllamaUnavailableError):
+        sched.chat(PAYLOAD, "reply")
+    assert len(server.requests) == 2
+
+    # 冷却后放行一个试探请求；它再次失败时立即重新熔断
+    time.sleep(0.35)
+    with pytest.raises(OllamaHTTPError):
+        sched.chat(PAYLOAD, "reply")
+    with pytest.raises(OllamaUnavailableError):
+        sched.chat(PAYLOAD, "reply")
+
+    # 再次冷却后试探成功，熔断解除
+    time.sleep(0.35)
+    assert content(sched.chat(PAYLOAD, "reply")) == "好的"
+    assert content(sched.chat(PAYLOAD, "reply")) == "好的"
+    assert len(server.requests) == 5
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    sched = RequestScheduler(max_retries=10, backoff=(0.01, 0.02), residency=ModelResidencyManager(exclusive=False))
+    error = OllamaHTTPError(503, "busy")
+    for attempt in (1, 5):
+        start = time.perf_counter()
+        sched._backoff(attempt, error, "reply", time.monotonic() + 10)
+        elapsed = time.perf_counter() - start
+        # 等待时间为 min(上限, 初始值 * 2^(n-1)) 乘以 0.5~1.0 的随机系数
+        cap = min(0.02, 0.01 * 2 ** (attempt - 1))
+        assert cap * 0.5 <= elapsed < cap + 0.05
+    # 等待后会超过截止时间时不再重试
+    with pytest.raises(OllamaHTTPError):
+        sched._backoff(1, error, "reply", time.monotonic() + 0.001)
@@ -0,0 +1,123 @@
+import json
+
+from session import ChatSession
+from static import MODEL_NAME_CHAT
+from store import ConversationStore, fts_query, set_conversation_store
+
+
+def filled_store() -> ConversationStore:
+    store = ConversationStore(":memory:")
+    store.add_messages("群1", [
+        {"sender": "张三", "message": "周末去爬山吗"},
+        {"sender": "李四", "message": "明天下午开会讨论预算"},
+        {"sender": "王五", "message": "去爬山要带多少水"},
+    ])
+    store.add_reply("群1", "我周末有空喵~")
+    store.add_messages("群2", [{"sender": "赵六", "message": "周末去爬山吗"}])
+    return store
+
+
+def test_fts_query_splits_cjk_into_trigrams():
+    assert fts_query("去爬山") == '"去爬山"'
+    assert fts_query("周末去爬山") == '"周末去" OR "末去爬" OR "去爬山"'
+    # 不足 3 个字的片段和短英文词无法用 trigram 检索
+    assert fts_query("好的 ok") == ""
+    assert fts_query('say "hello"') == '"say" OR "hello"'
+
+
+def test_search_ranks_by_relevance_within_session():
+    store = filled_store()
+    found = store.search("群1", "有人一起去爬山吗", k=2)
+    assert {m.sender for m in found} == {"张三", "王五"}
+    # 按时间先后返回
+    assert [m.id for m in found] == sorted(m.id for m in found)
+    # 其他会话的消息不会被检索到
+    assert [m.sender for m in store.search("群2", "有人一起去爬山吗", k=5)] == ["赵六"]
+    assert store.search("群1", "好的", k=3) == []
+
+
+def test_search_skips_excluded_lines():
+    store = filled_store()
+    found = store.search("群1", "周末有空去爬山", k=5, exclude={"张三:周末去爬山吗"})
+    assert [m.line() for m in found] == ["王五:去爬山要带多少水", "我周末有空喵~"]
+
+
+def test_recent_and_count():
+    store = filled_store()
+    recent = store.recent("群1", 2)
+    assert [m.line() for m in recent] == ["王五:去爬山要带多少水", "我周末有空喵~"]
+    assert recent[-1].role == "assistant"
+    assert store.count("群1") == 4 and store.count() == 5
+
+
+def test_notes_upsert_and_order():
+    store = ConversationStore(":memory:")
+    store.set_notes("群1", {"张三": "喜欢爬山", "李四": "负责预算"})
+    store.set_notes("群1", {"张三": "喜欢爬山，周末有空"})
+    assert store.notes("群1", ["李四", "张三", "王五"]) == {"李四": "负责预算", "张三": "喜欢爬山，周末有空"}
+    assert store.notes("群2", ["张三"]) == {}
+    assert store.notes("群1", []) == {}
+
+
+def test_session_restores_history_and_recalls_related_messages():
+    store = filled_store()
+    store.set_notes("群1", {"张三": "喜欢爬山"})
+    set_conversation_store(store)
+    session = ChatSession("群1", sender=lambda text: None)
+
+    # 识别出的消息按回复分隔放回历史，自己的回复作为 assistant 消息恢复
+    history = [(m.role, m.content) for m in session.builder.message_manager.messages]
+    assert history == [("user", "张三:周末去爬山吗\n李四:明天下午开会讨论预算\n王五:去爬山要带多少水"),
+                       ("assistant", "我周末有空喵~")]
+    # 屏幕上仍显示的旧消息不会被当作新消息
+    assert session.timeline.add([{"sender": "王五", "message": "去爬山要带多少水"},
+                                 {"sender": "张三", "message": "那就周六"}]) == [{"sender": "张三", "message": "那就周六"}]
+
+    # 已在历史中的消息（包括自己的回复）不重复检索，只附带笔记和不在上下文中的历史
+    store.add_messages("群1", [{"sender": "赵六", "message": "上次去爬山很累"}])
+    session.recall("张三:周六去爬山，我周末有空")
+    assert "喜欢爬山" in session.builder.memory
+    assert "赵六:上次去爬山很累" in session.builder.memory
+    assert "王五:去爬山要带多少水" not in session.builder.memory
+    assert "我周末有空喵~" not in session.builder.memory
+
+
+def test_send_adds_reply_to_history_timeline_and_store():
+    store = ConversationStore(":memory:")
+    set_conversation_store(store)
+    sent = []
+    session = ChatSession("群1", sender=sent.append)
+    session.builder.add_user_message("张三:在吗")
+    tokens = session.builder.prompt_tokens()
+    session.send("在的喵~")
+
+    assert sent == ["在的喵~"]
+    last = session.builder.message_manager.messages[-1]
+    assert (last.role, last.content) == ("assistant", "在的喵~")
+    # 回复计入上下文预算
+    assert session.builder.prompt_tokens() > tokens
+    # 屏幕上识别到自己发出的消息不算新消息
+    assert session.timeline.add([{"sender": "晓羽", "message": "在的喵~"}]) == []
+    assert [m.line() for m in store.recent("群1", 5)] == ["在的喵~"]
+
+
+def test_summarize_notes_updates_store_and_trims_history(mock_ollama):
+    store = ConversationStore(":memory:")
+    set_conversation_store(store)
+    replies = []
+
+    def notes_reply(payload):
+        replies.append(payload)
+        return json.dumps({"张三": "喜欢爬山", "路人": "不在快照里", "李四": ""}, ensure_ascii=False)
+
+    mock_ollama(replies={MODEL_NAME_CHAT: notes_reply})
+    session = ChatSession("群1", sender=lambda text: None)
+    session.builder.add_user_message("张三:周末去爬山吗\n李四:好")
+    session.builder.add_assistant_message("一起去喵~")
+    snapshot = list(session.builder.message_manager.messages)
+    session.builder._summarize_notes(snapshot)
+
+    assert replies and replies[0]["format"] == "json"
+    # 只保存快照中出现过、且内容非空的发送者的笔记
+    assert store.notes("群1", ["张三", "李四", "路人"]) == {"张三": "喜欢爬山"}
+    assert session.builder.message_manager.messages == []
@@ -0,0 +1,62 @@
+import json
+
+import cv2
+import numpy as np
+
+import task
+from static import MODEL_NAME_VL, PROMPT_BATCH_READ, PROMPT_CHAT_READ, VL_MESSAGE_SCHEMA
+from vl_cache import get_transcription_cache
+
+
+def region(text: str) -> np.ndarray:
+    image = np.full((240, 480, 3), 236, np.uint8)
+    cv2.rectangle(image, (20, 20), (440, 60), (255, 255, 255), -1)
+    cv2.putText(image, text, (30, 48), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2)
+    return image
+
+
+def test_batch_format_does_not_leak_into_shared_builder(mock_ollama, monkeypatch):
+    monkeypatch.setattr(task, "VL_STRUCTURED_OUTPUT", True)
+    monkeypatch.setattr(task, "VL_CACHE_ENABLED", True)
+    get_transcription_cache().clear()
+    formats = []
+
+    def vl_reply(payload):
+        formats.append(payload.get("format"))
+        count = len(payload["messages"][-1].get("images", []))
+        if count > 1:
+            return json.dumps({str(i): [{"sender": "张三", "message": f"第{i}张"}] for i in range(1, count + 1)},
+                              ensure_ascii=False)
+        return json.dumps([{"sender": "张三", "message": "单张"}], ensure_ascii=False)
+
+    mock_ollama(replies={MODEL_NAME_VL: vl_reply})
+    regions = [region("first"), region("second line")]
+    results = task.describe_regions(regions)
+    assert results == [[{"sender": "张三", "message": "第1张"}], [{"sender": "张三", "message": "第2张"}]]
+    assert formats[0]["type"] == "object"
+
+    # 批量请求的 schema 只放进那一次请求，共享的 builder 仍使用单张识别的 schema
+    assert task._get_vl_builder(PROMPT_CHAT_READ + "\n\n" + PROMPT_BATCH_READ).settings["format"] == VL_MESSAGE_SCHEMA
+    assert task.describe_region(region("third one here"), task._get_vl_builder(PROMPT_CHAT_READ)) == \
+        [{"sender": "张三", "message": "单张"}]
+    assert formats[-1] == VL_MESSAGE_SCHEMA
+
+
+def test_single_and_batch_paths_share_cache(mock_ollama, monkeypatch):
+    monkeypatch.setattr(task, "VL_CACHE_ENABLED", True)
+    get_transcription_cache().clear()
+    calls = []
+
+    def vl_reply(payload):
+        # 服务在回复发出之后才记入 server.requests，这里在生成回复时计数，不受时序影响
+        calls.append(payload)
+        return json.dumps([{"sender": "李四", "message": "好"}], ensure_ascii=False)
+
+    mock_ollama(replies={MODEL_NAME_VL: vl_reply})
+    image = region("cached")
+    first = task.describe_region(image, task._get_vl_builder(PROMPT_CHAT_READ))
+    assert len(calls) == 1
+    # 逐张识别写入的缓存在批量路径中同样命中
+    assert task.describe_regions([image]) == [first]
+    assert len(calls) == 1
+    get_transcription_cache().clear()
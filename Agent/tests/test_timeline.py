@@ -0,0 +1,66 @@
+from timeline import MessageTimeline, normalize_text
+
+
+def msgs(*pairs):
+    return [{"sender": sender, "message": message} for sender, message in pairs]
+
+
+def test_normalize_text():
+    assert normalize_text("Ｈｅｌｌｏ， World!") == "helloworld"
+    # 只有标点或表情时保留原文，不同的表情不会被当作相同
+    assert normalize_text("？？") != normalize_text("！！")
+
+
+def test_scrolling_yields_only_new_messages():
+    timeline = MessageTimeline()
+    assert timeline.add(msgs(("a", "一"), ("b", "二"), ("c", "三"))) == msgs(("a", "一"), ("b", "二"), ("c", "三"))
+    assert timeline.add(msgs(("b", "二"), ("c", "三"), ("d", "四"))) == msgs(("d", "四"))
+    assert timeline.add(msgs(("c", "三"), ("d", "四"))) == []
+
+
+def test_recognition_noise_is_not_new():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("小明", "今天晚上一起去吃火锅吧"), ("小红", "好的，几点？")))
+    # 标点、全角半角和个别错字不算新消息
+    assert timeline.add(msgs(("小明", "今天晚上一起去吃火锅吧!"), ("小红", "好的,几点?"))) == []
+    assert timeline.add(msgs(("小明", "今天晚上一起去吃火锅巴"), ("小红", "好的，几点？"))) == []
+
+
+def test_repeated_text_after_overlap_is_new():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("a", "好"), ("b", "在吗")))
+    assert timeline.add(msgs(("b", "在吗"), ("a", "好"))) == msgs(("a", "好"))
+
+
+def test_missed_message_between_matches_is_new():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("a", "第一条消息"), ("b", "第三条消息")))
+    assert timeline.add(msgs(("a", "第一条消息"), ("c", "完全不同的内容"), ("b", "第三条消息"))) == msgs(("c", "完全不同的内容"))
+
+
+def test_same_text_from_other_sender_is_new():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("张三", "收到")))
+    assert timeline.add(msgs(("张三", "收到"), ("李四", "收到"))) == msgs(("李四", "收到"))
+
+
+def test_own_messages_are_not_new():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("a", "你好")))
+    timeline.add_own("喵~你好呀")
+    assert timeline.add(msgs(("a", "你好"), ("巧克力", "喵~你好呀"))) == []
+
+
+def test_partial_results_are_not_returned_twice():
+    timeline = MessageTimeline()
+    timeline.add(msgs(("a", "早上好"), ("b", "吃了吗")))
+    assert timeline.add(msgs(("b", "吃了吗")), partial=True) == []
+    assert timeline.add(msgs(("b", "吃了吗"), ("c", "还没有")), partial=True) == msgs(("c", "还没有"))
+    assert timeline.add(msgs(("b", "吃了吗"), ("c", "还没有"), ("a", "一起去吧")), partial=True) == msgs(("a", "一起去吧"))
+    assert timeline.add(msgs(("b", "吃了吗"), ("c", "还没有"), ("a", "一起去吧"))) == []
+
+
+def test_invalid_items_are_skipped():
+    timeline = MessageTimeline()
+    assert timeline.add(["text", {"sender": "a"}, {"sender": "a", "message": "  "}]) == []
+    assert timeline.add(None) == []
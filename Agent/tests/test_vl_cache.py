@@ -0,0 +1,90 @@
+import time
+
+import cv2
+import numpy as np
+
+from vl_cache import TranscriptionCache, hamming, perceptual_hash
+
+RESULT = [{"sender": "李四", "message": "晚上一起吃饭"}]
+
+
+def chat_region(lines, size=(320, 480)) -> np.ndarray:
+    """
+    白底的聊天区域，每行一条文字消息。
+    """
+    region = np.full((size[0], size[1], 3), 236, np.uint8)
+    for i, text in enumerate(lines):
+        y = 20 + i * 50
+        cv2.rectangle(region, (20, y), (440, y + 40), (255, 255, 255), -1)
+        cv2.putText(region, text, (30, y + 28), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2)
+    return region
+
+
+def test_hash_tolerates_noise():
+    region = chat_region(["hello", "see you at eight"])
+    noise = np.random.default_rng(0).integers(-3, 4, region.shape)
+    noisy = np.clip(region.astype(int) + noise, 0, 255).astype(np.uint8)
+    assert hamming(perceptual_hash(region), perceptual_hash(noisy)) <= 4
+
+
+def test_hit_on_same_and_noisy_region():
+    cache = TranscriptionCache(path=None)
+    region = chat_region(["hello", "see you at eight"])
+    cache.put(cache.key(region, "ns"), region, RESULT)
+    assert cache.get(cache.key(region, "ns"), region) == RESULT
+
+    noisy = region.copy()
+    noisy[::7, ::5] = 230
+    assert cache.get(cache.key(noisy, "ns"), noisy) == RESULT
+
+
+def test_thumbnail_rejects_hash_collision():
+    # 汉明距离放宽到任何候选都通过，只剩缩略图确认：内容不同的区域不能命中
+    cache = TranscriptionCache(max_distance=64, path=None)
+    region = chat_region(["hello", "see you at eight"])
+    changed = chat_region(["hello", "see you at nine!"])
+    cache.put(cache.key(region), region, RESULT)
+    assert cache.get(cache.key(changed), changed) is None
+
+
+def test_namespace_separates_results():
+    cache = TranscriptionCache(path=None)
+    region = chat_region(["hello"])
+    cache.put(cache.key(region, "model-a"), region, RESULT)
+    assert cache.get(cache.key(region, "model-b"), region) is None
+
+
+def test_entries_expire_after_ttl():
+    cache = TranscriptionCache(ttl=60, path=None)
+    region = chat_region(["hello"])
+    key = cache.key(region)
+    cache.put(key, region, RESULT)
+    result, _, thumb = cache.entries[key]
+    cache.entries[key] = (result, time.time() - 61, thumb)
+    assert cache.get(key, region) is None
+
+
+def test_lru_capacity():
+    cache = TranscriptionCache(capacity=2, path=None)
+    regions = [chat_region([f"message {i}"], size=(120 + 40 * i, 480)) for i in range(3)]
+    for i, region in enumerate(regions):
+        cache.put(cache.key(region), region, [{"sender": "a", "message": str(i)}])
+    assert len(cache.entries) == 2
+    assert cache.get(cache.key(regions[0]), regions[0]) is None
+    assert cache.get(cache.key(regions[2]), regions[2]) == [{"sender": "a", "message": "2"}]
+
+
+def test_persists_and_skips_expired(tmp_path):
+    path = str(tmp_path / "vl_cache.json")
+    cache = TranscriptionCache(ttl=60, path=path)
+    fresh, stale = chat_region(["fresh"]), chat_region(["stale"], size=(200, 480))
+    cache.put(cache.key(fresh), fresh, RESULT)
+    cache.put(cache.key(stale), stale, RESULT)
+    key = cache.key(stale)
+    result, _, thumb = cache.entries[key]
+    cache.entries[key] = (result, time.time() - 120, thumb)
+    cache.save()
+
+    loaded = TranscriptionCache(ttl=60, path=path)
+    assert len(loaded.entries) == 1
+    assert loaded.get(loaded.key(fresh), fresh) == RESULT
@@ -0,0 +1,189 @@
+import difflib
+import logging
+import re
+import threading
+import unicodedata
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import metrics
+from static import TIMELINE_HISTORY, TIMELINE_WINDOW, TIMELINE_SIMILARITY, UNKNOWN_SENDER
+
+_NOISE_PATTERN = re.compile(r"[\s\W_]+")
+
+
+def normalize_text(text: Any) -> str:
+    """
+    归一化文本用于比较：NFKC（全角/半角统一）、小写，并去掉空白和标点。
+    只剩标点或表情时保留 NFKC 后的原文，避免所有这类消息都变成空串。
+    """
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    stripped = _NOISE_PATTERN.sub("", text)
+    return stripped or text.strip()
+
+
+def similar(a: str, b: str, threshold: float) -> bool:
+    """
+    判断两个归一化后的文本是否足够相似（容忍识别误差），先用长度和 quick_ratio 快速排除。
+    """
+    if a == b:
+        return True
+    if not a or not b:
+        return False
+    # ratio() 的上限是 2*min/(len(a)+len(b))，长度相差太大时直接排除
+    if 2 * min(len(a), len(b)) / (len(a) + len(b)) < threshold:
+        return False
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold
+
+
+_UNKNOWN_KEY = normalize_text(UNKNOWN_SENDER)
+
+
+class TimelineEntry:
+    __slots__ = ("sender", "message", "sender_key", "message_key")
+
+    def __init__(self, sender: Optional[str], message: str):
+        self.sender = sender
+        self.message = message
+        # sender 为 None 表示未知（如机器人自己发出的消息），与任何发送者都匹配
+        self.sender_key = normalize_text(sender) if sender is not None else None
+        self.message_key = normalize_text(message)
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"sender": self.sender if self.sender is not None else UNKNOWN_SENDER, "message": self.message}
+
+
+class MessageTimeline:
+    """
+    持久的消息时间线，用于从每次的识别结果中找出真正新增的消息。
+
+    每次识别结果（从上到下的可见消息）都与已知历史的尾部窗口对齐：
+    用归一化文本和模糊匹配判断两条消息是否相同，在窗口内求保持顺序的最长匹配（最长重叠，完全相同的匹配优先），
+    最后一个匹配之后未匹配的消息为新消息；中间未匹配的消息只有在与窗口内任何消息都不相似时才算新消息
+    （例如上一帧被漏识别的消息），否则视为识别误差。窗口大小固定，因此每次对齐的耗时只与识别结果的长度成正比。
+    """
+
+    def __init__(self, max_history: int = TIMELINE_HISTORY, window: int = TIMELINE_WINDOW,
+                 similarity: float = TIMELINE_SIMILARITY):
+        """
+        :param max_history: 保留的历史消息数
+        :param window: 对齐时使用的历史尾部长度，滚动回去的内容超出该范围后会被当作新消息
+        :param similarity: 视为同一条消息的最小相似度（0~1）
+        """
+        self.history: "deque[TimelineEntry]" = deque(maxlen=max_history)
+        self.window = window
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        # 流式识别期间已经提前返回的新消息数，用于在最终结果中统计重复消息
+        self._streamed = 0
+
+    def _score(self, a: TimelineEntry, b: TimelineEntry) -> int:
+        """
+        两条消息的匹配分数：2 为归一化后完全相同，1 为模糊相似，0 为不同。
+        对齐时优先采用完全相同的匹配，避免只差一个数字的相近消息把对齐整体错开一位。
+        """
+        if a.sender_key is not None and b.sender_key is not None and a.sender_key != b.sender_key:
+            if _UNKNOWN_KEY not in (a.sender_key, b.sender_key) and not similar(a.sender_key, b.sender_key, self.similarity):
+                return 0
+        if a.message_key == b.message_key:
+            return 2
+        return 1 if similar(a.message_key, b.message_key, self.similarity) else 0
+
+    @staticmethod
+    def _entries(messages: Any) -> List[TimelineEntry]:
+        """
+        把识别结果转换为条目，跳过不是字典或没有消息内容的项。
+        """
+        entries = []
+        for item in messages or []:
+            if not isinstance(item, dict):
+                continue
+            message = item.get("message")
+            if message is None or str(message).strip() == "":
+                continue
+            sender = item.get("sender")
+            entries.append(TimelineEntry(str(sender) if sender else UNKNOWN_SENDER, str(message)))
+        return entries
+
+    def _align(self, current: List[TimelineEntry], tail: List[TimelineEntry]) -> Tuple[List[bool], List[List[int]]]:
+        """
+        在 current 与 tail 之间求保持顺序、匹配分数之和最大的对齐。
+
+        :return: (current 中每条消息是否被匹配, 两两匹配分数的矩阵)
+        """
+        m, n = len(current), len(tail)
+        score = [[self._score(current[i], tail[j]) for j in range(n)] for i in range(m)]
+        # dp[i][j]：current[i:] 与 tail[j:] 对齐的最大分数
+        dp = [[0] * (n + 1) for _ in range(m + 1)]
+        for i in range(m - 1, -1, -1):
+            for j in range(n - 1, -1, -1):
+                best = max(dp[i + 1][j], dp[i][j + 1])
+                if score[i][j]:
+                    best = max(best, dp[i + 1][j + 1] + score[i][j])
+                dp[i][j] = best
+
+        matched = [False] * m
+        i = j = 0
+        while i < m and j < n:
+            if score[i][j] and dp[i][j] == dp[i + 1][j + 1] + score[i][j]:
+                matched[i] = True
+                i += 1
+                j += 1
+            elif dp[i][j] == dp[i][j + 1]:
+                # 分数相同时优先跳过较早的历史，使匹配尽量落在历史尾部（屏幕滚动时重叠的部分），
+                # 否则与更早历史重复的消息（如又发了一次“好”）会被匹配到旧消息上而当作识别误差
+                j += 1
+            else:
+                i += 1
+        return matched, score
+
+    def add(self, messages: Any, partial: bool = False) -> List[Dict[str, str]]:
+        """
+        输入一次识别结果，返回其中的新消息（sender/message 字典），并把它们追加到历史。
+
+        :param partial: messages 只是流式识别到目前为止的前缀，之后还会用更长的前缀（最后是完整结果）再次调用。
+                        此时后面的消息还未知，无法判断一条与历史相似却未匹配的消息是识别误差还是新消息，
+                        因此从这样的消息开始暂不返回，留到下一次调用再判断；已经返回的消息进入历史后会被匹配上，不会重复返回
+        """
+        current = self._entries(messages)
+        if not current:
+            if not partial:
+                self._streamed = 0
+            return []
+        with self._lock:
+            tail = list(self.history)[-self.window:]
+            matched, score = self._align(current, tail)
+            last_match = max((i for i, ok in enumerate(matched) if ok), default=-1)
+
+            new_entries = []
+            for i, entry in enumerate(current):
+                if matched[i]:
+                    continue
+                # 最后一个匹配之前的未匹配消息：与窗口内任何消息相似都视为识别误差
+                if i < last_match and any(score[i]):
+                    logging.debug(f"忽略疑似重复的消息: {entry.to_dict()}")
+                    continue
+                if partial and any(score[i]):
+                    break
+                new_entries.append(entry)
+
+            self.history.extend(new_entries)
+            if partial:
+                self._streamed += len(new_entries)
+                return [entry.to_dict() for entry in new_entries]
+            duplicates = max(0, len(current) - len(new_entries) - self._streamed)
+            self._streamed = 0
+        metrics.incr("duplicate_messages", duplicates)
+        return [entry.to_dict() for entry in new_entries]
+
+    def add_own(self, message: str) -> None:
+        """
+        记录机器人自己发出的消息，之后在屏幕上识别到它时不会被当作新消息。
+        """
+        with self._lock:
+            self.history.append(TimelineEntry(None, message))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.history.clear()
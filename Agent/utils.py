@@ -1,27 +1,33 @@
 import base64
-import pyautogui
 import cv2
 import numpy as np
 import json
 import re
-import os
-import pyperclip
 import time
-from typing import Union
+import logging
+from typing import Optional, Union
+
+try:
+    import pyautogui
+    import pyperclip
+except Exception:
+    # 没有图形界面时（如离线回放基准测试）无法导入，截图改由 frame_source.set_frame_source 提供
+    pyautogui = None
+    pyperclip = None
+
+from anchor import AnchorTracker, get_anchor_tracker
+from metrics import metrics
+from frame_cache import FrameCache, get_frame_cache, is_similar
+from frame_source import get_frame_source
+from preprocess import encode_image, image_to_base64_preset
+from scroll import crop_new_content
+from static import DEBUG_SNAPSHOT, INCREMENTAL_CROP, CONTROL_TOKENS
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
 
 # 自定义异常类
 class ScreenshotNotChangedException(Exception):
     pass
-# 比较两张图像是否几乎相同（允许一定误差）
-def is_similar(img1, img2, threshold=500):
-    if img1.shape != img2.shape:
-        # 尺寸不一致时默认认为不同
-        return False
-    
-    diff = cv2.absdiff(img1, img2)
-    non_zero = cv2.countNonZero(cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY))
-    
-    return non_zero < threshold
 def format_response_to_string(response: Union[str, list]) -> str:
     """
     清理 response 中的 Markdown 代码块标记，并解析 JSON，
@@ -58,27 +64,33 @@ def format_response_to_string(response: Union[str, list]) -> str:
         result.append(f"{sender}:{message}")
 
     return '\n'.join(result)
+def estimate_tokens(text: str) -> float:
+    """
+    粗略估计文本的 token 数：中日韩字符约 0.7 个 token/字，其余字符约 3.5 字符/token。
+    只作为初始估计，PayloadBuilder 会用 Ollama 返回的真实计数校准。
+    """
+    if not text:
+        return 0.0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk * 0.7 + (len(text) - cjk) / 3.5
+
 def image_to_base64(file_path):
     """将图像文件转为 base64 编码"""
     with open(file_path, "rb") as image_file:
         encoded_str = base64.b64encode(image_file.read()).decode("utf-8")
     return encoded_str
 
-def image_to_base64_NumPy(image: np.ndarray, format='png') -> str:
+def image_to_base64_NumPy(image: np.ndarray, format='png', quality=None) -> str:
     """
     将 NumPy 图像数组转换为 Base64 编码的字符串。
     
     :param image: NumPy 数组形式的图像（如 OpenCV 加载的 BGR 图像）
-    :param format: 图像格式，支持 'png' 或 'jpeg'
+    :param format: 图像格式，支持 'png'、'jpeg' 或 'webp'
+    :param quality: 编码质量（png 为压缩级别），None 表示默认值
     :return: Base64 编码字符串
     """
-    # 将图像编码为内存中的字节流
-    success, encoded_image = cv2.imencode(f'.{format}', image)
-    if not success:
-        raise ValueError("图像编码失败，请检查图像格式或数据是否正确。")
-
-    # 转换为 base64 字符串
-    return base64.b64encode(encoded_image.tobytes()).decode('utf-8')
+    # 将图像编码为内存中的字节流，并转换为 base64 字符串
+    return base64.b64encode(encode_image(image, format, quality)).decode('utf-8')
 
 def parse_response(http_response : str) -> tuple[str, str]: 
     """ 
@@ -95,158 +107,232 @@ def parse_response(http_response : str) -> tuple[str, str]:
     
     return thinking, response
 
-def capture_between_icons(icon1_path, icon2_path, threshold=0.8, output_path="capture_result.png"):
-    # 截取整个屏幕
-    screenshot = pyautogui.screenshot()
-    screen_img = np.array(screenshot)
-    screen_img = cv2.cvtColor(screen_img, cv2.COLOR_RGB2BGR)
-
-    # 加载图标模板
-    icon1 = cv2.imread(icon1_path, cv2.IMREAD_COLOR)
-    icon2 = cv2.imread(icon2_path, cv2.IMREAD_COLOR)
-
-    if icon1 is None or icon2 is None:
-        raise FileNotFoundError("无法加载图标文件，请确认路径是否正确。")
-
-    # 获取图标尺寸
-    h1, w1 = icon1.shape[:2]
-    h2, w2 = icon2.shape[:2]
-
-    # 使用模板匹配查找图标位置
-    res1 = cv2.matchTemplate(screen_img, icon1, cv2.TM_CCOEFF_NORMED)
-    loc1 = np.where(res1 >= threshold)
+class ThinkStreamParser:
+    """
+    增量解析流式回复中的 <think> 思考部分和回答部分，
+    并在回答部分出现控制指令（如 [reject]、[quit]）时立即报告。
+    思考部分中出现的控制指令不计入，因为模型可能只是在斟酌是否使用它。
+    """
 
-    res2 = cv2.matchTemplate(screen_img, icon2, cv2.TM_CCOEFF_NORMED)
-    loc2 = np.where(res2 >= threshold)
+    def __init__(self, control_tokens=CONTROL_TOKENS):
+        self.control_tokens = control_tokens
+        self.text = ""
+        self.thinking = ""
+        self.answer = ""
+        self.control_token = None
+        self._state = "start"  # start -> think -> answer，或者没有思考部分时 start -> answer
+        self._answer_start = 0
+
+    def feed(self, delta: str) -> str:
+        """
+        输入新的文本片段，返回本次新增的回答文本。
+        """
+        self.text += delta
+
+        if self._state == "start":
+            head = self.text.lstrip()
+            if head.startswith("<think>"):
+                self._state = "think"
+            elif not "<think>".startswith(head):
+                # 没有思考部分，全部都是回答
+                self._state = "answer"
+                self._answer_start = len(self.text) - len(head)
+
+        if self._state == "think":
+            think_start = self.text.find("<think>") + len("<think>")
+            think_end = self.text.find("</think>", think_start)
+            if think_end == -1:
+                self.thinking = self.text[think_start:].strip("\n")
+                return ""
+            self.thinking = self.text[think_start:think_end].strip("\n")
+            self._state = "answer"
+            self._answer_start = think_end + len("</think>")
+
+        if self._state != "answer":
+            return ""
+
+        answer = self.text[self._answer_start:].lstrip("\n")
+        new_text = answer[len(self.answer):]
+        # 只在可能包含新指令的尾部查找，避免重复扫描
+        lookback = max((len(token) for token in self.control_tokens), default=0)
+        tail = answer[max(0, len(self.answer) - lookback):]
+        self.answer = answer
+        if self.control_token is None:
+            for token in self.control_tokens:
+                if token in tail:
+                    self.control_token = token
+                    break
+        return new_text
+
+class JsonArrayStreamParser:
+    """
+    增量解析流式回复中的 JSON 数组，数组中的每个对象一完整就立即返回，不必等整个回复结束。
+    数组之前的 Markdown 代码块标记或其他文字会被忽略；回复被截断时，已经完整的对象仍然有效。
+    """
 
-    try:
-        # icon1: 取所有匹配中最左上角的点 → 左上角
-        y1_all, x1_all = loc1
-        if len(x1_all) == 0:
-            raise ValueError("icon1 未找到匹配项")
-        min_x = np.min(x1_all)
-        min_y = np.min(y1_all)
-        x1_right_bottom = min_x + w1
-        y1_right_bottom = min_y + h1
-
-        # icon2: 取所有匹配点中最上面一行中最右边的点 → 右上角
-        y2_all, x2_all = loc2
-        if len(x2_all) == 0:
-            raise ValueError("icon2 未找到匹配项")
-        min_y_icon2 = np.min(y2_all)
-        top_row_mask = (y2_all == min_y_icon2)
-        x_rightmost = np.max(x2_all[top_row_mask])
-        x2_right_top = x_rightmost + w2
-        y2_right_top = min_y_icon2
-
-        # 截图区域左上角 = icon1 的右下角
-        left = x1_right_bottom
-        top = y1_right_bottom
-        # 截图区域右下角 = icon2 的右上角
-        right = x2_right_top
-        bottom = y2_right_top
-
-    except IndexError:
-        raise ValueError("未找到图标，请调整阈值或确保图标在屏幕上可见。")
-
-    # 截取区域
-    region = screen_img[top:bottom, left:right]
-
-    # 检查是否存在缓存图像
-    if os.path.exists(output_path):
-        cached_img = cv2.imread(output_path)
-        if cached_img is not None and is_similar(region, cached_img):
-            raise ScreenshotNotChangedException("截图内容未发生显著变化（可能为截图误差）。")
-    
-    # 保存结果
-    cv2.imwrite(output_path, region)
-    print(f"截图已保存为 {output_path}")
-    
-    # 返回 Base64 编码
-    return image_to_base64_NumPy(region)
+    def __init__(self):
+        self.text = ""
+        self.items: list = []
+        self.errors = 0  # 无法解析而被跳过的元素数
+        self.done = False  # 数组已经结束
+        self._pos = 0
+        self._depth = 0  # 0 表示还没进入数组，1 表示在数组内、元素之间
+        self._in_string = False
+        self._escape = False
+        self._item_start = None
+
+    def feed(self, delta: str) -> list:
+        """
+        输入新的文本片段，返回本次新解析出的完整对象。
+        """
+        self.text += delta
+        text = self.text
+        new_items = []
+        i = self._pos
+        while i < len(text) and not self.done:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                if ch == "[":
+                    self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 1:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                elif self._depth == 1 and self._item_start is not None:
+                    try:
+                        item = json.loads(text[self._item_start:i + 1])
+                    except json.JSONDecodeError:
+                        self.errors += 1
+                    else:
+                        if isinstance(item, dict):
+                            self.items.append(item)
+                            new_items.append(item)
+                    self._item_start = None
+            i += 1
+        self._pos = i
+        return new_items
+
+def grab_screen(region: Optional[tuple] = None, gray: bool = False) -> np.ndarray:
+    """
+    通过当前的截图来源（frame_source.get_frame_source()）截取整个屏幕或 region=(left, top, width, height) 指定的区域。
+    返回 BGR 图像，gray=True 时返回灰度图；返回的数组可能是复用的缓冲区，需要保留时请复制。
+    """
+    return get_frame_source().grab(region, gray)
 
-def update_screenshot_cache(icon1_path, icon2_path, threshold=0.8, output_path="capture_result.png"):
+def capture_region(icon1_path, icon2_path, threshold=0.8, output_path="capture_result.png", frame_cache: FrameCache = None,
+                   tracker: AnchorTracker = None, screen_img: np.ndarray = None, origin: tuple = (0, 0),
+                   incremental: bool = INCREMENTAL_CROP) -> np.ndarray:
+    """
+    截取两个图标之间的区域，返回需要发送给视觉模型的部分（BGR 图像，未编码）。
+    :param tracker: 使用的锚点跟踪器，默认按图标路径共享
+    :param screen_img: 已截取的屏幕图像（多个会话共用同一张截图时传入），None 表示现在截取
+    :param origin: screen_img 左上角的屏幕坐标，screen_img 只是屏幕的一部分时传入
+    :param incremental: 只返回相对上一帧新滚动进来的部分，False 时返回整个区域
+    :raises ScreenshotNotChangedException: 与上一帧相比没有显著变化
+    """
     # 截取整个屏幕
-    screenshot = pyautogui.screenshot()
-    screen_img = np.array(screenshot)
-    screen_img = cv2.cvtColor(screen_img, cv2.COLOR_RGB2BGR)
-
-    # 加载图标模板
-    icon1 = cv2.imread(icon1_path, cv2.IMREAD_COLOR)
-    icon2 = cv2.imread(icon2_path, cv2.IMREAD_COLOR)
-
-    if icon1 is None or icon2 is None:
-        raise FileNotFoundError("无法加载图标文件，请确认路径是否正确。")
-
-    # 获取图标尺寸
-    h1, w1 = icon1.shape[:2]
-    h2, w2 = icon2.shape[:2]
-
-    # 使用模板匹配查找图标位置
-    res1 = cv2.matchTemplate(screen_img, icon1, cv2.TM_CCOEFF_NORMED)
-    loc1 = np.where(res1 >= threshold)
-
-    res2 = cv2.matchTemplate(screen_img, icon2, cv2.TM_CCOEFF_NORMED)
-    loc2 = np.where(res2 >= threshold)
-
-    try:
-        # icon1: 取所有匹配中最左上角的点 → 左上角
-        y1_all, x1_all = loc1
-        if len(x1_all) == 0:
-            raise ValueError("icon1 未找到匹配项")
-        min_x = np.min(x1_all)
-        min_y = np.min(y1_all)
-        x1_right_bottom = min_x + w1
-        y1_right_bottom = min_y + h1
-
-        # icon2: 取所有匹配点中最上面一行中最右边的点 → 右上角
-        y2_all, x2_all = loc2
-        if len(x2_all) == 0:
-            raise ValueError("icon2 未找到匹配项")
-        min_y_icon2 = np.min(y2_all)
-        top_row_mask = (y2_all == min_y_icon2)
-        x_rightmost = np.max(x2_all[top_row_mask])
-        x2_right_top = x_rightmost + w2
-        y2_right_top = min_y_icon2
-
-        # 截图区域左上角 = icon1 的右下角
-        left = x1_right_bottom
-        top = y1_right_bottom
-        # 截图区域右下角 = icon2 的右上角
-        right = x2_right_top
-        bottom = y2_right_top
-
-    except IndexError:
-        raise ValueError("未找到图标，请调整阈值或确保图标在屏幕上可见。")
-
-    # 截取区域
-    region = screen_img[top:bottom, left:right]
-    
-    # 保存结果
-    cv2.imwrite(output_path, region)
-    print(f"缓存已更新为 {output_path}")
+    if screen_img is None:
+        with metrics.timer("screenshot"):
+            screen_img = grab_screen()
+
+    # 使用常驻内存的模板和上次的位置定位图标
+    with metrics.timer("template_match"):
+        if tracker is None:
+            tracker = get_anchor_tracker(icon1_path, icon2_path, threshold)
+        left, top, right, bottom = tracker.locate(screen_img, origin)
+
+    # 截取区域（切片，不复制）
+    ox, oy = origin
+    region = screen_img[top - oy:bottom - oy, left - ox:right - ox]
+
+    # 与内存中的上一帧比较
+    if frame_cache is None:
+        frame_cache = get_frame_cache(output_path, output_path if DEBUG_SNAPSHOT else None)
+    with metrics.timer("change_detect"):
+        unchanged = frame_cache.is_unchanged(region)
+    if unchanged:
+        metrics.incr("frames_unchanged")
+        raise ScreenshotNotChangedException("截图内容未发生显著变化（可能为截图误差）。")
+    metrics.incr("frames_changed")
+
+    # 只发送相对上一帧新滚动进来的部分
+    with metrics.timer("scroll_crop"):
+        new_content = crop_new_content(frame_cache.region, region) if incremental else region
+    logging.debug(f"发送区域高度: {new_content.shape[0]}/{region.shape[0]}")
+    frame_cache.update(region)
+    return new_content
+
+def capture_between_icons(icon1_path, icon2_path, threshold=0.8, output_path="capture_result.png", frame_cache: FrameCache = None):
+    new_content = capture_region(icon1_path, icon2_path, threshold, output_path, frame_cache)
+
+    # 按 static.IMAGE_PRESET 预处理并返回 Base64 编码
+    with metrics.timer("encode"):
+        return image_to_base64_preset(new_content)
+
+def update_screenshot_cache(icon1_path, icon2_path, threshold=0.8, output_path="capture_result.png", frame_cache: FrameCache = None, region=None,
+                            tracker: AnchorTracker = None):
+    """
+    发送消息后刷新截图缓存，使机器人自己发出的消息不会被当作屏幕变化。
+    已有当前帧时直接使用；否则只截取上次定位到的区域，不再截取整个屏幕。
+    """
+    if frame_cache is None:
+        frame_cache = get_frame_cache(output_path, output_path if DEBUG_SNAPSHOT else None)
+
+    if region is None:
+        if tracker is None:
+            tracker = get_anchor_tracker(icon1_path, icon2_path, threshold)
+        with metrics.timer("screenshot"):
+            if tracker.region is not None:
+                left, top, right, bottom = tracker.region
+                region = grab_screen((left, top, right - left, bottom - top))
+            else:
+                screen_img = grab_screen()
+                left, top, right, bottom = tracker.locate(screen_img)
+                region = screen_img[top:bottom, left:right]
+
+    frame_cache.update(region)
+    logging.debug("截图缓存已更新")
     
-def send_message(response: str) -> None:
+def send_message(response: str, click_at: Optional[tuple] = None) -> None:
     """
     将 response 写入剪贴板，并模拟 Ctrl+V 粘贴、Ctrl+Enter 发送。
+    :param click_at: 先点击的屏幕坐标 (x, y)，用于多个聊天窗口时切换到对应的输入框
     """
-    # 写入剪贴板
-    pyperclip.copy(response)
+    with metrics.timer("send_message"):
+        if click_at is not None:
+            pyautogui.click(*click_at)
+
+        # 写入剪贴板
+        pyperclip.copy(response)
 
-    # 稍微延迟一下，确保剪贴板准备好
-    time.sleep(0.5)
+        # 稍微延迟一下，确保剪贴板准备好
+        time.sleep(0.5)
 
-    # 模拟 Ctrl + V（粘贴）
-    pyautogui.hotkey('ctrl', 'v')
+        # 模拟 Ctrl + V（粘贴）
+        pyautogui.hotkey('ctrl', 'v')
 
-    # 模拟 Ctrl + Enter（发送）
-    pyautogui.hotkey('ctrl', 'enter')
+        # 模拟 Ctrl + Enter（发送）
+        pyautogui.hotkey('ctrl', 'enter')
 
     print("消息已发送")
     
 def get_new_responses(responce, responce_cache):
     """
     返回 responce 中独有的新消息（不在 responce_cache 中的消息）
+    只做精确比较；流水线使用容忍识别误差的 timeline.MessageTimeline
     
     参数:
         responce (list): 当前获取到的消息列表（JSON 格式）
@@ -258,12 +344,12 @@ def get_new_responses(responce, responce_cache):
     # 将缓存转换成集合，用于快速查找
     responce = parse_json_from_markdown(responce)
     responce_cache = parse_json_from_markdown(responce_cache)
-    cache_set = {(item["sender"], item["message"]) for item in responce_cache if isinstance(item, dict)}
+    cache_set = {(item.get("sender"), item.get("message")) for item in responce_cache if isinstance(item, dict)}
 
     # 遍历当前响应，筛选出缓存中没有的新消息
     new_responses = [
         item for item in responce
-        if isinstance(item, dict) and (item["sender"], item["message"]) not in cache_set
+        if isinstance(item, dict) and (item.get("sender"), item.get("message")) not in cache_set
     ]
 
     return new_responses
@@ -274,12 +360,15 @@ def parse_json_from_markdown(text, default=list):
     如果输入为空或无效，默认返回空列表或空字典。
 
     参数:
-        text (str): 可能包含 ```json ... ``` 包裹的字符串
+        text (str): 可能包含 ```json ... ``` 包裹的字符串，已解析的 list/dict 原样返回
         default: 默认返回类型，list -> [], dict -> {}
 
     返回:
         list 或 dict: 解析后的 JSON 数据，失败则返回默认值
     """
+    if isinstance(text, (list, dict)):
+        # 已经解析过的结果（如来自识别缓存）直接返回
+        return text
     if not isinstance(text, str) or text.strip() == "":
         return [] if default == list else {} if default == dict else None
 
@@ -291,8 +380,14 @@ def parse_json_from_markdown(text, default=list):
         data = json.loads(json_str)
         return data
     except json.JSONDecodeError as e:
-        # 可选：记录日志
-        # logging.warning(f"JSON 解析失败: {e}")
+        # 回复被截断或数组中有个别元素损坏时，保留其中完整的消息对象
+        if default == list:
+            parser = JsonArrayStreamParser()
+            parser.feed(json_str)
+            if parser.items:
+                logging.warning(f"JSON 解析失败，保留了其中 {len(parser.items)} 个完整的对象: {e}")
+                return parser.items
+        logging.warning(f"JSON 解析失败: {e}")
         return [] if default == list else {} if default == dict else None
 
 if __name__ == "__main__":
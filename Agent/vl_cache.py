@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from static import VL_CACHE_SIZE, VL_CACHE_TTL, VL_CACHE_MAX_DISTANCE, VL_CACHE_PATH, VL_CACHE_HASH_SIZE, VL_CACHE_THUMB_WIDTH, VL_CACHE_PIXEL_TOLERANCE
+
+# (命名空间, 尺寸分桶, 感知哈希)
+CacheKey = Tuple[str, Tuple[int, int], int]
+
+
+def perceptual_hash(image: np.ndarray, hash_size: int = VL_CACHE_HASH_SIZE) -> int:
+    """
+    差值哈希（dHash）：缩小为 (hash_size+1)×hash_size 的灰度图，比较每行相邻像素的大小关系。
+    噪点和压缩误差几乎不改变结果，内容滚动或出现新消息时会有大量位发生变化。
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def thumbnail(image: np.ndarray, width: int = VL_CACHE_THUMB_WIDTH) -> np.ndarray:
+    """
+    用于确认命中的灰度缩略图，宽度不超过 width。
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape[:2]
+    if w <= width:
+        return gray.copy()
+    return cv2.resize(gray, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+
+
+def thumbnails_match(a: np.ndarray, b: np.ndarray, tolerance: int = VL_CACHE_PIXEL_TOLERANCE) -> bool:
+    """
+    比较两张缩略图：按 4×4 的块求平均差，任何一块超过 tolerance 都视为内容不同。
+    只差几个字的新消息哈希可能相同，但在对应的块上会有明显差异；压缩和抗锯齿的噪点则被平均掉。
+    """
+    if a.shape != b.shape:
+        b = cv2.resize(b, (a.shape[1], a.shape[0]), interpolation=cv2.INTER_AREA)
+    diff = cv2.absdiff(a, b)
+    blocks = cv2.resize(diff, (max(1, diff.shape[1] // 4), max(1, diff.shape[0] // 4)), interpolation=cv2.INTER_AREA)
+    return int(blocks.max()) <= tolerance
+
+
+class TranscriptionCache:
+    """
+    以截图区域的感知哈希为键的视觉识别结果缓存。
+
+    聊天窗口切回之前的画面、或者同一画面只有噪点差异时，直接返回之前解析好的识别结果，
+    不再调用视觉模型。哈希只用于快速找到候选，命中前还要用缩略图确认内容确实相同。按 LRU 淘汰，条目超过 ttl 秒后失效；配置了 path 时会持久化到 JSON 文件。
+    命名空间（模型、提示词、预处理预设）不同的结果互不命中。
+    """
+
+    def __init__(self, capacity: int = VL_CACHE_SIZE, ttl: Optional[float] = VL_CACHE_TTL,
+                 max_distance: int = VL_CACHE_MAX_DISTANCE, path: Optional[str] = VL_CACHE_PATH):
+        """
+        :param capacity: 最多保存的条目数
+        :param ttl: 条目有效期（秒），None 表示不过期
+        :param max_distance: 视为同一画面的最大汉明距离，0 表示哈希必须完全相同
+        :param path: 持久化文件路径，None 表示只保存在内存中
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.path = path
+        # 键 -> (识别结果, 写入时间, 缩略图)，按最近使用排序
+        self.entries: "OrderedDict[CacheKey, Tuple[Any, float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def namespace(*parts: str) -> str:
+        return hashlib.md5("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def key(image: np.ndarray, namespace: str = "") -> CacheKey:
+        h, w = image.shape[:2]
+        # 尺寸按 8 像素分桶，裁剪边界相差一两个像素时仍能命中
+        return namespace, (round(h / 8), round(w / 8)), perceptual_hash(image)
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, key: CacheKey, image: np.ndarray) -> Optional[Any]:
+        """
+        查找识别结果，未命中时返回 None。
+        在同一命名空间和尺寸内按汉明距离从近到远检查候选，缩略图也一致才算命中。
+
+        :param key: key() 返回的键
+        :param image: 与 key 对应的截图区域
+        """
+        now = time.time()
+        thumb = None
+        with self._lock:
+            candidates = []
+            for other, (_, stored_at, _) in self.entries.items():
+                if other[:2] != key[:2]:
+                    continue
+                distance = hamming(other[2], key[2])
+                if distance <= self.max_distance and not self._expired(stored_at, now):
+                    candidates.append((distance, other))
+
+            found = None
+            for _, other in sorted(candidates, key=lambda c: c[0]):
+                if thumb is None:
+                    thumb = thumbnail(image)
+                if thumbnails_match(thumb, self.entries[other][2]):
+                    found = other
+                    break
+
+            if found is None:
+                metrics.incr("vl_cache_misses")
+                return None
+            self.entries.move_to_end(found)
+            metrics.incr("vl_cache_hits")
+            return self.entries[found][0]
+
+    def put(self, key: CacheKey, image: np.ndarray, result: Any) -> None:
+        with self._lock:
+            self.entries[key] = (result, time.time(), thumbnail(image))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            metrics.set_gauge("vl_cache_size", len(self.entries))
+        if self.path:
+            self.save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def load(self) -> None:
+        """
+        从 path 读取缓存，跳过已过期的条目。
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取识别缓存失败: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for item in items:
+                if self._expired(item["stored_at"], now):
+                    continue
+                key = (item["namespace"], tuple(item["size"]), int(item["hash"], 16))
+                thumb = cv2.imdecode(np.frombuffer(base64.b64decode(item["thumbnail"]), np.uint8), cv2.IMREAD_GRAYSCALE)
+                if thumb is None:
+                    continue
+                self.entries[key] = (item["result"], item["stored_at"], thumb)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        logging.info(f"已加载 {len(self.entries)} 条识别缓存")
+
+    def save(self) -> None:
+        """
+        写入 path；先写临时文件再替换，避免中途退出时损坏缓存文件。
+        """
+        with self._lock:
+            items = [
+                {"namespace": ns, "size": list(size), "hash": f"{h:x}", "result": result, "stored_at": stored_at,
+                 "thumbnail": base64.b64encode(cv2.imencode(".png", thumb)[1].tobytes()).decode("ascii")}
+                for (ns, size, h), (result, stored_at, thumb) in self.entries.items()
+            ]
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"保存识别缓存失败: {e}")
+
+
+_cache: Optional[TranscriptionCache] = None
+
+
+def get_transcription_cache() -> TranscriptionCache:
+    """
+    获取共享的识别结果缓存。
+    """
+    global _cache
+    if _cache is None:
+        _cache = TranscriptionCache()
+    return _cache